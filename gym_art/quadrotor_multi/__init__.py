@@ -0,0 +1,32 @@
+def warmup(quads_use_numba=(True, 'fused'), quads_precision='float64', num_agents=2):
+    """
+    Compile the numba kernels, or load them from the on-disk cache, by stepping a tiny swarm once per numba mode and
+    precision: the float32 kernels have signatures of their own.
+    Call it once in the launcher process before the rollout workers start: the workers then load the compiled
+    kernels from the cache instead of all of them compiling the same code at the same time.
+    Returns the time it took per (mode, precision), in seconds.
+    """
+    import time
+
+    from gym_art.quadrotor_multi.quadrotor_multi import QuadrotorEnvMulti
+
+    if isinstance(quads_use_numba, (bool, str)):
+        quads_use_numba = (quads_use_numba,)
+    if isinstance(quads_precision, str):
+        quads_precision = (quads_precision,)
+
+    timings = dict()
+    for use_numba in quads_use_numba:
+        for precision in quads_precision:
+            start = time.time()
+            env = QuadrotorEnvMulti(
+                num_agents=num_agents, dynamics_params='Crazyflie', sense_noise='default', init_random_state=True,
+                swarm_obs='pos_vel_goals_ndist_gdist', quads_use_numba=use_numba, quads_precision=precision,
+                dynamics_change=dict(noise=dict(thrust_noise_ratio=0.05), damp=dict(vel=0, omega_quadratic=0)),
+            )
+            env.reset()
+            env.step([env.action_space.sample() for _ in range(num_agents)])
+            env.close()
+            timings[(use_numba, precision)] = time.time() - start
+
+    return timings
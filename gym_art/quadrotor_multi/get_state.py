@@ -2,6 +2,11 @@ import numpy as np
 
 ## NOTE: the state_* methods are static because otherwise getattr memorizes self
 
+def attitude_quat(dynamics):
+    """The quaternion of the dynamics if they integrate one (attitude='quat'), else None."""
+    return dynamics.quat if dynamics.swarm.attitude == 'quat' else None
+
+
 def state_xyz_vxyz_R_omega(self):
     if self.use_numba:
         pos, vel, rot, omega, acc = self.sense_noise.add_noise_numba(
@@ -10,7 +15,8 @@ def state_xyz_vxyz_R_omega(self):
             self.dynamics.rot,
             self.dynamics.omega,
             self.dynamics.accelerometer,
-            self.dt
+            self.dt,
+            quat=attitude_quat(self.dynamics),
         )
     else:
         pos, vel, rot, omega, acc = self.sense_noise.add_noise(
@@ -22,7 +28,7 @@ def state_xyz_vxyz_R_omega(self):
             dt=self.dt
         )
     # return np.concatenate([pos - self.goal[:3], vel, rot.flatten(), omega, (pos[2],)])
-    return np.concatenate([pos - self.goal[:3], vel, rot.flatten(), omega])
+    return np.concatenate([pos - self.goal[:3], vel, rot.flatten(), omega], dtype=pos.dtype)
 
 def state_xyz_vxyz_R_omega_wall(self):
     if self.use_numba:
@@ -32,7 +38,8 @@ def state_xyz_vxyz_R_omega_wall(self):
             self.dynamics.rot,
             self.dynamics.omega,
             self.dynamics.accelerometer,
-            self.dt
+            self.dt,
+            quat=attitude_quat(self.dynamics),
         )
     else:
         pos, vel, rot, omega, acc = self.sense_noise.add_noise(
@@ -46,7 +53,41 @@ def state_xyz_vxyz_R_omega_wall(self):
     # return np.concatenate([pos - self.goal[:3], vel, rot.flatten(), omega, (pos[2],)])
     wall_box_0 = np.clip(pos - self.room_box[0], a_min=0.0, a_max=5.0)
     wall_box_1 = np.clip(self.room_box[1] - pos, a_min=0.0, a_max=5.0)
-    return np.concatenate([pos - self.goal[:3], vel, rot.flatten(), omega, wall_box_0, wall_box_1])
+    return np.concatenate([pos - self.goal[:3], vel, rot.flatten(), omega, wall_box_0, wall_box_1], dtype=pos.dtype)
+
+def swarm_sensor_readings(self):
+    """Noisy pos, vel, rot, omega and acc of all agents of a QuadrotorEnvMulti, (N, 3) and (N, 3, 3) arrays."""
+    swarm = self.swarm_dynamics
+    swarm.sync_rot()
+    return self.swarm_sense_noise.add_noise(swarm.pos, swarm.vel, swarm.rot, swarm.omega, swarm.accelerometer,
+                                            self.envs[0].dt)
+
+
+def _swarm_concatenate(columns, out):
+    if out is None:
+        return np.concatenate(columns, axis=1, dtype=columns[0].dtype)
+    return np.concatenate(columns, axis=1, out=out)
+
+
+def swarm_state_xyz_vxyz_R_omega(self, out=None):
+    """
+    state_xyz_vxyz_R_omega() of all agents of a QuadrotorEnvMulti at once, one row per agent.
+    out is an optional (N, 18) array the observations are written into, e.g. ObservationBuffer.self_obs.
+    """
+    pos, vel, rot, omega, acc = swarm_sensor_readings(self)
+    goals = np.array([e.goal[:3] for e in self.envs])
+    return _swarm_concatenate([pos - goals, vel, rot.reshape(-1, 9), omega], out)
+
+
+def swarm_state_xyz_vxyz_R_omega_wall(self, out=None):
+    """state_xyz_vxyz_R_omega_wall() of all agents of a QuadrotorEnvMulti at once, see swarm_state_xyz_vxyz_R_omega()."""
+    pos, vel, rot, omega, acc = swarm_sensor_readings(self)
+    goals = np.array([e.goal[:3] for e in self.envs])
+    room_box = self.swarm_dynamics.room_box
+    wall_box_0 = np.clip(pos - room_box[:, 0], a_min=0.0, a_max=5.0)
+    wall_box_1 = np.clip(room_box[:, 1] - pos, a_min=0.0, a_max=5.0)
+    return _swarm_concatenate([pos - goals, vel, rot.reshape(-1, 9), omega, wall_box_0, wall_box_1], out)
+
 
 def state_xyz_vxyz_tx3_R_omega(self):        
     pos, vel, rot, omega, acc = self.sense_noise.add_noise(
@@ -0,0 +1,65 @@
+"""
+Pools of pre-generated random numbers for the thrust and sensor noise.
+
+Every agent draws a dozen vectors of 3 or 4 normal / uniform samples per control step, the overhead of the individual
+numpy.random calls dominates the cost of the samples themselves. A NoisePool draws large blocks of standard normals
+and uniforms with a np.random.Generator and hands out consecutive slices, a block is refilled lazily once it is used
+up. The samples only depend on the seed and on the sequence of requests, so seeded runs are reproducible.
+"""
+import math
+
+import numpy as np
+
+DEFAULT_BLOCK_SIZE = 1 << 16
+
+
+class NoisePool:
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE, seed=None):
+        """
+        @param: block_size: number of samples generated at once for each distribution
+        @param: seed: seed of the generator, None for fresh entropy from the OS
+        """
+        if block_size <= 0:
+            raise ValueError(f'Block size has to be positive, got {block_size}')
+        self.block_size = block_size
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        """Restart the pool with a new generator, the unused samples of the current blocks are discarded."""
+        self.rng = np.random.default_rng(seed)
+        self._normals = np.empty(0)
+        self._uniforms = np.empty(0)
+        self._normal_pos = 0
+        self._uniform_pos = 0
+        self.num_refills = 0
+
+    def normal(self, shape):
+        """Standard normal samples, shape is an int or a tuple."""
+        size = shape if isinstance(shape, int) else math.prod(shape)
+        start = self._normal_pos
+        end = start + size
+        if end > len(self._normals):
+            if size > self.block_size:
+                return self.rng.standard_normal(shape)
+            # a new array instead of an in-place refill, slices handed out earlier stay valid
+            self._normals = self.rng.standard_normal(self.block_size)
+            self.num_refills += 1
+            start, end = 0, size
+        self._normal_pos = end
+        samples = self._normals[start:end]
+        return samples if isinstance(shape, int) else samples.reshape(shape)
+
+    def uniform(self, shape):
+        """Uniform samples in [-1, 1), scaled by the caller to the range of the noise."""
+        size = shape if isinstance(shape, int) else math.prod(shape)
+        start = self._uniform_pos
+        end = start + size
+        if end > len(self._uniforms):
+            if size > self.block_size:
+                return self.rng.uniform(-1., 1., shape)
+            self._uniforms = self.rng.uniform(-1., 1., self.block_size)
+            self.num_refills += 1
+            start, end = 0, size
+        self._uniform_pos = end
+        samples = self._uniforms[start:end]
+        return samples if isinstance(shape, int) else samples.reshape(shape)
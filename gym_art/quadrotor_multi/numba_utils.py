@@ -1,12 +1,13 @@
+from types import FunctionType
+
 import numpy as np
 import numpy.random as nr
-from numba import njit, types, vectorize, int32, float32, double, boolean
+from numba import config, njit, set_num_threads, types, vectorize
 from numba.core.errors import TypingError
 from numba.extending import overload
-from numba.experimental import jitclass
 
 
-@overload(np.clip)
+@overload(np.clip, jit_options={'cache': True})
 def impl_clip(a, a_min, a_max):
     # Check that `a_min` and `a_max` are scalars, and at most one of them is None.
     if not isinstance(a_min, (types.Integer, types.Float, types.NoneType)):
@@ -54,53 +55,94 @@ def impl_clip(a, a_min, a_max):
     return impl
 
 
-@vectorize(nopython=True)
+@vectorize(nopython=True, cache=True)
 def angvel2thrust_numba(w, linearity=0.424):
     return (1 - linearity) * w ** 2 + linearity * w
 
 
-@njit
+@njit(cache=True)
 def numba_cross(a, b):
     return np.array([a[1]*b[2] - a[2]*b[1], a[2]*b[0] - a[0]*b[2], a[0]*b[1] - a[1]*b[0]])
 
 
-spec = [
-    ('action_dimension', int32),
-    ('mu', float32),
-    ('theta', float32),
-    ('sigma', float32),
-    ('state', double[:]),
-    ('use_seed', boolean)
-]
+@njit(cache=True)
+def seed_numba(seed):
+    # numba keeps its own random state, seeding numpy does not affect the njit kernels
+    nr.seed(seed)
+
+
+@njit(cache=True)
+def ou_noise_step_numba(state, mu, theta, sigma):
+    for i in range(state.shape[0]):
+        state[i] += theta * (mu - state[i]) + sigma * nr.randn()
+    return state
+
+
+@njit(cache=True)
+def ou_noise_step_from_normals_numba(state, mu, theta, sigma, normals):
+    """Same as ou_noise_step_numba() with standard normal samples drawn by the caller, e.g. from a NoisePool."""
+    for i in range(state.shape[0]):
+        state[i] += theta * (mu - state[i]) + sigma * normals[i]
+    return state
+
+
+@njit(cache=True)
+def ou_noise_rows_step_numba(state, theta, sigma):
+    """Zero-mean OU step for a (N, k) state with one sigma per row, in place."""
+    for n in range(state.shape[0]):
+        for i in range(state.shape[1]):
+            state[n, i] += -theta * state[n, i] + sigma[n] * nr.randn()
+    return state
 
 
-@jitclass(spec)
 class OUNoiseNumba:
-    """Ornstein–Uhlenbeck process"""
+    """
+    Ornstein–Uhlenbeck process, the update is done by an njit kernel.
+    This used to be a jitclass, but jitclasses cannot be cached on disk and were recompiled by every worker.
+    """
 
-    def __init__(self, action_dimension, mu=0, theta=0.15, sigma=0.3, use_seed=False):
+    def __init__(self, action_dimension, mu=0, theta=0.15, sigma=0.3, use_seed=False, noise_pool=None):
         """
         @param: mu: mean of noise
         @param: theta: stabilization coeff (i.e. noise return to mean)
         @param: sigma: noise scale coeff
         @param: use_seed: set the random number generator to some specific seed for test
+        @param: noise_pool: NoisePool the samples are taken from, None to use the numba random generator
         """
         self.action_dimension = action_dimension
         self.mu = mu
         self.theta = theta
         self.sigma = sigma
+        self.noise_pool = noise_pool
         self.state = np.ones(self.action_dimension) * self.mu
         self.reset()
 
         if use_seed:
-            nr.seed(2)
+            seed_numba(2)
 
     def reset(self):
         self.state = np.ones(self.action_dimension) * self.mu
 
     def noise(self):
-        x = self.state
-        dx = self.theta * (self.mu - x) + self.sigma * nr.randn(len(x))
-        self.state = x + dx
-        return self.state
-
+        # the state is updated in place
+        if self.noise_pool is not None:
+            return ou_noise_step_from_normals_numba(self.state, self.mu, self.theta, self.sigma,
+                                                    self.noise_pool.normal(self.action_dimension))
+        return ou_noise_step_numba(self.state, self.mu, self.theta, self.sigma)
+
+
+def set_numba_threads(num_threads):
+    """Number of threads used by the parallel (prange) kernels of the calling thread, None keeps the numba default."""
+    if num_threads:
+        set_num_threads(min(num_threads, config.NUMBA_NUM_THREADS))
+
+
+def njit_variant(py_func, name, **jit_options):
+    """
+    njit-compiles a copy of py_func called name, e.g. a parallel=True version of a kernel that also exists serially.
+    The on-disk cache is indexed by the qualified name of the function, so the variants need names of their own.
+    """
+    func = FunctionType(py_func.__code__, py_func.__globals__, name, py_func.__defaults__, py_func.__closure__)
+    func.__qualname__ = name
+    func.__doc__ = py_func.__doc__
+    return njit(**jit_options)(func)
@@ -112,7 +112,7 @@ class ExperienceReplayWrapper(gym.Wrapper):
                     and self.env.envs[0].tick % self.replay_buffer.cp_step_size_freq == 0:
                 self.save_checkpoint(obs)
 
-            if self.env.last_step_unique_collisions.any() and self.env.use_replay_buffer and self.env.activate_replay_buffer \
+            if len(self.env.last_step_unique_collisions) > 0 and self.env.use_replay_buffer and self.env.activate_replay_buffer \
                     and self.env.envs[0].tick > self.env.collisions_grace_period_seconds * self.env.envs[0].control_freq and not self.saved_in_replay_buffer:
 
                 if self.env.envs[0].tick - self.last_tick_added_to_buffer > 5 * self.env.envs[0].control_freq:
@@ -151,6 +151,7 @@ class ExperienceReplayWrapper(gym.Wrapper):
 
             # we want to use these for tensorboard, so reset them to zero to get accurate stats
             replayed_env.collisions_per_episode = replayed_env.collisions_after_settle = 0
+            replayed_env.reward_components.reset_episode()
             self.env = replayed_env
 
             self.replay_buffer.cleanup()
@@ -0,0 +1,355 @@
+"""
+Fused control step of the whole swarm, selected with quads_use_numba='fused' or, for large swarms, 'parallel'.
+
+A single @njit(nogil=True) call advances the dynamics of all quadrotors and produces everything QuadrotorEnvMulti
+needs from the individual QuadrotorSingle envs: observations (including the neighbor block), reward components,
+crash and done flags, drone-drone collision pairs and proximity penalties.
+In the 'parallel' mode the per-agent loops (dynamics, sensor noise, rewards, distances and neighbor observations)
+run in numba.prange, the number of threads is set with quads_num_threads.
+The noise of the fused path is drawn from the numba random generator, a NoisePool of the swarm is not used.
+The per-env Python path (QuadrotorSingle._step, add_neighborhood_obs, calculate_collision_matrix) is kept as the
+reference implementation, see tests/test_numba_opt.py for the parity check.
+"""
+import numpy as np
+from numba import prange
+
+from gym_art.quadrotor_multi.quad_utils import quat2R_numba, quatXquat_numba
+from gym_art.quadrotor_multi.quadrotor_control import RawControl
+from gym_art.quadrotor_multi.numba_utils import njit_variant, set_numba_threads
+from gym_art.quadrotor_multi.quadrotor_swarm_dynamics import EPS, GRAV, INTEGRATORS, quad_step_numba, \
+    quat_to_rot_numba
+from gym_art.quadrotor_multi.sensor_noise import quat_from_small_angle_numba, rot2quat_numba
+
+# Order of the coefficients in the rew_coeff array passed to the kernel
+REWARD_COEFFS = ('pos', 'effort', 'crash', 'orient', 'yaw', 'rot', 'attitude', 'spin', 'action_change', 'vel')
+
+NEIGHBOR_OBS_TYPES = {'none': 0, 'pos_vel': 1, 'pos_vel_goals': 2, 'pos_vel_goals_ndist_gdist': 3}
+
+
+class SwarmFusedStep:
+    """
+    Owns the configuration and the output buffers of fused_swarm_step() for a QuadrotorEnvMulti.
+    Only raw 3D control without obstacles in the single envs and without the gyro bias noise model is supported.
+    """
+
+    def __init__(self, env, parallel=False, num_threads=None):
+        e = env.envs[0]
+        if not isinstance(e.controller, RawControl):
+            raise NotImplementedError('Fused step only supports raw 3D control')
+        if e.obs_repr not in ('xyz_vxyz_R_omega', 'xyz_vxyz_R_omega_wall'):
+            raise NotImplementedError(f'Fused step does not support obs_repr {e.obs_repr}')
+        if e.obstacles is not None:
+            raise NotImplementedError('Fused step does not support obstacles of the single env')
+        if not e.sense_noise.bypass and e.sense_noise.gyro_norm_std != 0.:
+            raise NotImplementedError('Fused step does not support the gyro bias noise model')
+
+        self.env = env
+        self.swarm = env.swarm_dynamics
+        self.parallel = parallel
+        self.num_threads = num_threads
+        num_agents = env.num_agents
+
+        self.wall_obs = e.obs_repr == 'xyz_vxyz_R_omega_wall'
+
+        sn = e.sense_noise
+        self.sense_noise_on = not sn.bypass
+        self.sense_noise_params = np.array([
+            sn.pos_norm_std, sn.pos_unif_range, sn.vel_norm_std, sn.vel_unif_range, sn.gyro_noise_density,
+            sn.quat_norm_std, sn.quat_unif_range,
+        ]) if self.sense_noise_on else np.zeros(7)
+
+        self.neighbor_obs_type = NEIGHBOR_OBS_TYPES[env.swarm_obs] if num_agents > 1 else 0
+        self.num_neighbors = env.num_use_neighbor_obs if self.neighbor_obs_type > 0 else 0
+        # Inputs and outputs have the precision of the dynamics, rewards are always accumulated in float64
+        self.dtype = dtype = self.swarm.dtype
+        self.nbr_clip_low = np.asarray(env.clip_neighbor_space_min_box, dtype=dtype)
+        self.nbr_clip_high = np.asarray(env.clip_neighbor_space_max_box, dtype=dtype)
+
+        self.actions_prev = np.zeros((num_agents, 4), dtype=dtype)
+        self.goals = np.zeros((num_agents, 3), dtype=dtype)
+
+        self.rewards = np.zeros(num_agents)
+        self.crashed = np.zeros(num_agents, dtype=np.bool_)
+        self.dones = np.zeros(num_agents, dtype=np.bool_)
+        self.collision_matrix = np.zeros((num_agents, num_agents), dtype=np.float32)
+        self.dist = np.zeros((num_agents, num_agents), dtype=dtype)
+        self.collision_pairs = np.zeros((num_agents * (num_agents - 1) // 2, 2), dtype=np.int64)
+        self.proximity = np.zeros(num_agents)
+
+    def reset(self):
+        self.actions_prev[:] = 0.
+
+    def step(self, actions):
+        env, swarm, e = self.env, self.swarm, self.env.envs[0]
+        controller = e.controller
+        for i, quad_env in enumerate(env.envs):
+            self.goals[i] = quad_env.goal[:3]
+        rew_coeff = np.array([env.rew_coeff[k] for k in REWARD_COEFFS])
+
+        actions = np.asarray(actions, dtype=self.dtype)
+        step_func = fused_swarm_step
+        if self.parallel:
+            set_numba_threads(self.num_threads)
+            step_func = fused_swarm_step_parallel
+
+        num_collisions = step_func(
+            actions, self.actions_prev, float(controller.scale), float(controller.bias), controller.low, controller.high,
+            swarm.thrust_noise, swarm.thrust_noise_sigma, swarm.thrust_noise_theta, e.dt, e.sim_steps,
+            INTEGRATORS[swarm.integrator], swarm.attitude == 'quat',
+            swarm.pos, swarm.vel, swarm.acc, swarm.accelerometer, swarm.rot, swarm.quat, swarm.omega, swarm.omega_dot,
+            swarm.torque,
+            swarm.thrust_cmds_damp, swarm.thrust_rot_damp, swarm.since_last_svd, swarm.room_box,
+            swarm.mass, swarm.inertia, swarm.thrust_max, swarm.torque_max, swarm.prop_crossproducts, swarm.prop_ccw,
+            swarm.motor_linearity, swarm.motor_damp_time_up, swarm.motor_damp_time_down, swarm.vel_damp,
+            swarm.damp_omega_quadratic, swarm.omega_max, swarm.gravity, swarm.since_last_svd_limit,
+            self.goals, env.quad_arm, e.tick, e.ep_len,
+            self.sense_noise_on, self.sense_noise_params, self.wall_obs,
+            rew_coeff, e.quads_settle, e.quads_settle_range_meters, e.quads_vel_reward_out_range,
+            self.neighbor_obs_type, self.num_neighbors, env.local_metric == 'dist_inverse', env.local_coeff,
+            self.nbr_clip_low, self.nbr_clip_high,
+            env.collision_hitbox_radius, env.collision_falloff_radius, env.rew_coeff['quadcol_bin_smooth_max'],
+            env.control_dt,
+            env.obs_buffer.agent_obs, self.rewards, env.reward_components.step, self.crashed, self.dones,
+            self.collision_matrix, self.dist, self.collision_pairs, self.proximity,
+        )
+
+        # the kernel bypasses the controllers, their thrusts are kept for get_diagnostics()
+        thrusts = np.clip(controller.scale * (actions + controller.bias), controller.low, controller.high)
+        tick = e.tick + 1
+        for i, quad_env in enumerate(env.envs):
+            quad_env.actions[1] = quad_env.actions[0]
+            quad_env.actions[0] = self.actions_prev[i].copy()
+            quad_env.controller.action = thrusts[i]
+            quad_env.crashed = bool(self.crashed[i])
+            quad_env.time_remain = quad_env.ep_len - quad_env.tick
+            quad_env.tick = tick
+            quad_env.traj_count += int(self.dones[i])
+
+        # the reward components are reported by the env
+        infos = [{} for _ in env.envs]
+        if e.info_level == 'full':
+            for info, quad_env in zip(infos, env.envs):
+                info.update(quad_env.get_diagnostics())
+
+        return env.obs_buffer.buffer, self.rewards.tolist(), self.dones.tolist(), infos, self.collision_matrix.copy(), \
+            self.collision_pairs[:num_collisions].copy(), self.dist.copy(), -self.proximity
+
+
+def _fused_swarm_step(actions, actions_prev, act_scale, act_bias, act_low, act_high,
+                      thrust_noise, thrust_noise_sigma, thrust_noise_theta, dt, steps_num, integrator, use_quat,
+                      pos, vel, acc, accelerometer, rot, quat, omega, omega_dot, torque,
+                      thrust_cmds_damp, thrust_rot_damp, since_last_svd, room_box,
+                      mass, inertia, thrust_max, torque_max, prop_crossproducts, prop_ccw,
+                      motor_linearity, motor_damp_time_up, motor_damp_time_down, vel_damp,
+                      damp_omega_quadratic, omega_max, gravity, since_last_svd_limit,
+                      goals, arm, tick, ep_len,
+                      sense_noise_on, sense_noise_params, wall_obs,
+                      rew_coeff, quads_settle, quads_settle_range_meters, quads_vel_reward_out_range,
+                      neighbor_obs_type, num_neighbors, local_metric_inverse, local_coeff, nbr_clip_low, nbr_clip_high,
+                      hitbox_radius, falloff_radius, proximity_max_penalty, control_dt,
+                      obs, rewards, rew_components, crashed, dones,
+                      collision_matrix, dist, collision_pairs, proximity):
+    """
+    One control step of the whole swarm. All outputs are written into the preallocated arrays passed as arguments.
+    On exit actions_prev holds the current actions. Returns the number of collision pairs written to collision_pairs.
+    Every prange iteration only writes the rows of its own agent.
+    With use_quat the attitude is integrated as a quaternion and rot is materialized once per control step.
+    """
+    num_agents = pos.shape[0]
+    thrust_cmds = np.empty((num_agents, 4))
+    theta = np.empty((num_agents, 3))
+    done = tick + 1 > ep_len
+
+    for n in prange(num_agents):
+        # Raw control and Ornstein-Uhlenbeck thrust noise (sampled once per control step)
+        for k in range(4):
+            a = act_scale * (actions[n, k] + act_bias)
+            thrust_cmds[n, k] = min(max(a, act_low[k]), act_high[k])
+            thrust_noise[n, k] += -thrust_noise_theta * thrust_noise[n, k] + \
+                thrust_noise_sigma[n] * np.random.normal(0., 1.)
+
+        quad_step_numba(
+            n, thrust_cmds, thrust_noise, dt, steps_num, integrator, use_quat, EPS, GRAV,
+            pos, vel, acc, accelerometer, rot, quat, omega, omega_dot, torque,
+            thrust_cmds_damp, thrust_rot_damp, since_last_svd, room_box,
+            mass, inertia, thrust_max, torque_max, prop_crossproducts, prop_ccw,
+            motor_linearity, motor_damp_time_up, motor_damp_time_down, vel_damp,
+            damp_omega_quadratic, omega_max, gravity, since_last_svd_limit,
+        )
+        if use_quat:
+            # The rewards and the observations need the matrix
+            quat_to_rot_numba(quat, rot, n)
+
+        dones[n] = done
+
+        # Crash with the floor or the walls
+        crash = pos[n, 2] <= arm
+        for i in range(3):
+            if pos[n, i] < room_box[n, 0, i] or pos[n, i] > room_box[n, 1, i]:
+                crash = True
+        crashed[n] = crash
+
+        # Reward, see compute_reward_weighted()
+        dx, dy, dz = goals[n, 0] - pos[n, 0], goals[n, 1] - pos[n, 1], goals[n, 2] - pos[n, 2]
+        dist_goal = (dx * dx + dy * dy + dz * dz) ** 0.5
+        cost_pos_raw = dist_goal
+        cost_pos = rew_coeff[0] * cost_pos_raw
+        vel_coeff = rew_coeff[9]
+        if dist_goal <= quads_settle_range_meters and quads_settle:
+            cost_pos = 0.
+            vel_coeff = quads_vel_reward_out_range
+
+        cost_effort_raw, cost_act_change_raw = 0., 0.
+        for k in range(4):
+            cost_effort_raw += actions[n, k] ** 2
+            cost_act_change_raw += (actions[n, k] - actions_prev[n, k]) ** 2
+            actions_prev[n, k] = actions[n, k]
+        cost_effort_raw = cost_effort_raw ** 0.5
+        cost_act_change_raw = cost_act_change_raw ** 0.5
+
+        cost_vel_raw = (vel[n, 0] ** 2 + vel[n, 1] ** 2 + vel[n, 2] ** 2) ** 0.5
+        cost_orient_raw = -np.float64(rot[n, 2, 2])
+        cost_yaw_raw = -np.float64(rot[n, 0, 0])
+        rot_cos = ((rot[n, 0, 0] + rot[n, 1, 1] + rot[n, 2, 2]) - 1.) / 2.
+        cost_rotation_raw = np.arccos(min(max(rot_cos, -1.), 1.))
+        cost_attitude_raw = np.arccos(min(max(rot[n, 2, 2], -1.), 1.))
+        cost_spin_raw = (omega[n, 0] ** 2 + omega[n, 1] ** 2 + omega[n, 2] ** 2) ** 0.5
+        cost_crash_raw = 1. if crash else 0.
+
+        costs_raw = (cost_pos_raw, cost_effort_raw, cost_crash_raw, cost_orient_raw, cost_yaw_raw, cost_rotation_raw,
+                     cost_attitude_raw, cost_spin_raw, cost_act_change_raw, cost_vel_raw)
+        costs = (cost_pos, rew_coeff[1] * cost_effort_raw, rew_coeff[2] * cost_crash_raw,
+                 rew_coeff[3] * cost_orient_raw, rew_coeff[4] * cost_yaw_raw, rew_coeff[5] * cost_rotation_raw,
+                 rew_coeff[6] * cost_attitude_raw, rew_coeff[7] * cost_spin_raw, rew_coeff[8] * cost_act_change_raw,
+                 vel_coeff * cost_vel_raw)
+
+        reward = 0.
+        for c in costs:
+            reward += c
+        rewards[n] = -dt * reward
+
+        # columns of quad_rewards.AGENT_REWARD_COMPONENTS: main, pos, action, crash, orient, yaw, rot, attitude, spin,
+        # act_change, vel, then the same raw values
+        rew_components[n, 0] = -dt * costs[0]
+        rew_components[n, 11] = -dt * costs_raw[0]
+        for c in range(len(costs)):
+            rew_components[n, 1 + c] = -dt * costs[c]
+            rew_components[n, 12 + c] = -dt * costs_raw[c]
+
+        # Observation of the quad itself, see get_state.state_xyz_vxyz_R_omega()
+        if sense_noise_on:
+            for i in range(3):
+                obs[n, i] = pos[n, i] + np.random.normal(0., sense_noise_params[0]) + \
+                    np.random.uniform(-sense_noise_params[1], sense_noise_params[1]) - goals[n, i]
+                obs[n, 3 + i] = vel[n, i] + np.random.normal(0., sense_noise_params[2]) + \
+                    np.random.uniform(-sense_noise_params[3], sense_noise_params[3])
+                obs[n, 15 + i] = omega[n, i] + np.random.normal(0., sense_noise_params[4])
+                theta[n, i] = np.random.normal(0., sense_noise_params[5]) + \
+                    np.random.uniform(-sense_noise_params[6], sense_noise_params[6])
+            quat_theta = quat_from_small_angle_numba(theta[n])
+            if use_quat:
+                noisy_quat = quatXquat_numba(quat[n], quat_theta)
+            else:
+                noisy_quat = quatXquat_numba(rot2quat_numba(rot[n]), quat_theta)
+            noisy_rot = quat2R_numba(noisy_quat[0], noisy_quat[1], noisy_quat[2], noisy_quat[3])
+            for i in range(3):
+                for j in range(3):
+                    obs[n, 6 + 3 * i + j] = noisy_rot[i, j]
+        else:
+            for i in range(3):
+                obs[n, i] = pos[n, i] - goals[n, i]
+                obs[n, 3 + i] = vel[n, i]
+                obs[n, 15 + i] = omega[n, i]
+                for j in range(3):
+                    obs[n, 6 + 3 * i + j] = rot[n, i, j]
+
+        if wall_obs:
+            for i in range(3):
+                noisy_pos = obs[n, i] + goals[n, i]
+                obs[n, 18 + i] = min(max(noisy_pos - room_box[n, 0, i], 0.), 5.)
+                obs[n, 21 + i] = min(max(room_box[n, 1, i] - noisy_pos, 0.), 5.)
+
+    for n in range(num_agents):
+        if np.isnan(rewards[n]) or not np.isfinite(rewards[n]):
+            raise ValueError('QuadEnv: reward is Nan')
+
+    # Pairwise distances, collisions and proximity penalties between drones, see calculate_collision_matrix().
+    # Every row is computed independently, i.e. each distance is evaluated twice, which keeps the rows parallel
+    for i in prange(num_agents):
+        penalties = 0.
+        for j in range(num_agents):
+            if j == i:
+                dist[i, i] = 0.
+                collision_matrix[i, i] = 0.
+                continue
+            d = ((pos[i, 0] - pos[j, 0]) ** 2 + (pos[i, 1] - pos[j, 1]) ** 2 + (pos[i, 2] - pos[j, 2]) ** 2) ** 0.5
+            dist[i, j] = d
+            collision_matrix[i, j] = 1. if d < hitbox_radius * arm else 0.
+
+            if falloff_radius:
+                penalty = (-proximity_max_penalty / (falloff_radius * arm)) * d + proximity_max_penalty
+                if penalty > 0.:
+                    penalties += control_dt * penalty
+        proximity[i] = penalties
+
+    num_collisions = 0
+    for i in range(num_agents):
+        for j in range(i + 1, num_agents):
+            if collision_matrix[i, j] > 0.:
+                collision_pairs[num_collisions, 0] = i
+                collision_pairs[num_collisions, 1] = j
+                num_collisions += 1
+
+    # Observations of the neighbors, see QuadrotorEnvMulti.neighborhood_indices() and extend_obs_space()
+    if neighbor_obs_type > 0:
+        obs_self_size = 24 if wall_obs else 18
+        nbr_obs_size = (6, 9, 11)[neighbor_obs_type - 1]
+        others = np.empty((num_agents, num_agents - 1), dtype=np.int64)
+        metric = np.empty((num_agents, num_agents - 1))
+        for i in prange(num_agents):
+            m = 0
+            for j in range(num_agents):
+                if j != i:
+                    others[i, m] = j
+                    m += 1
+
+            closest = others[i]
+            if num_neighbors < num_agents - 1:
+                for m in range(num_agents - 1):
+                    j = others[i, m]
+                    rel_dist = max(dist[i, j], 0.01)
+                    vel_proj = 0.
+                    for k in range(3):
+                        vel_proj += (pos[j, k] - pos[i, k]) / rel_dist * (vel[j, k] - vel[i, k])
+                    if local_metric_inverse:
+                        metric[i, m] = -(1.0 / rel_dist - local_coeff * vel_proj)
+                    else:
+                        metric[i, m] = rel_dist + local_coeff * vel_proj
+                closest = others[i][np.argsort(metric[i])[:num_neighbors]]
+
+            for m in range(num_neighbors):
+                j = closest[m]
+                start = obs_self_size + m * nbr_obs_size
+                gd = 0.
+                for k in range(3):
+                    obs[i, start + k] = pos[j, k] - pos[i, k]
+                    obs[i, start + 3 + k] = vel[j, k] - vel[i, k]
+                    if neighbor_obs_type > 1:
+                        g = goals[j, k] - pos[i, k]
+                        obs[i, start + 6 + k] = g
+                        gd += g * g
+                if neighbor_obs_type == 3:
+                    obs[i, start + 9] = dist[i, j]
+                    obs[i, start + 10] = gd ** 0.5
+
+            for c in range(num_neighbors * nbr_obs_size):
+                col = obs_self_size + c
+                obs[i, col] = min(max(obs[i, col], nbr_clip_low[c]), nbr_clip_high[c])
+
+    return num_collisions
+
+
+# prange is a plain range in the serial version, quads_use_numba='parallel' distributes the agents over numba threads
+fused_swarm_step = njit_variant(_fused_swarm_step, 'fused_swarm_step', nogil=True, cache=True)
+fused_swarm_step_parallel = njit_variant(_fused_swarm_step, 'fused_swarm_step_parallel', nogil=True, parallel=True,
+                                         cache=True)
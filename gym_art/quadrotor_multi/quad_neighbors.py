@@ -0,0 +1,124 @@
+"""
+Selection of the closest neighbors of every drone for the local observations (--quads_local_obs).
+
+The metric of a neighbor is its distance ('dist') or its inverse distance ('dist_inverse'), both corrected by
+local_coeff times the relative velocity projected on the direction to the neighbor. The metric is computed for all
+pairs of drones at once and the K smallest are selected with np.argpartition, only the K selected are sorted.
+
+With search='kdtree' the metric is only computed for the num_candidates nearest drones found by a KD-tree. Drones
+outside of the candidates are farther than all of them, so their metric is bounded from below by the distance of the
+farthest candidate minus the largest possible velocity term. Agents whose K-th metric is above that bound are
+selected again with 4 times more candidates, and eventually among all drones, so the result is the same as with
+search='full'.
+"""
+import numpy as np
+from scipy import spatial
+
+NEIGHBOR_SEARCH = ('full', 'kdtree')
+
+
+def neighbor_metric(rel_pos, rel_vel, local_metric='dist', local_coeff=0.0):
+    """Metric of the (..., 3) relative positions and velocities of the neighbors, the smaller the closer."""
+    rel_dist = np.maximum(np.linalg.norm(rel_pos, axis=-1), 0.01)
+    vel_proj = np.sum(rel_pos / rel_dist[..., None] * rel_vel, axis=-1)
+    if local_metric == 'dist':
+        return rel_dist + local_coeff * vel_proj
+    elif local_metric == 'dist_inverse':
+        return -1.0 * (1.0 / rel_dist - local_coeff * vel_proj)
+    else:
+        raise NotImplementedError(f'Unknown local metric {local_metric}')
+
+
+def top_k_smallest(values, k):
+    """Column indices of the k smallest values of every row, sorted by value."""
+    if k < values.shape[1]:
+        indices = np.argpartition(values, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+    order = np.argsort(np.take_along_axis(values, indices, axis=1), axis=1)
+    return np.take_along_axis(indices, order, axis=1)
+
+
+class NeighborSelector:
+    def __init__(self, num_agents, num_neighbors, local_metric='dist', local_coeff=0.0, search='full',
+                 num_candidates=None):
+        """
+        @param: num_neighbors: number K of neighbors selected for every drone
+        @param: search: 'full' to compute the metric of all pairs, 'kdtree' to prefilter the candidates with a KD-tree
+        @param: num_candidates: number of candidates of the KD-tree search, 2K by default
+        """
+        if search not in NEIGHBOR_SEARCH:
+            raise ValueError(f'Unknown neighbor search {search}, supported: {NEIGHBOR_SEARCH}')
+        self.num_agents = num_agents
+        self.num_neighbors = num_neighbors
+        self.local_metric = local_metric
+        self.local_coeff = local_coeff
+        self.search = search
+        if num_candidates is None:
+            num_candidates = 2 * num_neighbors
+        self.num_candidates = min(max(num_candidates, num_neighbors), num_agents - 1)
+
+        # (N, N - 1) indices of the other drones of every drone
+        self.others = np.array([[j for j in range(num_agents) if j != i] for i in range(num_agents)],
+                               dtype=np.int64).reshape(num_agents, -1)
+        self.num_full_selections = 0
+
+    def select(self, pos, vel):
+        """(N, K) indices of the closest neighbors of every drone, sorted by the metric."""
+        if self.search == 'kdtree' and self.num_candidates < self.num_agents - 1:
+            return self.select_kdtree(pos, vel)
+        return self.select_full(pos, vel)
+
+    def select_full(self, pos, vel, agents=None):
+        """Selection among all drones, for the given agents only if agents is an array of indices."""
+        others = self.others
+        if agents is not None:
+            others, pos_self, vel_self = others[agents], pos[agents, None], vel[agents, None]
+        else:
+            pos_self, vel_self = pos[:, None], vel[:, None]
+        metric = neighbor_metric(pos[others] - pos_self, vel[others] - vel_self, self.local_metric, self.local_coeff)
+        return np.take_along_axis(others, top_k_smallest(metric, self.num_neighbors), axis=1)
+
+    def select_kdtree(self, pos, vel):
+        tree = spatial.cKDTree(pos)
+        # bound of the relative speed of every agent to any other drone
+        vel_dev = np.linalg.norm(vel - vel.mean(axis=0), axis=1)
+        max_vel_term = abs(self.local_coeff) * (vel_dev + vel_dev.max())
+
+        closest = np.empty((self.num_agents, self.num_neighbors), dtype=np.int64)
+        agents = np.arange(self.num_agents)
+        num_candidates = self.num_candidates
+        while len(agents) > 0:
+            if num_candidates >= self.num_agents - 1:
+                self.num_full_selections += len(agents)
+                closest[agents] = self.select_full(pos, vel, agents=agents)
+                break
+            agents_closest, exact = self.select_candidates(tree, pos, vel, agents, num_candidates, max_vel_term)
+            closest[agents[exact]] = agents_closest[exact]
+            # the selection of the other agents is retried with more candidates
+            agents = agents[~exact]
+            num_candidates *= 4
+        return closest
+
+    def select_candidates(self, tree, pos, vel, agents, num_candidates, max_vel_term):
+        """Selection of the given agents among their num_candidates nearest drones, and whether it is exact."""
+        cand_dist, candidates = tree.query(pos[agents], k=num_candidates + 1)
+
+        # drop the drone itself, which is not necessarily the first result if drones are at the same position
+        is_self = candidates == agents[:, None]
+        keep = np.argsort(is_self, axis=1, kind='stable')[:, :num_candidates]
+        candidates = np.take_along_axis(candidates, keep, axis=1)
+
+        metric = neighbor_metric(pos[candidates] - pos[agents, None], vel[candidates] - vel[agents, None],
+                                 self.local_metric, self.local_coeff)
+        selected = top_k_smallest(metric, self.num_neighbors)
+        closest = np.take_along_axis(candidates, selected, axis=1)
+        kth_metric = np.take_along_axis(metric, selected[:, -1:], axis=1)[:, 0]
+
+        # lower bound of the metric of the drones that are not candidates, they are at least as far as the last result
+        outside_dist = np.maximum(cand_dist[:, -1], 0.01)
+        if self.local_metric == 'dist':
+            outside_bound = outside_dist - max_vel_term[agents]
+        else:
+            outside_bound = -1.0 / outside_dist - max_vel_term[agents]
+        return closest, kth_metric <= outside_bound
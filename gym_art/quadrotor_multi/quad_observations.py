@@ -0,0 +1,51 @@
+"""
+Observations of all agents of a QuadrotorEnvMulti in a persistent (N, obs_dim) array.
+
+The columns are split in blocks: the own state of the agent (state_* of get_state), the relative states of its
+neighbors (QuadrotorEnvMulti.extend_obs_space() or the fused step) and one block per obstacle (MultiObstacles). Each
+block is written in place every step, the env only copies the whole buffer once when it returns the observations.
+"""
+import numpy as np
+
+from gym_art.quadrotor_multi.quad_obstacle_utils import OBSTACLE_OBS_SIZE
+
+
+class ObservationBuffer:
+    def __init__(self, num_agents, self_obs_size, neighbor_obs_size=0, num_neighbors=0, num_obstacles=0,
+                 dtype=np.float32):
+        self.num_agents = num_agents
+        self.num_obstacles = num_obstacles
+        neighbors_end = self_obs_size + num_neighbors * neighbor_obs_size
+        obs_dim = neighbors_end + num_obstacles * OBSTACLE_OBS_SIZE
+        self.buffer = np.zeros((num_agents, obs_dim), dtype=dtype)
+
+        # the blocks are views created on access, so deep copies of the env keep them consistent with the buffer
+        self.self_slice = slice(0, self_obs_size)
+        self.neighbor_slice = slice(self_obs_size, neighbors_end)
+        self.agent_slice = slice(0, neighbors_end)
+        self.obstacle_slice = slice(neighbors_end, obs_dim)
+
+    @property
+    def self_obs(self):
+        return self.buffer[:, self.self_slice]
+
+    @property
+    def neighbor_obs(self):
+        return self.buffer[:, self.neighbor_slice]
+
+    @property
+    def agent_obs(self):
+        """Own and neighbor blocks, i.e. all but the obstacles."""
+        return self.buffer[:, self.agent_slice]
+
+    @property
+    def obstacle_obs(self):
+        return self.buffer[:, self.obstacle_slice]
+
+    def obstacle(self, i):
+        start = self.obstacle_slice.start + i * OBSTACLE_OBS_SIZE
+        return self.buffer[:, start:start + OBSTACLE_OBS_SIZE]
+
+    def output(self):
+        """Copy of the observations, the buffer is overwritten by the next step."""
+        return self.buffer.copy()
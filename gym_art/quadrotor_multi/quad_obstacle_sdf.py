@@ -0,0 +1,115 @@
+"""
+Signed distance field of static obstacles on a regular grid over the room.
+
+The grid is built once per episode from the state arrays of MultiObstacles. The collision, proximity penalty and
+nearest-obstacle queries of the drones then cost a trilinear interpolation per drone, independently of the number of
+obstacles. The values are exact at the grid nodes, in between the interpolation error grows with the resolution.
+"""
+import numpy as np
+
+from gym_art.quadrotor_multi.quad_obstacle_utils import OBSTACLES_SHAPE_LIST
+
+CUBE = OBSTACLES_SHAPE_LIST.index('cube')
+
+
+class ObstacleSDF:
+    """
+    Grids with a node every resolution meters over room_box:
+    - sdf: signed distance to the surface of the closest collidable obstacle, band further than band meters away
+    - nearest: index of that obstacle, -1 further than band meters away
+    - proximity: sum over all obstacles of max(0, 1 - distance to the center / penalty radius), the proximity penalties
+      of calculate_obst_drone_proximity_penalties() up to the max_penalty * dt factor
+    """
+
+    def __init__(self, resolution=0.1, band=0.5, dtype=np.float32):
+        if resolution <= 0.0:
+            raise ValueError(f'SDF resolution should be positive, got {resolution}')
+        self.resolution = resolution
+        self.band = band
+        self.dtype = dtype
+        self.low = np.zeros(3)
+        self.sdf = self.nearest = self.proximity = None
+
+    def build(self, room_box, pos, size, shape_ids, collidable, penalty_radius):
+        """
+        pos (M, 3), size (M,) and shape_ids (M,) are the state arrays of MultiObstacles. Only the collidable obstacles
+        are in sdf / nearest, penalty_radius (M,) is penalty_fall_off * arm + the radius of every obstacle.
+        """
+        room_box = np.asarray(room_box, dtype=np.float64)
+        self.low = room_box[0].copy()
+        shape = np.ceil((room_box[1] - room_box[0]) / self.resolution).astype(np.int64) + 1
+        self.sdf = np.full(shape, self.band, dtype=self.dtype)
+        self.nearest = np.full(shape, -1, dtype=np.int32)
+        self.proximity = np.zeros(shape, dtype=self.dtype)
+
+        for m in range(len(pos)):
+            half_size = 0.5 * size[m]
+            if collidable[m]:
+                region, rel_pos = self._region(pos[m], half_size + self.band)
+                if shape_ids[m] == CUBE:
+                    # signed distance to an axis-aligned box
+                    q = tuple(np.abs(r) - half_size for r in rel_pos)
+                    outside = np.sqrt(sum(np.maximum(c, 0.) ** 2 for c in q))
+                    inside = np.minimum(np.maximum(np.maximum(q[0], q[1]), q[2]), 0.)
+                    dist = outside + inside
+                else:
+                    dist = np.sqrt(sum(r ** 2 for r in rel_pos)) - half_size
+                sdf, nearest = self.sdf[region], self.nearest[region]
+                closer = dist < sdf
+                sdf[closer] = dist[closer]
+                nearest[closer] = m
+
+            if penalty_radius[m] > 0.:
+                region, rel_pos = self._region(pos[m], penalty_radius[m])
+                dist = np.sqrt(sum(r ** 2 for r in rel_pos))
+                self.proximity[region] += np.maximum(1. - dist / penalty_radius[m], 0.)
+
+    def _region(self, center, radius):
+        """Slices of the nodes within the box of half side radius around center and their positions relative to it."""
+        lo = np.maximum(np.floor((center - radius - self.low) / self.resolution).astype(np.int64), 0)
+        hi = np.minimum(np.ceil((center + radius - self.low) / self.resolution).astype(np.int64) + 1, self.sdf.shape)
+        hi = np.maximum(hi, lo)
+        region = tuple(slice(l, h) for l, h in zip(lo, hi))
+        rel_pos = tuple(
+            (self.low[k] + self.resolution * np.arange(lo[k], hi[k]) - center[k]).reshape(
+                [-1 if j == k else 1 for j in range(3)])
+            for k in range(3)
+        )
+        return region, rel_pos
+
+    def _interpolate(self, grid, points):
+        # points outside of the room take the values on its boundary
+        u = np.clip((np.asarray(points, dtype=np.float64) - self.low) / self.resolution, 0., np.array(grid.shape) - 1.)
+        i0 = np.minimum(np.floor(u).astype(np.int64), np.maximum(np.array(grid.shape) - 2, 0))
+        t = u - i0
+        i1 = np.minimum(i0 + 1, np.array(grid.shape) - 1)
+        values = np.zeros(len(u))
+        for corner in range(8):
+            idx, weight = [], np.ones(len(u))
+            for k in range(3):
+                upper = (corner >> k) & 1
+                idx.append(i1[:, k] if upper else i0[:, k])
+                weight *= t[:, k] if upper else 1. - t[:, k]
+            values += weight * grid[idx[0], idx[1], idx[2]]
+        return values
+
+    def distance(self, points):
+        """Signed distance of the (N, 3) points to the closest collidable obstacle, at most band."""
+        return self._interpolate(self.sdf, points)
+
+    def proximity_penalties(self, points, max_penalty, dt):
+        """calculate_obst_drone_proximity_penalties() of the (N, 3) points."""
+        return dt * max_penalty * self._interpolate(self.proximity, points)
+
+    def nearest_obstacle(self, points):
+        """Index of the closest collidable obstacle at the grid node closest to each point, -1 if none within band."""
+        idx = np.rint((np.asarray(points, dtype=np.float64) - self.low) / self.resolution).astype(np.int64)
+        idx = np.clip(idx, 0, np.array(self.nearest.shape) - 1)
+        return self.nearest[idx[:, 0], idx[:, 1], idx[:, 2]]
+
+    def collision_detection(self, points, quad_size):
+        """(drone, obstacle) pairs of the drones closer than quad_size to an obstacle, see MultiObstacles."""
+        drones = np.flatnonzero(self.distance(points) < quad_size)
+        obstacles = self.nearest_obstacle(points[drones])
+        valid = obstacles >= 0
+        return np.stack((drones[valid], obstacles[valid].astype(np.int64)), axis=1)
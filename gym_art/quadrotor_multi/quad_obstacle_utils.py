@@ -1 +1,4 @@
 OBSTACLES_SHAPE_LIST = ['sphere', 'cube']
+
+# rel_pos, rel_vel, size and shape of an obstacle, see MultiObstacles.update_obs()
+OBSTACLE_OBS_SIZE = 10
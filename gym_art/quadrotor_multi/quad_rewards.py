@@ -0,0 +1,124 @@
+"""
+Reward components of the swarm in (N, C) float arrays with a fixed column schema.
+
+QuadrotorEnvMulti writes the components of every step into RewardComponents.step: the per-agent terms of
+compute_reward_weighted() (or the fused step), then the drone-drone / obstacle collision and proximity terms and the
+terms of the scenario. The step values are summed over the episode in RewardComponents.episode and only converted to
+dicts when they are reported, i.e. in the info dicts (quads_info_level rewards/full) and at the end of an episode.
+"""
+import numpy as np
+
+# Terms of compute_reward_weighted(), the first columns are written by the fused step in this order
+AGENT_REWARD_COMPONENTS = (
+    'rew_main', 'rew_pos', 'rew_action', 'rew_crash', 'rew_orient', 'rew_yaw', 'rew_rot', 'rew_attitude', 'rew_spin',
+    'rew_act_change', 'rew_vel',
+    'rewraw_main', 'rewraw_pos', 'rewraw_action', 'rewraw_crash', 'rewraw_orient', 'rewraw_yaw', 'rewraw_rot',
+    'rewraw_attitude', 'rewraw_spin', 'rewraw_act_change', 'rewraw_vel',
+)
+
+# Terms added by QuadrotorEnvMulti and the scenarios
+SWARM_REWARD_COMPONENTS = (
+    'rew_quadcol', 'rewraw_quadcol', 'rew_proximity',
+    'rew_quadcol_obstacle', 'rewraw_quadcol_obstacle', 'rew_obst_quad_proximity',
+    'rew_quadsettle', 'rewraw_quadsettle',
+)
+
+REWARD_COMPONENTS = AGENT_REWARD_COMPONENTS + SWARM_REWARD_COMPONENTS
+REWARD_COLUMNS = {name: col for col, name in enumerate(REWARD_COMPONENTS)}
+
+
+class RewardComponents:
+    """
+    Reward components of the current step and their sums over the episode, one row per agent.
+    Only the columns that have been written are reported, e.g. the obstacle terms only appear with obstacles.
+    """
+
+    def __init__(self, num_agents):
+        self.num_agents = num_agents
+        self.step = np.zeros((num_agents, len(REWARD_COMPONENTS)))
+        self.episode = np.zeros_like(self.step)
+
+        self.agent_columns = np.zeros(len(REWARD_COMPONENTS), dtype=bool)
+        self.agent_columns[:len(AGENT_REWARD_COMPONENTS)] = True
+        self.step_written = self.agent_columns.copy()
+        self.episode_written = np.zeros(len(REWARD_COMPONENTS), dtype=bool)
+
+    def new_step(self):
+        self.step[:] = 0.
+        self.step_written[:] = self.agent_columns
+
+    def set(self, name, values):
+        col = REWARD_COLUMNS[name]
+        self.step[:, col] = values
+        self.step_written[col] = True
+
+    def get(self, name):
+        return self.step[:, REWARD_COLUMNS[name]]
+
+    def end_step(self):
+        self.episode += self.step
+        self.episode_written |= self.step_written
+
+    def reset_episode(self):
+        self.episode[:] = 0.
+        self.episode_written[:] = False
+
+    @staticmethod
+    def _to_dicts(values, written):
+        cols = np.flatnonzero(written)
+        names = [REWARD_COMPONENTS[col] for col in cols]
+        return [dict(zip(names, row)) for row in values[:, cols].tolist()]
+
+    def step_dicts(self):
+        """The components of the current step as one {name: value} dict per agent."""
+        return self._to_dicts(self.step, self.step_written)
+
+    def episode_dicts(self):
+        """The sums over the episode as one {name: value} dict per agent."""
+        return self._to_dicts(self.episode, self.episode_written)
+
+
+def compute_rewards_batched(pos, vel, rot, omega, goals, actions, actions_prev, crashed, rew_coeff, dt,
+                            quads_settle=False, quads_settle_range_meters=1.0, quads_vel_reward_out_range=0.8):
+    """
+    compute_reward_weighted() of all agents at once, the states are (N, 3) / (N, 3, 3) arrays and the actions (N, 4).
+    Returns the (N,) rewards and the (N, len(AGENT_REWARD_COMPONENTS)) components, scaled as the reward.
+    """
+    pos, vel, rot, omega = (np.asarray(x, dtype=np.float64) for x in (pos, vel, rot, omega))
+    actions = np.asarray(actions, dtype=np.float64)
+
+    cost_pos_raw = np.linalg.norm(goals - pos, axis=1)
+    cost_effort_raw = np.linalg.norm(actions, axis=1)
+    cost_act_change_raw = np.linalg.norm(actions - actions_prev, axis=1)
+    cost_vel_raw = np.linalg.norm(vel, axis=1)
+    cost_orient_raw = -rot[:, 2, 2]
+    cost_yaw_raw = -rot[:, 0, 0]
+    rot_cos = ((rot[:, 0, 0] + rot[:, 1, 1] + rot[:, 2, 2]) - 1.) / 2.
+    cost_rotation_raw = np.arccos(np.clip(rot_cos, -1., 1.))
+    cost_attitude_raw = np.arccos(np.clip(rot[:, 2, 2], -1., 1.))
+    cost_spin_raw = np.linalg.norm(omega, axis=1)
+    cost_crash_raw = np.asarray(crashed, dtype=np.float64)
+
+    cost_pos = rew_coeff['pos'] * cost_pos_raw
+    vel_coeff = np.full(len(pos), rew_coeff['vel'], dtype=np.float64)
+    if quads_settle:
+        # sphere of equal reward if drones are close to the goal position
+        settled = cost_pos_raw <= quads_settle_range_meters
+        cost_pos[settled] = 0.
+        vel_coeff[settled] = quads_vel_reward_out_range
+
+    # columns of AGENT_REWARD_COMPONENTS, main is the position term
+    costs = np.stack([
+        cost_pos, cost_pos, rew_coeff['effort'] * cost_effort_raw, rew_coeff['crash'] * cost_crash_raw,
+        rew_coeff['orient'] * cost_orient_raw, rew_coeff['yaw'] * cost_yaw_raw, rew_coeff['rot'] * cost_rotation_raw,
+        rew_coeff['attitude'] * cost_attitude_raw, rew_coeff['spin'] * cost_spin_raw,
+        rew_coeff['action_change'] * cost_act_change_raw, vel_coeff * cost_vel_raw,
+        cost_pos_raw, cost_pos_raw, cost_effort_raw, cost_crash_raw, cost_orient_raw, cost_yaw_raw, cost_rotation_raw,
+        cost_attitude_raw, cost_spin_raw, cost_act_change_raw, cost_vel_raw,
+    ], axis=1)
+
+    rewards = -dt * costs[:, 1:11].sum(axis=1)
+    if not np.isfinite(rewards).all():
+        raise ValueError(f'QuadEnv: reward is Nan for agents {np.flatnonzero(~np.isfinite(rewards))}')
+
+    return rewards, -dt * costs
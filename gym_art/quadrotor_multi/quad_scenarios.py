@@ -3,14 +3,16 @@ import bezier
 import copy
 
 from gym_art.quadrotor_multi.quad_scenarios_utils import QUADS_PARAMS_DICT, update_formation_and_max_agent_per_layer, \
-    update_layer_dist, get_formation_range, get_goal_by_formation, get_z_value, QUADS_MODE_LIST, \
-    QUADS_MODE_LIST_OBSTACLES
-from gym_art.quadrotor_multi.quad_utils import generate_points, get_grid_dim_number
+    update_layer_dist, get_formation_range, get_z_value, QUADS_MODE_LIST, QUADS_MODE_LIST_OBSTACLES, \
+    FORMATION_TEMPLATES
 
 
-def create_scenario(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size):
+def create_scenario(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size,
+                    reward_components=None):
     cls = eval('Scenario_' + quads_mode)
     scenario = cls(quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size)
+    # quad_rewards.RewardComponents of the env, scenarios that add rewards record their components there
+    scenario.reward_components = reward_components
     return scenario
 
 
@@ -22,7 +24,11 @@ class QuadrotorScenario:
         self.room_dims = room_dims
         self.set_room_dims = room_dims_callback  # usage example: self.set_room_dims((10, 10, 10))
         self.rew_coeff = rew_coeff
+        self.reward_components = None
         self.goals = None
+        # (T, N, 3) goals of the episode by tick for the scenarios whose goals do not depend on the drones,
+        # built at reset, see step_goal_schedule()
+        self.goal_schedule = None
 
         #  Set formation, num_agents_per_layer, lowest_formation_size, highest_formation_size, formation_size,
         #  layer_dist, formation_center
@@ -60,72 +66,8 @@ class QuadrotorScenario:
         if formation_center is None:
             formation_center = np.array([0., 0., 2.])
 
-        if self.formation.startswith("circle"):
-            if num_agents <= self.num_agents_per_layer:
-                real_num_per_layer = [num_agents]
-            else:
-                whole_layer_num = num_agents // self.num_agents_per_layer
-                real_num_per_layer = [self.num_agents_per_layer for _ in range(whole_layer_num)]
-                rest_num = num_agents % self.num_agents_per_layer
-                if rest_num > 0:
-                    real_num_per_layer.append(rest_num)
-
-            pi = np.pi
-            goals = []
-            for i in range(num_agents):
-                cur_layer_num_agents = real_num_per_layer[i // self.num_agents_per_layer]
-                degree = 2 * pi * (i % cur_layer_num_agents) / cur_layer_num_agents
-                pos_0 = self.formation_size * np.cos(degree)
-                pos_1 = self.formation_size * np.sin(degree)
-                goal = get_goal_by_formation(formation=self.formation, pos_0=pos_0, pos_1=pos_1, layer_pos=(i//self.num_agents_per_layer) * layer_dist)
-                goals.append(goal)
-
-            goals = np.array(goals)
-            goals += formation_center
-        elif self.formation == "sphere":
-            goals = self.formation_size * np.array(generate_points(num_agents)) + formation_center
-        elif self.formation.startswith("grid"):
-            if num_agents <= self.num_agents_per_layer:
-                dim_1, dim_2 = get_grid_dim_number(num_agents)
-                dim_size_each_layer = [[dim_1, dim_2]]
-            else:
-                # whole layer
-                whole_layer_num = num_agents // self.num_agents_per_layer
-                max_dim_1, max_dim_2 = get_grid_dim_number(self.num_agents_per_layer)
-                dim_size_each_layer = [[max_dim_1, max_dim_2] for _ in range(whole_layer_num)]
-
-                # deal with the rest of the drones
-                rest_num = num_agents % self.num_agents_per_layer
-                if rest_num > 0:
-                    dim_1, dim_2 = get_grid_dim_number(rest_num)
-                    dim_size_each_layer.append([dim_1, dim_2])
-
-            goals = []
-            for i in range(num_agents):
-                dim_1, dim_2 = dim_size_each_layer[i//self.num_agents_per_layer]
-                pos_0 = self.formation_size * (i % dim_2)
-                pos_1 = self.formation_size * (int(i / dim_2) % dim_1)
-                goal = get_goal_by_formation(formation=self.formation, pos_0=pos_0, pos_1=pos_1, layer_pos=(i//self.num_agents_per_layer) * layer_dist)
-                goals.append(goal)
-
-            mean_pos = np.mean(goals, axis=0)
-            goals = goals - mean_pos + formation_center
-        elif self.formation.startswith("cube"):
-            dim_size = np.power(num_agents, 1.0 / 3)
-            floor_dim_size = int(dim_size)
-            goals = []
-            for i in range(num_agents):
-                pos_0 = self.formation_size * (int(i / floor_dim_size) % floor_dim_size)
-                pos_1 = self.formation_size * (i % floor_dim_size)
-                goal = np.array([formation_center[2] + self.formation_size * (i // np.square(floor_dim_size)), pos_0, pos_1])
-                goals.append(goal)
-
-            mean_pos = np.mean(goals, axis=0)
-            goals = goals - mean_pos + formation_center
-        else:
-            raise NotImplementedError("Unknown formation")
-
-        return goals
+        size_template, layer_template = FORMATION_TEMPLATES.get(self.formation, num_agents, self.num_agents_per_layer)
+        return self.formation_size * size_template + layer_dist * layer_template + formation_center
 
     def update_formation_size(self, new_formation_size):
         if new_formation_size != self.formation_size:
@@ -150,6 +92,16 @@ class QuadrotorScenario:
     def step(self, infos, rewards, pos):
         raise NotImplementedError("Implemented in a specific scenario")
 
+    def goal_schedule_len(self):
+        # step() runs after the tick of the envs is incremented, i.e. for the ticks 1, ..., ep_len + 1
+        return self.envs[0].ep_len + 2
+
+    def step_goal_schedule(self):
+        tick = min(self.envs[0].tick, len(self.goal_schedule) - 1)
+        self.goals = self.goal_schedule[tick]
+        for i, env in enumerate(self.envs):
+            env.goal = self.goals[i]
+
     def reset(self):
         # Reset formation and related parameters
         self.update_formation_and_relate_param()
@@ -201,14 +153,7 @@ class Scenario_dynamic_same_goal(QuadrotorScenario):
     def step(self, infos, rewards, pos):
         tick = self.envs[0].tick
         if tick % self.control_step_for_sec == 0 and tick > 0:
-            box_size = self.envs[0].box
-            x, y = np.random.uniform(low=-box_size, high=box_size, size=(2,))
-            z = np.random.uniform(low=-0.5 * box_size, high=0.5 * box_size) + 2.0
-            z = max(0.25, z)
-            self.formation_center = np.array([x, y, z])
-            self.goals = self.generate_goals(num_agents=self.num_agents, formation_center=self.formation_center, layer_dist=0.0)
-            for i, env in enumerate(self.envs):
-                env.goal = self.goals[i]
+            self.step_goal_schedule()
 
         return infos, rewards
 
@@ -220,6 +165,19 @@ class Scenario_dynamic_same_goal(QuadrotorScenario):
         # Reset formation, and parameters related to the formation; formation center; goals
         self.standard_reset()
 
+        # teleport the formation to a random center every control_step_for_sec ticks
+        num_ticks = self.goal_schedule_len()
+        box_size = self.envs[0].box
+        segments = [self.goals]
+        for _ in range(self.control_step_for_sec, num_ticks, self.control_step_for_sec):
+            x, y = np.random.uniform(low=-box_size, high=box_size, size=(2,))
+            z = np.random.uniform(low=-0.5 * box_size, high=0.5 * box_size) + 2.0
+            z = max(0.25, z)
+            formation_center = np.array([x, y, z])
+            segments.append(self.generate_goals(num_agents=self.num_agents, formation_center=formation_center, layer_dist=0.0))
+        self.goal_schedule = np.array(segments)[np.arange(num_ticks) // self.control_step_for_sec]
+        self.goals = self.goal_schedule[0]
+
 
 class Scenario_dynamic_diff_goal(QuadrotorScenario):
     def __init__(self, quads_mode, envs, num_agents, room_dims, room_dims_callback, rew_coeff, quads_formation, quads_formation_size):
@@ -274,16 +232,7 @@ class Scenario_ep_lissajous3D(QuadrotorScenario):
         return x, y, z
 
     def step(self, infos, rewards, pos):
-        control_freq = self.envs[0].control_freq
-        tick = self.envs[0].tick / control_freq
-        x, y, z = self.lissajous3D(tick)
-        goal_x, goal_y, goal_z = self.goals[0]
-        x_new, y_new, z_new = x + goal_x, y + goal_y, z + goal_z
-        self.goals = np.array([[x_new, y_new, z_new] for _ in range(self.num_agents)])
-
-        for i, env in enumerate(self.envs):
-            env.goal = self.goals[i]
-
+        self.step_goal_schedule()
         return infos, rewards
 
     def update_formation_size(self, new_formation_size):
@@ -297,21 +246,37 @@ class Scenario_ep_lissajous3D(QuadrotorScenario):
         self.formation_center = np.array([-2.0, 0.0, 2.0])  # prevent drones from crashing into the wall
         self.goals = self.generate_goals(num_agents=self.num_agents, formation_center=self.formation_center, layer_dist=0.0)
 
+        # the goal of all drones moves by lissajous3D(tick) from the goal of the first drone at every tick
+        num_ticks = self.goal_schedule_len()
+        offsets = np.stack(self.lissajous3D(np.arange(1, num_ticks) / self.envs[0].control_freq), axis=1)
+        path = np.cumsum(np.concatenate((self.goals[:1], offsets)), axis=0)
+        self.goal_schedule = np.repeat(path[:, None], self.num_agents, axis=1)
+        self.goal_schedule[0] = self.goals
+
 
 class Scenario_ep_rand_bezier(QuadrotorScenario):
     def step(self, infos, rewards, pos):
-        # randomly sample new goal pos in free space and have the goal move there following a bezier curve
-        tick = self.envs[0].tick
+        self.step_goal_schedule()
+        return infos, rewards
+
+    def reset(self):
+        super().reset()
+
+        # randomly sample new goal pos in free space and have the goal move there following a bezier curve,
+        # a new curve starts from the end of the previous one every control_steps ticks
         control_freq = self.envs[0].control_freq
         num_secs = 5
         control_steps = int(num_secs * control_freq)
-        t = tick % control_steps
+        num_ticks = self.goal_schedule_len()
         room_dims = np.array(self.room_dims) - self.formation_size
         # min and max distance the goal can spawn away from its current location. 30 = empirical upper bound on
         # velocity that the drones can handle.
         max_dist = min(30, max(room_dims))
         min_dist = max_dist / 2
-        if tick % control_steps == 0 or tick == 1:
+        pts = np.linspace(0, 1, control_steps)
+        start = self.goals[0]
+        path = []
+        for _ in range(0, num_ticks, control_steps):
             # sample a new goal pos that's within the room boundaries and satisfies the distance constraint
             new_goal_found = False
             while not new_goal_found:
@@ -321,24 +286,22 @@ class Scenario_ep_rand_bezier(QuadrotorScenario):
                 new_pos = np.random.uniform(low=-high, high=high, size=(2, 3)).reshape(3, 2)
                 # add some velocity randomization = random magnitude * unit direction
                 new_pos = new_pos * np.random.randint(min_dist, max_dist + 1) / np.linalg.norm(new_pos, axis=0)
-                new_pos = self.goals[0].reshape(3, 1) + new_pos
+                new_pos = start.reshape(3, 1) + new_pos
                 lower_bound = np.expand_dims(low, axis=1)
                 upper_bound = np.expand_dims(high, axis=1)
                 new_goal_found = (new_pos > lower_bound + 0.5).all() and (
                         new_pos < upper_bound - 0.5).all()  # check bounds that are slightly smaller than the room dims
-            nodes = np.concatenate((self.goals[0].reshape(3, 1), new_pos), axis=1)
+            nodes = np.concatenate((start.reshape(3, 1), new_pos), axis=1)
             nodes = np.asfortranarray(nodes)
-            pts = np.linspace(0, 1, control_steps)
             curve = bezier.Curve(nodes, degree=2)
             self.interp = curve.evaluate_multi(pts)
-            # self.interp = np.clip(self.interp, a_min=np.array([0,0,0.2]).reshape(3,1), a_max=high.reshape(3,1)) # want goal clipping to be slightly above the floor
-        if tick % control_steps != 0 and tick > 1:
-            self.goals = np.array([self.interp[:, t] for _ in range(self.num_agents)])
-
-            for i, env in enumerate(self.envs):
-                env.goal = self.goals[i]
+            path.append(self.interp.T)
+            start = self.interp[:, -1]
 
-        return infos, rewards
+        path = np.concatenate(path)[:num_ticks]
+        self.goal_schedule = np.repeat(path[:, None], self.num_agents, axis=1)
+        # the goals stay at the ones of the reset until the first curve starts at the tick 2
+        self.goal_schedule[:2] = self.goals
 
     def update_formation_size(self, new_formation_size):
         pass
@@ -380,13 +343,12 @@ class Scenario_circular_config(QuadrotorScenario):
             env.goal = goal
 
     def step(self, infos, rewards, pos):
-        for i, e in enumerate(self.envs):
-            dist = np.linalg.norm(pos[i] - e.goal)
-            if abs(dist) < self.metric_of_settle:
-                self.settle_count[i] += 1
-            else:
-                self.settle_count = np.zeros(self.num_agents)
-                break
+        # the goals of the envs are the rows of self.goals
+        dist = np.linalg.norm(pos - self.goals, axis=1)
+        if (dist < self.metric_of_settle).all():
+            self.settle_count += 1
+        else:
+            self.settle_count = np.zeros(self.num_agents)
 
         # drones settled at the goal for 1 sec
         control_step_for_one_sec = int(self.envs[0].control_freq)
@@ -399,8 +361,9 @@ class Scenario_circular_config(QuadrotorScenario):
                 env.goal = self.goals[i]
                 # Add settle rewards
                 rewards[i] += rews_settle
-                infos[i]["rewards"]["rew_quadsettle"] = rews_settle
-                infos[i]["rewards"]["rewraw_quadsettle"] = rews_settle_raw
+            if self.reward_components is not None:
+                self.reward_components.set('rew_quadsettle', rews_settle)
+                self.reward_components.set('rewraw_quadsettle', rews_settle_raw)
 
             self.settle_count = np.zeros(self.num_agents)
 
@@ -652,7 +615,8 @@ class Scenario_mix(QuadrotorScenario):
         self.scenario = create_scenario(quads_mode=mode, envs=self.envs, num_agents=self.num_agents,
                                         room_dims=self.room_dims, room_dims_callback=self.room_dims_callback,
                                         rew_coeff=self.rew_coeff, quads_formation=self.formation,
-                                        quads_formation_size=self.formation_size)
+                                        quads_formation_size=self.formation_size,
+                                        reward_components=self.reward_components)
 
         self.scenario.reset()
         self.goals = self.scenario.goals
@@ -1,5 +1,8 @@
+from collections import OrderedDict
+
 import numpy as np
-from gym_art.quadrotor_multi.quad_utils import get_circle_radius, get_sphere_radius, get_grid_dim_number
+from gym_art.quadrotor_multi.quad_utils import get_circle_radius, get_sphere_radius, get_grid_dim_number, \
+    generate_points
 
 QUADS_MODE_LIST = ['static_same_goal', 'static_diff_goal', 'dynamic_same_goal', 'dynamic_diff_goal', 'circular_config',
                    'ep_lissajous3D', 'ep_rand_bezier', 'swarm_vs_swarm', 'dynamic_formations', 'swap_goals']
@@ -91,6 +94,102 @@ def get_goal_by_formation(formation, pos_0, pos_1, layer_pos=0.):
     return goal
 
 
+def get_formation_axes(formation):
+    """Columns of pos_0, pos_1 and layer_pos in the goals, see get_goal_by_formation()."""
+    if formation.endswith("horizontal"):
+        return 0, 1, 2
+    elif formation.endswith("vertical_xz"):
+        return 0, 2, 1
+    elif formation.endswith("vertical_yz"):
+        return 1, 2, 0
+    else:
+        raise NotImplementedError("Unknown formation")
+
+
+def formation_templates(formation, num_agents, num_agents_per_layer):
+    """
+    The goals of QuadrotorScenario.generate_goals() are linear in the formation size and the layer distance:
+    goals = formation_size * size_template + layer_dist * layer_template + formation_center, with (N, 3) templates.
+    """
+    idx = np.arange(num_agents)
+    # the layers are filled with num_agents_per_layer agents, the last one with the rest
+    layer = idx // num_agents_per_layer
+    agents_in_layer = np.minimum(num_agents_per_layer, num_agents - layer * num_agents_per_layer)
+    size_template = np.zeros((num_agents, 3))
+    layer_template = np.zeros((num_agents, 3))
+
+    if formation.startswith("circle"):
+        col_0, col_1, col_layer = get_formation_axes(formation)
+        degree = 2 * np.pi * (idx % agents_in_layer) / agents_in_layer
+        size_template[:, col_0] = np.cos(degree)
+        size_template[:, col_1] = np.sin(degree)
+        layer_template[:, col_layer] = layer
+    elif formation == "sphere":
+        size_template = np.array(generate_points(num_agents))
+        layer_template = np.zeros_like(size_template)
+    elif formation.startswith("grid"):
+        col_0, col_1, col_layer = get_formation_axes(formation)
+        dims = np.array([get_grid_dim_number(n) for n in agents_in_layer[::num_agents_per_layer]])
+        dim_1, dim_2 = dims[layer, 0], dims[layer, 1]
+        size_template[:, col_0] = idx % dim_2
+        size_template[:, col_1] = (idx // dim_2) % dim_1
+        layer_template[:, col_layer] = layer
+    elif formation.startswith("cube"):
+        floor_dim_size = int(np.power(num_agents, 1.0 / 3))
+        size_template = np.stack((idx // np.square(floor_dim_size), (idx // floor_dim_size) % floor_dim_size,
+                                  idx % floor_dim_size), axis=1).astype(np.float64)
+    else:
+        raise NotImplementedError("Unknown formation")
+
+    if formation.startswith("grid") or formation.startswith("cube"):
+        # these formations are centered around the formation center
+        size_template -= np.mean(size_template, axis=0)
+        layer_template -= np.mean(layer_template, axis=0)
+
+    return size_template, layer_template
+
+
+class FormationTemplateCache:
+    """
+    LRU cache of formation_templates(), shared by the scenarios: the templates only depend on the formation, the
+    number of agents and the number of agents per layer, while the goals are generated on every reset and every change
+    of the formation size.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.templates = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, formation, num_agents, num_agents_per_layer):
+        key = (formation, num_agents, num_agents_per_layer)
+        templates = self.templates.get(key)
+        if templates is not None:
+            self.hits += 1
+            self.templates.move_to_end(key)
+            return templates
+
+        self.misses += 1
+        templates = formation_templates(formation, num_agents, num_agents_per_layer)
+        for template in templates:
+            template.flags.writeable = False
+        self.templates[key] = templates
+        if len(self.templates) > self.maxsize:
+            self.templates.popitem(last=False)
+        return templates
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def clear(self):
+        self.templates.clear()
+        self.hits = self.misses = 0
+
+
+FORMATION_TEMPLATES = FormationTemplateCache()
+
+
 def get_z_value(num_agents, num_agents_per_layer, box_size, formation, formation_size):
     z = np.random.uniform(low=-0.5 * box_size, high=0.5 * box_size) + 2.0
     z_lower_bound = 0.25
@@ -4,7 +4,6 @@ from numba import njit
 from numpy.linalg import norm
 from copy import deepcopy
 from numpy import cos, sin
-from scipy import spatial
 from copy import deepcopy
 
 # dict pretty printing
@@ -91,7 +90,7 @@ def quat2R(qw, qx, qy, qz):
     return np.array(R)
 
 
-quat2R_numba = njit()(quat2R)
+quat2R_numba = njit(cache=True)(quat2R)
 
 
 def qwxyz2R(quat):
@@ -107,7 +106,7 @@ def quatXquat(quat, quat_theta):
     return noisy_quat
 
 
-quatXquat_numba = njit()(quatXquat)
+quatXquat_numba = njit(cache=True)(quatXquat)
 
 
 def R2quat(rot):
@@ -243,21 +242,165 @@ def get_grid_dim_number(num):
     return dim_1, dim_2
 
 
-def calculate_collision_matrix(positions, arm, hitbox_radius):
-    dist = spatial.distance_matrix(x=positions, y=positions)
-    collision_matrix = (dist < hitbox_radius * arm).astype(np.float32)
-    np.fill_diagonal(collision_matrix, 0.0)
+@njit(cache=True)
+def pairwise_collisions_numba(positions, collision_dist):
+    num_agents = positions.shape[0]
+    dist = np.zeros((num_agents, num_agents), dtype=positions.dtype)
+    collision_matrix = np.zeros((num_agents, num_agents), dtype=np.float32)
+    collisions = np.empty((num_agents * (num_agents - 1) // 2, 2), dtype=np.int64)
+    num_collisions = 0
+    for i in range(num_agents):
+        for j in range(i + 1, num_agents):
+            d = ((positions[i, 0] - positions[j, 0]) ** 2 + (positions[i, 1] - positions[j, 1]) ** 2 +
+                 (positions[i, 2] - positions[j, 2]) ** 2) ** 0.5
+            dist[i, j] = dist[j, i] = d
+            if d < collision_dist:
+                collision_matrix[i, j] = collision_matrix[j, i] = 1.0
+                collisions[num_collisions, 0] = i
+                collisions[num_collisions, 1] = j
+                num_collisions += 1
+
+    return collision_matrix, collisions[:num_collisions], dist
 
-    # get upper triangular matrix and check if they have collisions and append to all collisions
-    upt = np.triu(collision_matrix)
-    up_w1 = np.where(upt >= 1)
-    all_collisions = []
-    for i, val in enumerate(up_w1[0]):
-        all_collisions.append((up_w1[0][i], up_w1[1][i]))
 
+def calculate_collision_matrix(positions, arm, hitbox_radius):
+    # single pass over the upper triangle, all_collisions is a (num_collisions, 2) array of (i, j) pairs with i < j
+    # the distances have the precision of the positions
+    collision_matrix, all_collisions, dist = pairwise_collisions_numba(np.asarray(positions), hitbox_radius * arm)
     return collision_matrix, all_collisions, dist
 
 
+@njit(cache=True)
+def _cell_hash(key, shift):
+    # Fibonacci hashing, the top bits of the product are well mixed
+    return np.int64((np.uint64(key) * np.uint64(11400714819323198485)) >> shift)
+
+
+@njit(cache=True)
+def _append_close_pair(i, j, positions, cutoff, pairs_i, pairs_j, pairs_dist, num_pairs):
+    d = ((positions[i, 0] - positions[j, 0]) ** 2 + (positions[i, 1] - positions[j, 1]) ** 2 +
+         (positions[i, 2] - positions[j, 2]) ** 2) ** 0.5
+    if d >= cutoff:
+        return pairs_i, pairs_j, pairs_dist, num_pairs
+    if num_pairs == len(pairs_i):
+        pairs_i = np.concatenate((pairs_i, np.empty_like(pairs_i)))
+        pairs_j = np.concatenate((pairs_j, np.empty_like(pairs_j)))
+        pairs_dist = np.concatenate((pairs_dist, np.empty_like(pairs_dist)))
+    pairs_i[num_pairs] = min(i, j)
+    pairs_j[num_pairs] = max(i, j)
+    pairs_dist[num_pairs] = d
+    return pairs_i, pairs_j, pairs_dist, num_pairs + 1
+
+
+@njit(cache=True)
+def grid_pairs_numba(positions, cutoff):
+    """
+    Uniform grid (cell list) broad phase: the pairs (i, j), i < j, of drones closer than cutoff and their distances.
+    With cells of size cutoff, the drones of a cell are only checked against the drones of the same cell and of the
+    13 neighboring cells that follow it, every pair of neighboring cells is visited once.
+    """
+    num_agents = positions.shape[0]
+    cells = np.empty((num_agents, 3), dtype=np.int64)
+    for k in range(3):
+        low = positions[:, k].min()
+        for i in range(num_agents):
+            cells[i, k] = int(np.floor((positions[i, k] - low) / cutoff))
+    dims = np.empty(3, dtype=np.int64)
+    for k in range(3):
+        dims[k] = cells[:, k].max() + 1
+
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+
+    # runs of the drones of the occupied cells in order
+    cell_start = np.empty(num_agents + 1, dtype=np.int64)
+    num_cells = 0
+    for m in range(num_agents):
+        if m == 0 or sorted_keys[m] != sorted_keys[m - 1]:
+            cell_start[num_cells] = m
+            num_cells += 1
+    cell_start[num_cells] = num_agents
+
+    # open addressing hash table of the occupied cells: key -> index of the cell
+    table_bits = 1
+    while (1 << table_bits) < 2 * num_cells:
+        table_bits += 1
+    mask = (1 << table_bits) - 1
+    hash_shift = np.uint64(64 - table_bits)
+    table_keys = np.full(mask + 1, -1, dtype=np.int64)
+    table_cells = np.empty(mask + 1, dtype=np.int64)
+    for c in range(num_cells):
+        key = sorted_keys[cell_start[c]]
+        h = _cell_hash(key, hash_shift)
+        while table_keys[h] != -1:
+            h = (h + 1) & mask
+        table_keys[h] = key
+        table_cells[h] = c
+
+    pairs_i = np.empty(4 * num_agents + 16, dtype=np.int64)
+    pairs_j = np.empty_like(pairs_i)
+    pairs_dist = np.empty(len(pairs_i), dtype=positions.dtype)
+    num_pairs = 0
+    for c in range(num_cells):
+        start, end = cell_start[c], cell_start[c + 1]
+        for a in range(start, end):
+            for b in range(a + 1, end):
+                pairs_i, pairs_j, pairs_dist, num_pairs = _append_close_pair(
+                    order[a], order[b], positions, cutoff, pairs_i, pairs_j, pairs_dist, num_pairs)
+
+        cell = cells[order[start]]
+        for dx in range(0, 2):
+            for dy in range(-1, 2):
+                for dz in range(-1, 2):
+                    # half of the neighborhood: offsets lexicographically after (0, 0, 0)
+                    if dx == 0 and (dy < 0 or (dy == 0 and dz <= 0)):
+                        continue
+                    cx, cy, cz = cell[0] + dx, cell[1] + dy, cell[2] + dz
+                    if cx >= dims[0] or cy < 0 or cy >= dims[1] or cz < 0 or cz >= dims[2]:
+                        continue
+                    key = (cx * dims[1] + cy) * dims[2] + cz
+                    h = _cell_hash(key, hash_shift)
+                    while table_keys[h] != -1 and table_keys[h] != key:
+                        h = (h + 1) & mask
+                    if table_keys[h] == -1:
+                        continue
+                    other = table_cells[h]
+                    for a in range(start, end):
+                        for b in range(cell_start[other], cell_start[other + 1]):
+                            pairs_i, pairs_j, pairs_dist, num_pairs = _append_close_pair(
+                                order[a], order[b], positions, cutoff, pairs_i, pairs_j, pairs_dist, num_pairs)
+
+    return pairs_i[:num_pairs], pairs_j[:num_pairs], pairs_dist[:num_pairs]
+
+
+def calculate_collision_pairs(positions, arm, hitbox_radius, falloff_radius):
+    """
+    Sparse version of calculate_collision_matrix(): the (i, j, dist) arrays of the pairs of drones within the hitbox
+    or the proximity penalty fall-off radius, sorted by (i, j), and the (num_collisions, 2) array of colliding pairs.
+    """
+    cutoff = max(hitbox_radius, falloff_radius) * arm
+    pairs_i, pairs_j, pairs_dist = grid_pairs_numba(np.asarray(positions), cutoff)
+    order = np.lexsort((pairs_j, pairs_i))
+    pairs_i, pairs_j, pairs_dist = pairs_i[order], pairs_j[order], pairs_dist[order]
+    colliding = pairs_dist < hitbox_radius * arm
+    all_collisions = np.stack((pairs_i[colliding], pairs_j[colliding]), axis=1)
+    return (pairs_i, pairs_j, pairs_dist), all_collisions
+
+
+def calculate_drone_proximity_penalties_sparse(pairs, arm, dt, penalty_fall_off, max_penalty, num_agents):
+    """calculate_drone_proximity_penalties() for the (i, j, dist) pairs of calculate_collision_pairs()."""
+    if not penalty_fall_off:
+        # smooth penalties is disabled, so noop
+        return np.zeros(num_agents)
+    pairs_i, pairs_j, pairs_dist = pairs
+    pair_penalties = np.maximum((-max_penalty / (penalty_fall_off * arm)) * pairs_dist + max_penalty, 0.0)
+    penalties = np.bincount(pairs_i, weights=pair_penalties, minlength=num_agents) + \
+        np.bincount(pairs_j, weights=pair_penalties, minlength=num_agents)
+
+    return dt * penalties  # actual penalties per tick to be added to the overall reward
+
+
 def calculate_drone_proximity_penalties(distance_matrix, arm, dt, penalty_fall_off, max_penalty, num_agents):
     if not penalty_fall_off:
         # smooth penalties is disabled, so noop
@@ -281,6 +424,30 @@ def calculate_obst_drone_proximity_penalties(distance_matrix, arm, dt, penalty_f
     return dt * penalties  # actual penalties per tick to be added to the overall reward
 
 
+class ContactEvents:
+    """
+    Contact state of pairs, i.e. drone-drone (i < j) or drone-obstacle, in a persistent (rows, cols) boolean matrix.
+    New contacts are curr & ~prev, only the entries of the current and of the previous contacts are touched.
+    """
+
+    def __init__(self, num_rows, num_cols):
+        self.contacts = np.zeros((num_rows, num_cols), dtype=bool)
+        self.rows = np.empty(0, dtype=np.int64)
+        self.cols = np.empty(0, dtype=np.int64)
+
+    def reset(self):
+        self.contacts[self.rows, self.cols] = False
+        self.rows = self.cols = np.empty(0, dtype=np.int64)
+
+    def update(self, rows, cols):
+        """Replaces the contacts by the (rows[k], cols[k]) pairs of this step, returns the mask of the new ones."""
+        new = ~self.contacts[rows, cols]
+        self.contacts[self.rows, self.cols] = False
+        self.contacts[rows, cols] = True
+        self.rows, self.cols = rows, cols
+        return new
+
+
 def compute_col_norm_and_new_velocities(dyn1, dyn2):
     # Ge the collision normal, i.e difference in position
     collision_norm = dyn1.pos - dyn2.pos
@@ -383,19 +550,106 @@ def perform_collision_with_obstacle_v2(drone_dyn, obstacle_dyn, quad_arm=0.046):
     drone_dyn.omega += new_omega
 
 
+def sample_collision_omega_kicks(num_events, resample_zero=True):
+    """
+    Random angular velocity kicks of num_events collisions, as in perform_collision_between_drones() (resample_zero)
+    and perform_collision_with_obstacle(): random directions with magnitudes in [omega_max / 2, omega_max].
+    """
+    omega_max = 20 * np.pi  # this will amount to max 3.5 revolutions per second
+    eps = 1e-5
+    new_omega = np.random.uniform(low=-1, high=1, size=(num_events, 3))  # random directions in 3D space
+    if resample_zero:
+        zero = np.all(np.abs(new_omega) < eps, axis=1)
+        while zero.any():
+            # just to make sure we don't get a 0-vector
+            new_omega[zero] = np.random.uniform(low=-1, high=1, size=(np.count_nonzero(zero), 3))
+            zero = np.all(np.abs(new_omega) < eps, axis=1)
+    else:
+        new_omega += eps
+
+    new_omega /= np.linalg.norm(new_omega, axis=1, keepdims=True) + eps  # normalize
+    new_omega *= np.random.uniform(low=omega_max / 2, high=omega_max, size=(num_events, 1))
+    return new_omega
+
+
+@njit(cache=True)
+def _collision_normal(pos1, pos2):
+    collision_norm = pos1 - pos2
+    coll_norm_mag = np.sqrt(np.sum(collision_norm ** 2))
+    return collision_norm / (coll_norm_mag + 0.00001 if coll_norm_mag == 0.0 else coll_norm_mag)
+
+
+@njit(cache=True)
+def collisions_between_drones_numba(pos, vel, omega, pairs, vel_kicks_i, vel_kicks_j, omega_kicks):
+    # pairs are handled in order, a drone in several pairs sees the velocities left by the previous ones
+    for k in range(pairs.shape[0]):
+        i, j = pairs[k, 0], pairs[k, 1]
+        collision_norm = _collision_normal(pos[i].astype(np.float64), pos[j].astype(np.float64))
+        v1new = np.sum(vel[i] * collision_norm)
+        v2new = np.sum(vel[j] * collision_norm)
+        for c in range(3):
+            vel[i, c] += (v2new - v1new) * collision_norm[c] + vel_kicks_i[k, c]
+            vel[j, c] += (v1new - v2new) * collision_norm[c] + vel_kicks_j[k, c]
+            omega[i, c] += omega_kicks[k, c]
+            omega[j, c] -= omega_kicks[k, c]
+
+
+@njit(cache=True)
+def collisions_with_obstacles_numba(pos, vel, omega, obstacles_pos, obstacles_vel, pairs, vel_kicks, omega_kicks):
+    for k in range(pairs.shape[0]):
+        i, o = pairs[k, 0], pairs[k, 1]
+        collision_norm = _collision_normal(obstacles_pos[o], pos[i].astype(np.float64))
+        v1new = np.sum(obstacles_vel[o] * collision_norm)
+        v2new = np.sum(vel[i] * collision_norm)
+        for c in range(3):
+            vel[i, c] += (v1new - v2new) * collision_norm[c] + vel_kicks[k, c]
+            omega[i, c] += omega_kicks[k, c]
+
+
+def perform_collisions_between_drones(pos, vel, omega, pairs):
+    """
+    perform_collision_between_drones() for all the (i, j) pairs at once, on the (N, 3) state arrays of the swarm.
+    The random velocity and omega components of all pairs are drawn in one go, with the same distributions.
+    """
+    num_events = len(pairs)
+    if num_events == 0:
+        return
+    # One random component that preserves momentum in opposite directions, one that does not
+    cons_rand_val = np.random.normal(0, 0.8, size=(num_events, 3))
+    vel_kicks_i = cons_rand_val + np.random.normal(0, 0.15, size=(num_events, 3))
+    vel_kicks_j = -cons_rand_val + np.random.normal(0, 0.15, size=(num_events, 3))
+    omega_kicks = sample_collision_omega_kicks(num_events)
+    collisions_between_drones_numba(pos, vel, omega, np.asarray(pairs, dtype=np.int64), vel_kicks_i, vel_kicks_j,
+                                    omega_kicks)
+
+
+def perform_collisions_with_obstacles(pos, vel, omega, obstacles_pos, obstacles_vel, pairs):
+    """perform_collision_with_obstacle() for all the (drone, obstacle) pairs at once, see above."""
+    num_events = len(pairs)
+    if num_events == 0:
+        return
+    vel_kicks = np.random.normal(0, 0.8, size=(num_events, 3)) + np.random.normal(0, 0.15, size=(num_events, 3))
+    omega_kicks = sample_collision_omega_kicks(num_events, resample_zero=False)
+    collisions_with_obstacles_numba(pos, vel, omega, np.asarray(obstacles_pos, dtype=np.float64),
+                                    np.asarray(obstacles_vel, dtype=np.float64), np.asarray(pairs, dtype=np.int64),
+                                    vel_kicks, omega_kicks)
+
+
 class OUNoise:
     """Ornstein–Uhlenbeck process"""
-    def __init__(self, action_dimension, mu=0, theta=0.15, sigma=0.3, use_seed=False):
+    def __init__(self, action_dimension, mu=0, theta=0.15, sigma=0.3, use_seed=False, noise_pool=None):
         """
         @param: mu: mean of noise
         @param: theta: stabilization coeff (i.e. noise return to mean)
         @param: sigma: noise scale coeff
         @param: use_seed: set the random number generator to some specific seed for test
+        @param: noise_pool: NoisePool the samples are taken from, None to use numpy.random
         """
         self.action_dimension = action_dimension
         self.mu = mu
         self.theta = theta
         self.sigma = sigma
+        self.noise_pool = noise_pool
         self.state = np.ones(self.action_dimension) * self.mu
         self.reset()
         if use_seed:
@@ -406,7 +660,8 @@ class OUNoise:
 
     def noise(self):
         x = self.state
-        dx = self.theta * (self.mu - x) + self.sigma * nr.randn(len(x))
+        normals = nr.randn(len(x)) if self.noise_pool is None else self.noise_pool.normal(len(x))
+        dx = self.theta * (self.mu - x) + self.sigma * normals
         self.state = x + dx
         return self.state
 
@@ -285,7 +285,6 @@ class VelocityYawControl(object):
 class NonlinearPositionController(object):
     #@profile
     def __init__(self, dynamics, tf_control=True):
-        import tensorflow as tf
         jacobian = quadrotor_jacobian(dynamics)
         self.Jinv = np.linalg.inv(jacobian)
         ## Jacobian inverse for our quadrotor
@@ -302,6 +301,7 @@ class NonlinearPositionController(object):
 
         self.tf_control = tf_control
         if tf_control:
+            import tensorflow as tf
             self.step_func = self.step_tf
             self.sess = tf.Session()
             self.thrusts_tf = self.step_graph_construct(Jinv_=self.Jinv, observation_provided=True)
@@ -7,16 +7,28 @@ import gym
 
 from copy import deepcopy
 
-from gym_art.quadrotor_multi.quad_utils import perform_collision_between_drones, perform_collision_with_obstacle, \
-    calculate_collision_matrix, calculate_drone_proximity_penalties, calculate_obst_drone_proximity_penalties
+from gym_art.quadrotor_multi.quad_utils import perform_collisions_between_drones, perform_collisions_with_obstacles, \
+    calculate_collision_matrix, calculate_drone_proximity_penalties, calculate_obst_drone_proximity_penalties, \
+    calculate_collision_pairs, calculate_drone_proximity_penalties_sparse, ContactEvents
 
 from gym_art.quadrotor_multi.quadrotor_multi_obstacles import MultiObstacles
+from gym_art.quadrotor_multi.quad_obstacle_sdf import ObstacleSDF
 from gym_art.quadrotor_multi.quadrotor_single import GRAV, QuadrotorSingle
+from gym_art.quadrotor_multi.quadrotor_swarm_dynamics import SwarmDynamics
+from gym_art.quadrotor_multi.noise_pool import NoisePool
+from gym_art.quadrotor_multi.sensor_noise import SwarmSensorNoise
+from gym_art.quadrotor_multi import get_state
 from gym_art.quadrotor_multi.quadrotor_multi_visualization import Quadrotor3DSceneMulti
 from gym_art.quadrotor_multi.quad_scenarios import create_scenario
 from gym_art.quadrotor_multi.quad_obstacle_utils import OBSTACLES_SHAPE_LIST
+from gym_art.quadrotor_multi.quad_fused_step import SwarmFusedStep
+from gym_art.quadrotor_multi.quad_neighbors import NeighborSelector
+from gym_art.quadrotor_multi.quad_observations import ObservationBuffer
+from gym_art.quadrotor_multi.quad_rewards import RewardComponents, compute_rewards_batched
 
 EPS = 1E-6
+# the obstacles move by 1 / OBSTACLE_SIM_FREQ seconds per control step, independently of the integrator and sim_steps
+OBSTACLE_SIM_FREQ = 200.
 
 
 class QuadrotorEnvMulti(gym.Env):
@@ -36,7 +48,10 @@ class QuadrotorEnvMulti(gym.Env):
                  collision_falloff_radius=2.0, collision_smooth_max_penalty=10.0,
                  local_metric='dist', local_coeff=0.0, use_replay_buffer=False,
                  obstacle_obs_mode='relative', obst_penalty_fall_off=10.0, vis_acc_arrows=False,
-                 viz_traces=25, viz_trace_nth_step=1):
+                 viz_traces=25, viz_trace_nth_step=1, swarm_dynamics=None, quads_num_threads=None,
+                 quads_integrator='euler', quads_attitude='rot', quads_precision='float64',
+                 quads_noise_pool=False, quads_info_level='none', quads_neighbor_search='full',
+                 quads_collision_broad_phase='dense', quads_obstacle_sdf=False, quads_obstacle_sdf_resolution=0.1):
 
         super().__init__()
 
@@ -53,12 +68,23 @@ class QuadrotorEnvMulti(gym.Env):
         # Set to True means that sample_factory will treat it as a multi-agent vectorized environment even with
         # num_agents=1. More info, please look at sample-factory: envs/quadrotors/wrappers/reward_shaping.py
         self.is_multiagent = True
+        # the sums of the reward components are reported in info['episode_rewards'] when the episode ends
+        self.reports_episode_rewards = True
         self.room_dims = (room_length, room_width, room_height)
 
         self.envs = []
         self.adaptive_env = adaptive_env
         self.quads_view_mode = quads_view_mode
 
+        # State of all quadrotors in struct-of-arrays layout, every env's dynamics is a view onto one row.
+        # QuadrotorVecEnvMulti passes a sub-swarm of its own engine here
+        if swarm_dynamics is None:
+            swarm_dynamics = SwarmDynamics(num_agents=self.num_agents, use_numba=quads_use_numba,
+                                           num_threads=quads_num_threads, integrator=quads_integrator,
+                                           attitude=quads_attitude, precision=quads_precision,
+                                           noise_pool=NoisePool() if quads_noise_pool else None)
+        self.swarm_dynamics = swarm_dynamics
+
         for i in range(self.num_agents):
             e = QuadrotorSingle(
                 dynamics_params, dynamics_change, dynamics_randomize_every, dyn_sampler_1, dyn_sampler_2,
@@ -67,10 +93,15 @@ class QuadrotorEnvMulti(gym.Env):
                 rew_coeff, sense_noise, verbose, gravity, t2w_std, t2t_std, excite, dynamics_simplification,
                 quads_use_numba, self.swarm_obs, self.num_agents, quads_settle, quads_settle_range_meters,
                 quads_vel_reward_out_range, quads_view_mode, quads_obstacle_mode, quads_obstacle_num,
-                self.num_use_neighbor_obs
+                self.num_use_neighbor_obs, swarm=self.swarm_dynamics, swarm_idx=i, info_level=quads_info_level
             )
             self.envs.append(e)
 
+        # Observations of all agents in a single call (for the supported obs_repr), see get_state.swarm_state_*()
+        self.swarm_state_vector = getattr(get_state, 'swarm_state_' + obs_repr, None)
+        self.swarm_sense_noise = SwarmSensorNoise(self.num_agents, self.envs[0].sense_noise,
+                                                  noise_pool=self.swarm_dynamics.noise_pool)
+
         self.resample_goals = resample_goals
 
         # we don't actually create a scene object unless we want to render stuff
@@ -102,7 +133,7 @@ class QuadrotorEnvMulti(gym.Env):
         self.quad_arm = self.envs[0].dynamics.arm
         self.control_freq = self.envs[0].control_freq
         self.control_dt = 1.0 / self.control_freq
-        self.pos = np.zeros([self.num_agents, 3])  # Matrix containing all positions
+        self.pos = np.zeros([self.num_agents, 3], dtype=self.swarm_dynamics.dtype)  # Matrix containing all positions
         self.quads_mode = quads_mode
         if obs_repr == 'xyz_vxyz_R_omega':
             obs_self_size = 18
@@ -121,6 +152,14 @@ class QuadrotorEnvMulti(gym.Env):
             self.neighbor_obs_size = 0
         else:
             raise NotImplementedError(f'Unknown value {self.swarm_obs} passed to --neighbor_obs_type')
+        # selection of the closest neighbors for local_obs, neighbor_indices_all are the (N, N - 1) indices of the
+        # other drones of every drone
+        if quads_neighbor_search == 'kdtree' and quads_use_numba in ('fused', 'parallel'):
+            # the fused step selects the neighbors inside its kernel
+            raise ValueError(f'Neighbor search kdtree is not supported with quads_use_numba={quads_use_numba}')
+        self.neighbor_selector = NeighborSelector(self.num_agents, self.num_use_neighbor_obs, local_metric=local_metric,
+                                                  local_coeff=local_coeff, search=quads_neighbor_search)
+        self.neighbor_indices_all = self.neighbor_selector.others
         self.clip_neighbor_space_length = self.num_use_neighbor_obs * self.neighbor_obs_size
         self.clip_neighbor_space_min_box = self.observation_space.low[obs_self_size:obs_self_size+self.clip_neighbor_space_length]
         self.clip_neighbor_space_max_box = self.observation_space.high[obs_self_size:obs_self_size+self.clip_neighbor_space_length]
@@ -128,16 +167,21 @@ class QuadrotorEnvMulti(gym.Env):
         # Aux variables for rewards
         self.rews_settle = np.zeros(self.num_agents)
         self.rews_settle_raw = np.zeros(self.num_agents)
+        # Reward components of the step and their sums over the episode, reported in the infos as dicts
+        self.reward_components = RewardComponents(self.num_agents)
+        self.info_level = quads_info_level
 
         # Aux variables for scenarios
         self.scenario = create_scenario(quads_mode=quads_mode, envs=self.envs, num_agents=self.num_agents,
                                         room_dims=self.room_dims, room_dims_callback=self.set_room_dims, rew_coeff=self.rew_coeff,
-                                        quads_formation=quads_formation, quads_formation_size=quads_formation_size)
+                                        quads_formation=quads_formation, quads_formation_size=quads_formation_size,
+                                        reward_components=self.reward_components)
         self.quads_formation_size = quads_formation_size
         self.goal_central = np.array([0., 0., 2.])
 
         # Set Obstacles
         self.multi_obstacles = None
+        self.obstacle_sdf = None
         self.obstacle_mode = quads_obstacle_mode
         self.obstacle_num = quads_obstacle_num
         self.use_obstacles = self.obstacle_mode != 'no_obstacles' and self.obstacle_num > 0
@@ -146,7 +190,7 @@ class QuadrotorEnvMulti(gym.Env):
             obstacle_init_box = self.envs[0].box  # box of env is: 2 meters
             # This parameter is used to judge whether obstacles are out of room, and then, we can reset the obstacles
             self.obstacle_room = self.envs[0].room_box  # [[-5, -5, 0], [5, 5, 10]]
-            dt = 1.0 / sim_freq
+            dt = 1.0 / OBSTACLE_SIM_FREQ
             self.set_obstacles = np.zeros(self.obstacle_num, dtype=bool)
             self.obstacle_shape = quads_obstacle_type
             self.obst_penalty_fall_off = obst_penalty_fall_off
@@ -158,7 +202,21 @@ class QuadrotorEnvMulti(gym.Env):
 
             # collisions between obstacles and quadrotors
             self.obst_quad_collisions_per_episode = 0
-            self.prev_obst_quad_collisions = []
+            self.obst_quad_contacts = ContactEvents(self.num_agents, self.obstacle_num)
+
+            # Obstacles that do not move within an episode can be queried through a signed distance grid
+            if quads_obstacle_sdf:
+                if self.obstacle_mode == 'dynamic':
+                    raise ValueError('quads_obstacle_sdf requires obstacles that do not move, not the dynamic mode')
+                self.obstacle_sdf = ObstacleSDF(resolution=quads_obstacle_sdf_resolution)
+
+        # Observations of all agents, the own, neighbor and obstacle blocks are written in place
+        use_neighbor_obs = self.swarm_obs != 'none' and self.num_agents > 1
+        self.obs_buffer = ObservationBuffer(
+            self.num_agents, obs_self_size, neighbor_obs_size=self.neighbor_obs_size,
+            num_neighbors=self.num_use_neighbor_obs if use_neighbor_obs else 0,
+            num_obstacles=self.obstacle_num if self.use_obstacles else 0, dtype=self.swarm_dynamics.dtype,
+        )
 
         # set render
         self.simulation_start_time = 0
@@ -180,9 +238,18 @@ class QuadrotorEnvMulti(gym.Env):
         self.collision_falloff_radius = collision_falloff_radius
         self.collision_smooth_max_penalty = collision_smooth_max_penalty
 
-        self.prev_drone_collisions, self.curr_drone_collisions = [], []
+        # contacts between drones, (i, j) pairs with i < j
+        self.drone_contacts = ContactEvents(self.num_agents, self.num_agents)
+        self.curr_drone_collisions = self.last_step_unique_collisions = np.empty((0, 2), dtype=np.int64)
         self.all_collisions = {}
         self.apply_collision_force = collision_force
+        # dense: N x N distance matrix, grid: cell list broad phase that only returns the pairs of close drones
+        if quads_collision_broad_phase not in ('dense', 'grid'):
+            raise ValueError(f'Unknown collision broad phase {quads_collision_broad_phase}')
+        if quads_collision_broad_phase == 'grid' and quads_use_numba in ('fused', 'parallel'):
+            # the fused step computes the dense collision matrix inside its kernel
+            raise ValueError(f'Collision broad phase grid is not supported with quads_use_numba={quads_use_numba}')
+        self.collision_broad_phase = quads_collision_broad_phase
 
         # set to true whenever we need to reset the OpenGL scene in render()
         self.reset_scene = False
@@ -193,10 +260,25 @@ class QuadrotorEnvMulti(gym.Env):
         self.use_replay_buffer = use_replay_buffer
         self.activate_replay_buffer = False  # only start using the buffer after the drones learn how to fly
         self.saved_in_replay_buffer = False  # since the same collisions happen during replay, we don't want to keep resaving the same event
-        self.last_step_unique_collisions = False
         self.crashes_in_recent_episodes = deque([], maxlen=100)
         self.crashes_last_episode = 0
 
+        # quads_use_numba='fused': the whole control step of the swarm is a single numba call
+        # quads_use_numba='parallel': same, with the agents distributed over quads_num_threads threads
+        self.fused_step = None
+        if quads_use_numba in ('fused', 'parallel'):
+            self.fused_step = SwarmFusedStep(self, parallel=quads_use_numba == 'parallel', num_threads=quads_num_threads)
+
+    def build_obstacle_sdf(self):
+        obstacles = self.multi_obstacles
+        if self.obst_penalty_fall_off:
+            penalty_radius = self.obst_penalty_fall_off * self.quad_arm + obstacles.size / 2
+        else:
+            penalty_radius = np.zeros(self.obstacle_num)
+        self.obstacle_sdf.build(room_box=self.envs[0].room_box, pos=obstacles.pos, size=obstacles.size,
+                                shape_ids=obstacles.shape_ids, collidable=self.set_obstacles,
+                                penalty_radius=penalty_radius)
+
     def set_room_dims(self, dims):
         # dims is a (x, y, z) tuple
         self.room_dims = dims
@@ -209,104 +291,72 @@ class QuadrotorEnvMulti(gym.Env):
 
         if indices is None:
             # if not specified explicitly, consider all neighbors
-            indices = [j for j in range(self.num_agents) if j != i]
-
-        cur_pos = self.envs[i].dynamics.pos
-        cur_vel = self.envs[i].dynamics.vel
-        pos_neighbor = np.stack([self.envs[j].dynamics.pos for j in indices])
-        vel_neighbor = np.stack([self.envs[j].dynamics.vel for j in indices])
-        pos_rel = pos_neighbor - cur_pos
-        vel_rel = vel_neighbor - cur_vel
+            indices = self.neighbor_indices_all[i]
+
+        pos, vel = self.swarm_dynamics.pos, self.swarm_dynamics.vel
+        pos_rel = pos[indices] - pos[i]
+        vel_rel = vel[indices] - vel[i]
         return pos_rel, vel_rel
 
-    def get_rel_pos_vel_stack(self):
-        rel_pos_stack, rel_vel_stack = [], []
-        for i in range(self.num_agents):
-            pos_rel, vel_rel = self.get_rel_pos_vel_item(env_id=i)
-            rel_pos_stack.append(pos_rel)
-            rel_vel_stack.append(vel_rel)
-        return np.array(rel_pos_stack), np.array(rel_vel_stack)
+    def get_rel_pos_vel_stack(self, indices=None):
+        """Positions and velocities of the neighbors relative to every agent, (N, K, 3) arrays for (N, K) indices."""
+        if indices is None:
+            indices = self.neighbor_indices_all
+        pos, vel = self.swarm_dynamics.pos, self.swarm_dynamics.vel
+        rel_pos = pos[indices] - pos[:, None]
+        rel_vel = vel[indices] - vel[:, None]
+        return rel_pos, rel_vel
 
-    def get_obs_neighbor_rel(self, env_id, closest_drones):
-        i = env_id
-        pos_neighbors_rel, vel_neighbors_rel = self.get_rel_pos_vel_item(env_id=i, indices=closest_drones[i])
+    def get_obs_neighbor_rel(self, closest_drones):
+        """Observations of the neighbors of all agents gathered at once, (N, K, neighbor_obs_size)."""
+        pos_neighbors_rel, vel_neighbors_rel = self.get_rel_pos_vel_stack(indices=closest_drones)
 
         if self.swarm_obs == 'pos_vel':
-            obs_neighbor_rel = np.concatenate((pos_neighbors_rel, vel_neighbors_rel), axis=1)
+            obs_neighbor_rel = np.concatenate((pos_neighbors_rel, vel_neighbors_rel), axis=2)
         else:
-            neighbor_goals_rel = np.stack([self.envs[j].goal for j in closest_drones[i]]) - self.envs[i].dynamics.pos
+            goals = np.array([e.goal for e in self.envs])
+            neighbor_goals_rel = goals[closest_drones] - self.swarm_dynamics.pos[:, None]
 
             if self.swarm_obs == 'pos_vel_goals':
-                obs_neighbor_rel = np.concatenate((pos_neighbors_rel, vel_neighbors_rel, neighbor_goals_rel), axis=1)
+                obs_neighbor_rel = np.concatenate((pos_neighbors_rel, vel_neighbors_rel, neighbor_goals_rel), axis=2)
             elif self.swarm_obs == 'pos_vel_goals_ndist_gdist':
-                dist_to_neighbors = np.linalg.norm(pos_neighbors_rel, axis=1).reshape(-1, 1)
-                dist_to_neighbor_goals = np.linalg.norm(neighbor_goals_rel, axis=1).reshape(-1, 1)
-                obs_neighbor_rel = np.concatenate((pos_neighbors_rel, vel_neighbors_rel, neighbor_goals_rel, dist_to_neighbors, dist_to_neighbor_goals), axis=1)
+                dist_to_neighbors = np.linalg.norm(pos_neighbors_rel, axis=2, keepdims=True)
+                dist_to_neighbor_goals = np.linalg.norm(neighbor_goals_rel, axis=2, keepdims=True)
+                obs_neighbor_rel = np.concatenate((pos_neighbors_rel, vel_neighbors_rel, neighbor_goals_rel, dist_to_neighbors, dist_to_neighbor_goals), axis=2)
             else:
                 raise NotImplementedError
 
         return obs_neighbor_rel
 
-    def extend_obs_space(self, obs, closest_drones):
+    def extend_obs_space(self, closest_drones):
+        """Writes the clipped observations of the neighbors into their block of the observation buffer."""
         assert self.swarm_obs in ['pos_vel', 'pos_vel_goals', 'pos_vel_goals_ndist_gdist'], \
             f'Invalid parameter {self.swarm_obs} passed in --obs_space'
 
-        obs_neighbors = []
-        for i in range(len(self.envs)):
-            obs_neighbor_rel = self.get_obs_neighbor_rel(env_id=i, closest_drones=closest_drones)
-            obs_neighbors.append(obs_neighbor_rel.reshape(-1))
-        obs_neighbors = np.stack(obs_neighbors)
+        obs_neighbors = self.get_obs_neighbor_rel(closest_drones=closest_drones).reshape(self.num_agents, -1)
 
         # clip observation space of neighborhoods
-        obs_neighbors = np.clip(
+        np.clip(
             obs_neighbors, a_min=self.clip_neighbor_space_min_box, a_max=self.clip_neighbor_space_max_box,
+            out=self.obs_buffer.neighbor_obs,
         )
-        obs_ext = np.concatenate((obs, obs_neighbors), axis=1)
-        return obs_ext
 
     def neighborhood_indices(self):
-        """Return a list of closest drones for each drone in the swarm."""
+        """Return the (N, K) indices of the closest drones of each drone in the swarm."""
         # indices of all the other drones except us
-        indices = [[j for j in range(self.num_agents) if i != j] for i in range(self.num_agents)]
-        indices = np.array(indices)
+        indices = self.neighbor_indices_all
 
         if self.num_use_neighbor_obs == self.num_agents - 1:
             return indices
         elif 1 <= self.num_use_neighbor_obs < self.num_agents - 1:
-            close_neighbor_indices = []
-
-            for i in range(self.num_agents):
-                rel_pos, rel_vel = self.get_rel_pos_vel_item(env_id=i, indices=indices[i])
-                rel_dist = np.linalg.norm(rel_pos, axis=1)
-                rel_dist = np.maximum(rel_dist, 0.01)
-                rel_pos_unit = rel_pos / rel_dist[:, None]
-
-                # new relative distance is a new metric that combines relative position and relative velocity
-                # F = alpha * distance + (1 - alpha) * dot(normalized_direction_to_other_drone, relative_vel)
-                if self.local_metric == "dist":
-                    # the smaller the new_rel_dist, the closer the drones
-                    new_rel_dist = rel_dist + self.local_coeff * np.sum(rel_pos_unit * rel_vel, axis=1)
-                elif self.local_metric == "dist_inverse":
-                    new_rel_dist = 1.0 / rel_dist - self.local_coeff * np.sum(rel_pos_unit * rel_vel, axis=1)
-                    new_rel_dist = -1.0 * new_rel_dist
-                else:
-                    raise NotImplementedError(f"Unknown local metric {self.local_metric}")
-
-                rel_pos_index = new_rel_dist.argsort()
-                rel_pos_index = rel_pos_index[:self.num_use_neighbor_obs]
-                close_neighbor_indices.append(indices[i][rel_pos_index])
-
-            return close_neighbor_indices
+            return self.neighbor_selector.select(self.swarm_dynamics.pos, self.swarm_dynamics.vel)
         else:
             raise RuntimeError("Incorrect number of neigbors")
 
-    def add_neighborhood_obs(self, obs):
+    def add_neighborhood_obs(self):
         if self.swarm_obs != 'none' and self.num_agents > 1:
             indices = self.neighborhood_indices()
-            obs_ext = self.extend_obs_space(obs, closest_drones=indices)
-            return obs_ext
-        else:
-            return obs
+            self.extend_obs_space(closest_drones=indices)
 
     def can_drones_fly(self):
         """
@@ -326,8 +376,22 @@ class QuadrotorEnvMulti(gym.Env):
             vis_acc_arrows=self.vis_acc_arrows, viz_traces=self.viz_traces, viz_trace_nth_step=self.viz_trace_nth_step,
         )
 
+    def seed(self, seed=None):
+        """
+        Seeds the start states of the quadrotors and, with quads_noise_pool=True, the thrust and sensor noise.
+        Goals and the scenarios still use the global numpy random generator.
+        """
+        pool_seed, agents_seed = np.random.SeedSequence(seed).spawn(2)
+        if self.swarm_dynamics.noise_pool is not None:
+            self.swarm_dynamics.noise_pool.seed(pool_seed)
+        self.seed_agents(agents_seed)
+        return [seed]
+
+    def seed_agents(self, seed_seq):
+        for e, agent_seed in zip(self.envs, seed_seq.generate_state(self.num_agents)):
+            e._seed(int(agent_seed))
+
     def reset(self):
-        obs, rewards, dones, infos = [], [], [], []
         self.scenario.reset()
         self.quads_formation_size = self.scenario.formation_size
         self.goal_central = np.mean(self.scenario.goals, axis=0)
@@ -348,108 +412,188 @@ class QuadrotorEnvMulti(gym.Env):
             e.rew_coeff = self.rew_coeff
             e.update_env(*self.room_dims)
 
-            observation = e.reset()
-            obs.append(observation)
+            self.obs_buffer.self_obs[i] = e.reset()
 
         # extend obs to see neighbors
-        obs = self.add_neighborhood_obs(obs)
+        self.add_neighborhood_obs()
 
         # Reset Obstacles
         if self.use_obstacles:
             self.set_obstacles = np.zeros(self.obstacle_num, dtype=bool)
-            quads_pos = np.array([e.dynamics.pos for e in self.envs])
-            quads_vel = np.array([e.dynamics.vel for e in self.envs])
-            obs = self.multi_obstacles.reset(obs=obs, quads_pos=quads_pos, quads_vel=quads_vel,
-                                             set_obstacles=self.set_obstacles, formation_size=self.quads_formation_size,
-                                             goal_central=self.goal_central)
+            self.multi_obstacles.reset(obs=self.obs_buffer.obstacle_obs, quads_pos=self.swarm_dynamics.pos,
+                                       quads_vel=self.swarm_dynamics.vel, set_obstacles=self.set_obstacles,
+                                       formation_size=self.quads_formation_size, goal_central=self.goal_central)
+            if self.obstacle_sdf is not None:
+                self.build_obstacle_sdf()
             self.obst_quad_collisions_per_episode = 0
-            self.prev_obst_quad_collisions = []
+            self.obst_quad_contacts.reset()
 
         self.all_collisions = {val: [0.0 for _ in range(len(self.envs))] for val in ['drone', 'ground', 'obstacle']}
 
         self.collisions_per_episode = self.collisions_after_settle = 0
-        self.prev_drone_collisions, self.curr_drone_collisions = [], []
+        self.drone_contacts.reset()
+        self.curr_drone_collisions = self.last_step_unique_collisions = np.empty((0, 2), dtype=np.int64)
 
         self.reset_scene = True
         self.crashes_last_episode = 0
-        return obs
+        self.reward_components.reset_episode()
+        if self.fused_step is not None:
+            self.fused_step.reset()
+        return self.obs_buffer.output()
 
-    # noinspection PyTypeChecker
-    def step(self, actions):
-        obs, rewards, dones, infos = [], [], [], []
+    def get_diagnostics(self):
+        """Observation components and dynamics parameters of all agents, i.e. the infos of quads_info_level=full."""
+        return [e.get_diagnostics() for e in self.envs]
+
+    def use_fused_step(self):
+        return self.fused_step is not None and self.swarm_dynamics.supports_batch_step()
+
+    def step_control(self, actions):
+        """
+        First phase of step(): controllers convert the actions into thrusts.
+        Returns True if the dynamics of the swarm still have to be integrated with a batched SwarmDynamics.step() call.
+        """
+        if self.use_fused_step():
+            return False
+
+        # Controllers only record the thrusts, then all agents are integrated in a single call
+        self.swarm_dynamics.batch_step = self.swarm_dynamics.supports_batch_step()
+        for i, a in enumerate(actions):
+            self.envs[i]._step_control(a)
+        batch_step, self.swarm_dynamics.batch_step = self.swarm_dynamics.batch_step, False
+        return batch_step
+
+    def step_envs(self, actions):
+        """
+        Reference (per-env) step of the quads, the own and neighbor observations are written into the observation
+        buffer, which is returned as obs.
+        """
+        dones, infos = [], []
+        states = [None] * self.num_agents
+        if self.swarm_state_vector is not None:
+            states = self.swarm_state_vector(self, out=self.obs_buffer.self_obs)
+
+        # crashes and rewards of all agents in one call, the reward components are written into their columns
+        swarm, e0 = self.swarm_dynamics, self.envs[0]
+        swarm.sync_rot()
+        crashed = [e._update_crashed() for e in self.envs]
+        rewards, rew_components = compute_rewards_batched(
+            swarm.pos, swarm.vel, swarm.rot, swarm.omega, np.array([e.goal for e in self.envs]),
+            np.asarray(actions), np.array([e.actions[1] for e in self.envs]), crashed, self.rew_coeff, e0.dt,
+            quads_settle=e0.quads_settle, quads_settle_range_meters=e0.quads_settle_range_meters,
+            quads_vel_reward_out_range=e0.quads_vel_reward_out_range,
+        )
+        self.reward_components.step[:, :rew_components.shape[1]] = rew_components
 
         for i, a in enumerate(actions):
             self.envs[i].rew_coeff = self.rew_coeff
 
-            observation, reward, done, info = self.envs[i].step(a)
-            obs.append(observation)
-            rewards.append(reward)
+            observation, _, done, info = self.envs[i]._step_post(a, sv=states[i], reward=rewards[i])
+            if states[i] is None:
+                self.obs_buffer.self_obs[i] = observation
             dones.append(done)
             infos.append(info)
 
             self.pos[i, :] = self.envs[i].dynamics.pos
 
-        obs = self.add_neighborhood_obs(obs)
+        self.add_neighborhood_obs()
+        return self.obs_buffer.buffer, rewards, dones, infos
 
-        if self.use_replay_buffer and not self.activate_replay_buffer:
-            self.crashes_last_episode += infos[0]["rewards"]["rew_crash"]
+    def step(self, actions):
+        if self.step_control(actions):
+            self.swarm_dynamics.step(dt=self.envs[0].dt, steps_num=self.envs[0].sim_steps)
+        return self.step_post(actions)
+
+    # noinspection PyTypeChecker
+    def step_post(self, actions):
+        """Second phase of step(), after the dynamics have been integrated: observations, rewards and collisions."""
+        rew_comps = self.reward_components
+        rew_comps.new_step()
+        if self.use_fused_step():
+            obs, rewards, dones, infos, drone_col_matrix, self.curr_drone_collisions, distance_matrix, \
+                rew_proximity = self.fused_step.step(actions)
+            self.pos[:] = self.swarm_dynamics.pos
+            drone_collisions = np.sum(drone_col_matrix, axis=1)
+        elif self.collision_broad_phase == 'grid':
+            obs, rewards, dones, infos = self.step_envs(actions)
+            # Only the pairs of drones within the hitbox or the fall-off radius of the proximity penalties
+            close_pairs, self.curr_drone_collisions = calculate_collision_pairs(
+                self.pos, self.quad_arm, self.collision_hitbox_radius, self.collision_falloff_radius)
+            drone_collisions = np.bincount(self.curr_drone_collisions.reshape(-1), minlength=self.num_agents)
+
+            rew_proximity = -1.0 * calculate_drone_proximity_penalties_sparse(
+                pairs=close_pairs, arm=self.quad_arm, dt=self.control_dt,
+                penalty_fall_off=self.collision_falloff_radius,
+                max_penalty=self.rew_coeff["quadcol_bin_smooth_max"],
+                num_agents=self.num_agents,
+            )
+        else:
+            obs, rewards, dones, infos = self.step_envs(actions)
+            # Calculating collisions between drones
+            drone_col_matrix, self.curr_drone_collisions, distance_matrix = calculate_collision_matrix(self.pos, self.quad_arm, self.collision_hitbox_radius)
+            drone_collisions = np.sum(drone_col_matrix, axis=1)
+
+            # penalties for being too close to other drones
+            rew_proximity = -1.0 * calculate_drone_proximity_penalties(
+                distance_matrix=distance_matrix, arm=self.quad_arm, dt=self.control_dt,
+                penalty_fall_off=self.collision_falloff_radius,
+                max_penalty=self.rew_coeff["quadcol_bin_smooth_max"],
+                num_agents=self.num_agents,
+            )
 
-        # Calculating collisions between drones
-        drone_col_matrix, self.curr_drone_collisions, distance_matrix = calculate_collision_matrix(self.pos, self.quad_arm, self.collision_hitbox_radius)
+        if self.use_replay_buffer and not self.activate_replay_buffer:
+            self.crashes_last_episode += rew_comps.get('rew_crash')[0]
 
-        self.last_step_unique_collisions = np.setdiff1d(self.curr_drone_collisions, self.prev_drone_collisions)
+        # pairs of drones that collide in this step and did not in the previous one
+        new_contacts = self.drone_contacts.update(self.curr_drone_collisions[:, 0], self.curr_drone_collisions[:, 1])
+        self.last_step_unique_collisions = self.curr_drone_collisions[new_contacts]
 
         # collision between 2 drones counts as a single collision
-        collisions_curr_tick = len(self.last_step_unique_collisions) // 2
+        collisions_curr_tick = len(self.last_step_unique_collisions)
         self.collisions_per_episode += collisions_curr_tick
-
-        if collisions_curr_tick > 0:
-            if self.envs[0].tick >= self.collisions_grace_period_seconds * self.control_freq:
-                self.collisions_after_settle += collisions_curr_tick
-
-        self.prev_drone_collisions = self.curr_drone_collisions
+        if self.envs[0].tick >= self.collisions_grace_period_seconds * self.control_freq:
+            self.collisions_after_settle += collisions_curr_tick
 
         rew_collisions_raw = np.zeros(self.num_agents)
-        if self.last_step_unique_collisions.any():
-            rew_collisions_raw[self.last_step_unique_collisions] = -1.0
+        rew_collisions_raw[self.last_step_unique_collisions.reshape(-1)] = -1.0
         rew_collisions = self.rew_coeff["quadcol_bin"] * rew_collisions_raw
 
-        # penalties for being too close to other drones
-        rew_proximity = -1.0 * calculate_drone_proximity_penalties(
-            distance_matrix=distance_matrix, arm=self.quad_arm, dt=self.control_dt,
-            penalty_fall_off=self.collision_falloff_radius,
-            max_penalty=self.rew_coeff["quadcol_bin_smooth_max"],
-            num_agents=self.num_agents,
-        )
-
         # COLLISION BETWEEN QUAD AND OBSTACLE(S)
-        if self.use_obstacles:
-            obst_quad_col_matrix, curr_obst_quad_collisions, curr_all_collisions, obst_quad_distance_matrix \
+        if self.use_obstacles and self.obstacle_sdf is not None:
+            curr_all_collisions = self.obstacle_sdf.collision_detection(self.pos, self.quad_arm)
+            obstacle_collisions = np.bincount(curr_all_collisions[:, 0], minlength=self.num_agents).astype(np.float64)
+        elif self.use_obstacles:
+            obst_quad_col_matrix, curr_all_collisions, obst_quad_distance_matrix \
                 = self.multi_obstacles.collision_detection(pos_quads=self.pos, set_obstacles=self.set_obstacles)
-            obst_quad_last_step_unique_collisions = np.setdiff1d(curr_obst_quad_collisions, self.prev_obst_quad_collisions)
-            self.obst_quad_collisions_per_episode += len(obst_quad_last_step_unique_collisions)
-            self.prev_obst_quad_collisions = curr_obst_quad_collisions
+            obstacle_collisions = np.sum(obst_quad_col_matrix, axis=1)
 
+        if self.use_obstacles:
+            new_contacts = self.obst_quad_contacts.update(curr_all_collisions[:, 0], curr_all_collisions[:, 1])
+            self.obst_quad_collisions_per_episode += np.count_nonzero(new_contacts)
+
+            # We assign penalties to the drones with a new contact with any of the obstacles
             rew_obst_quad_collisions_raw = np.zeros(self.num_agents)
-            if obst_quad_last_step_unique_collisions.any():
-                # We assign penalties to the drones which collide with the obstacles
-                # And obst_quad_last_step_unique_collisions only include drones' id
-                rew_obst_quad_collisions_raw[obst_quad_last_step_unique_collisions] = -1.0
+            rew_obst_quad_collisions_raw[curr_all_collisions[new_contacts, 0]] = -1.0
 
             rew_collisions_obst_quad = self.rew_coeff["quadcol_bin_obst"] * rew_obst_quad_collisions_raw
 
             # penalties for low distance between obstacles and drones
-            obstacles_radius = np.stack([self.multi_obstacles.obstacles[i].size / 2 for i in range(self.obstacle_num)])
-            rew_obst_quad_proximity = -1.0 * calculate_obst_drone_proximity_penalties(
-                distance_matrix=obst_quad_distance_matrix, arm=self.quad_arm, dt=self.control_dt,
-                penalty_fall_off=self.obst_penalty_fall_off,
-                max_penalty=self.rew_coeff["quadcol_bin_obst_smooth_max"],
-                num_agents=self.num_agents,
-                obstacles_radius=obstacles_radius
-            )
+            if self.obstacle_sdf is not None:
+                rew_obst_quad_proximity = np.zeros(self.num_agents)
+                if self.obst_penalty_fall_off:
+                    rew_obst_quad_proximity = -1.0 * self.obstacle_sdf.proximity_penalties(
+                        self.pos, max_penalty=self.rew_coeff["quadcol_bin_obst_smooth_max"], dt=self.control_dt)
+            else:
+                rew_obst_quad_proximity = -1.0 * calculate_obst_drone_proximity_penalties(
+                    distance_matrix=obst_quad_distance_matrix, arm=self.quad_arm, dt=self.control_dt,
+                    penalty_fall_off=self.obst_penalty_fall_off,
+                    max_penalty=self.rew_coeff["quadcol_bin_obst_smooth_max"],
+                    num_agents=self.num_agents,
+                    obstacles_radius=self.multi_obstacles.size / 2
+                )
         else:
-            obst_quad_col_matrix = np.zeros((self.num_agents, self.obstacle_num))
-            curr_all_collisions = []
+            obstacle_collisions = np.zeros(self.num_agents)
+            curr_all_collisions = np.empty((0, 2), dtype=np.int64)
             rew_obst_quad_collisions_raw = np.zeros(self.num_agents)
             rew_collisions_obst_quad = np.zeros(self.num_agents)
             rew_obst_quad_proximity = np.zeros(self.num_agents)
@@ -457,43 +601,46 @@ class QuadrotorEnvMulti(gym.Env):
         # Collisions with ground
         ground_collisions = [1.0 if pos[2] < 0.25 else 0.0 for pos in self.pos]
 
-        self.all_collisions = {'drone': np.sum(drone_col_matrix, axis=1), 'ground': ground_collisions,
-                               'obstacle': np.sum(obst_quad_col_matrix, axis=1)}
+        self.all_collisions = {'drone': drone_collisions, 'ground': ground_collisions,
+                               'obstacle': obstacle_collisions}
 
         # Applying random forces for all collisions between drones and obstacles
         if self.apply_collision_force:
-            for val in self.curr_drone_collisions:
-                perform_collision_between_drones(self.envs[val[0]].dynamics, self.envs[val[1]].dynamics)
-            for val in curr_all_collisions:
-                perform_collision_with_obstacle(
-                    drone_dyn=self.envs[val[0]].dynamics, obstacle_dyn=self.multi_obstacles.obstacles[val[1]],
-                    quad_arm=self.quad_arm)
-
-        for i in range(self.num_agents):
-            rewards[i] += rew_collisions[i]
-            infos[i]["rewards"]["rew_quadcol"] = rew_collisions[i]
-            infos[i]["rewards"]["rewraw_quadcol"] = rew_collisions_raw[i]
-
-            rewards[i] += rew_proximity[i]
-            infos[i]["rewards"]["rew_proximity"] = rew_proximity[i]
+            swarm = self.swarm_dynamics
+            perform_collisions_between_drones(swarm.pos, swarm.vel, swarm.omega, self.curr_drone_collisions)
+            if len(curr_all_collisions) > 0:
+                perform_collisions_with_obstacles(
+                    swarm.pos, swarm.vel, swarm.omega, obstacles_pos=self.multi_obstacles.pos,
+                    obstacles_vel=self.multi_obstacles.vel, pairs=curr_all_collisions)
+
+        rewards = np.asarray(rewards, dtype=np.float64) + rew_collisions + rew_proximity
+        rew_comps.set('rew_quadcol', rew_collisions)
+        rew_comps.set('rewraw_quadcol', rew_collisions_raw)
+        rew_comps.set('rew_proximity', rew_proximity)
 
-            if self.use_obstacles:
-                rewards[i] += rew_collisions_obst_quad[i]
-                infos[i]["rewards"]["rew_quadcol_obstacle"] = rew_collisions_obst_quad[i]
-                infos[i]["rewards"]["rewraw_quadcol_obstacle"] = rew_obst_quad_collisions_raw[i]
-
-                rewards[i] += rew_obst_quad_proximity[i]
-                infos[i]["rewards"]["rew_obst_quad_proximity"] = rew_obst_quad_proximity[i]
+        if self.use_obstacles:
+            rewards += rew_collisions_obst_quad
+            rewards += rew_obst_quad_proximity
+            rew_comps.set('rew_quadcol_obstacle', rew_collisions_obst_quad)
+            rew_comps.set('rewraw_quadcol_obstacle', rew_obst_quad_collisions_raw)
+            rew_comps.set('rew_obst_quad_proximity', rew_obst_quad_proximity)
+        rewards = rewards.tolist()
 
         # run the scenario passed to self.quads_mode
         infos, rewards = self.scenario.step(infos=infos, rewards=rewards, pos=self.pos)
 
+        # the reward components are only converted to dicts when they are reported
+        if self.info_level != 'none':
+            for info, rew_dict in zip(infos, rew_comps.step_dicts()):
+                info['rewards'] = rew_dict
+        rew_comps.end_step()
+
         # For obstacles
-        quads_vel = np.array([e.dynamics.vel for e in self.envs])
+        quads_vel = self.swarm_dynamics.vel
 
         if self.obstacle_mode == 'dynamic' and self.obstacle_num > 0:
-            tmp_obs = self.multi_obstacles.step(obs=obs, quads_pos=self.pos, quads_vel=quads_vel,
-                                                set_obstacles=self.set_obstacles)
+            self.multi_obstacles.step(obs=self.obs_buffer.obstacle_obs, quads_pos=self.pos, quads_vel=quads_vel,
+                                      set_obstacles=self.set_obstacles)
 
             # If there are still at least one obstacle flying in the air, we should check the function below
             # and reset the counter only if all obstacles hit the floor
@@ -518,8 +665,7 @@ class QuadrotorEnvMulti(gym.Env):
                                 obst_shape = OBSTACLES_SHAPE_LIST[obst_shape_id]
 
                             obstacle.reset(set_obstacle=False, formation_size=self.quads_formation_size,
-                                           goal_central=self.goal_central, shape=obst_shape, quads_pos=self.pos,
-                                           quads_vel=quads_vel)
+                                           goal_central=self.goal_central, shape=obst_shape)
                     elif self.multi_obstacles.obstacles[obst_i].tmp_traj == "electron":
                         tick = self.envs[0].tick
                         control_step_for_sec = int(7.0 * self.control_freq)
@@ -531,8 +677,8 @@ class QuadrotorEnvMulti(gym.Env):
                 self.set_obstacles = np.ones(self.obstacle_num, dtype=bool)
                 self.quads_formation_size = self.scenario.formation_size
                 self.goal_central = np.mean(self.scenario.goals, axis=0)
-                tmp_obs = self.multi_obstacles.reset(
-                    obs=obs, quads_pos=self.pos, quads_vel=quads_vel, set_obstacles=self.set_obstacles,
+                self.multi_obstacles.reset(
+                    obs=self.obs_buffer.obstacle_obs, quads_pos=self.pos, quads_vel=quads_vel, set_obstacles=self.set_obstacles,
                     formation_size=self.quads_formation_size, goal_central=self.goal_central)
 
                 # In testing mode, which means reset the scene, and this in visualization would make people feel
@@ -540,10 +686,10 @@ class QuadrotorEnvMulti(gym.Env):
                 if self.obstacle_num > 1:
                     self.reset_scene = True
 
-            obs = tmp_obs
-
         # DONES
         if any(dones):
+            for info, episode_rewards in zip(infos, rew_comps.episode_dicts()):
+                info['episode_rewards'] = episode_rewards
             for i in range(len(infos)):
                 if self.saved_in_replay_buffer:
                     infos[i]['episode_extra_stats'] = {
@@ -561,6 +707,8 @@ class QuadrotorEnvMulti(gym.Env):
 
             obs = self.reset()
             dones = [True] * len(dones)  # terminate the episode for all "sub-envs"
+        else:
+            obs = self.obs_buffer.output()
 
         return obs, rewards, dones, infos
 
@@ -656,3 +804,98 @@ class QuadrotorEnvMulti(gym.Env):
         copied_env.scene = None
 
         return copied_env
+
+
+class QuadrotorVecEnvMulti(gym.Env):
+    """
+    K independent swarms of N quadrotors simulated by a single array-backed engine with K * N rows.
+    Every swarm is a QuadrotorEnvMulti whose SwarmDynamics is a view onto its N rows, so the dynamics of all swarms are
+    integrated in a single call. Swarms reset independently when their episode ends.
+    The fused and parallel numba modes step a single swarm per kernel call and are only supported with num_envs == 1.
+    Observations, rewards, dones and infos of all agents are stacked swarm by swarm, i.e. agent i of swarm k is at
+    k * N + i, which allows to treat the whole vector env as a single multi-agent env with K * N agents.
+    """
+
+    def __init__(self, num_envs, num_agents, **kwargs):
+        super().__init__()
+
+        quads_use_numba = kwargs.get('quads_use_numba', False)
+        if num_envs > 1 and quads_use_numba in ('fused', 'parallel'):
+            # the fused kernel steps a single swarm, every swarm would run its own kernel and post-processing
+            raise ValueError(f'quads_use_numba={quads_use_numba} is not supported with num_envs > 1')
+
+        self.num_envs = num_envs
+        self.num_agents_per_env = num_agents
+        self.num_agents = num_envs * num_agents
+        self.is_multiagent = True
+        self.reports_episode_rewards = True
+
+        self.swarm_dynamics = SwarmDynamics(num_agents=self.num_agents, use_numba=quads_use_numba,
+                                            num_threads=kwargs.get('quads_num_threads'),
+                                            integrator=kwargs.get('quads_integrator', 'euler'),
+                                            attitude=kwargs.get('quads_attitude', 'rot'),
+                                            precision=kwargs.get('quads_precision', 'float64'),
+                                            noise_pool=NoisePool() if kwargs.get('quads_noise_pool') else None)
+        self.envs = [
+            QuadrotorEnvMulti(num_agents=num_agents,
+                              swarm_dynamics=self.swarm_dynamics.sub_swarm(k * num_agents, num_agents), **kwargs)
+            for k in range(num_envs)
+        ]
+
+        self.action_space = self.envs[0].action_space
+        self.observation_space = self.envs[0].observation_space
+        # reward coefficients of all swarms, e.g. modified by the reward shaping wrapper
+        self.rew_coeff = copy.deepcopy(self.envs[0].rew_coeff)
+        self.scenario = self.envs[0].scenario
+
+    def _sync_rew_coeff(self):
+        # swarms and their scenarios keep references to their dicts, so they are updated in-place
+        for env in self.envs:
+            env.rew_coeff.update(self.rew_coeff)
+
+    def seed(self, seed=None):
+        # all swarms share the noise pool of the engine
+        pool_seed, *env_seeds = np.random.SeedSequence(seed).spawn(self.num_envs + 1)
+        if self.swarm_dynamics.noise_pool is not None:
+            self.swarm_dynamics.noise_pool.seed(pool_seed)
+        for env, env_seed in zip(self.envs, env_seeds):
+            env.seed_agents(env_seed)
+        return [seed]
+
+    def get_diagnostics(self):
+        return [d for env in self.envs for d in env.get_diagnostics()]
+
+    def reset(self):
+        self._sync_rew_coeff()
+        return np.concatenate([np.asarray(env.reset()) for env in self.envs])
+
+    def step(self, actions):
+        self._sync_rew_coeff()
+        n = self.num_agents_per_env
+        env_actions = [actions[k * n:(k + 1) * n] for k in range(self.num_envs)]
+
+        integrate = [env.step_control(a) for env, a in zip(self.envs, env_actions)]
+        if all(integrate):
+            env0 = self.envs[0].envs[0]
+            self.swarm_dynamics.step(dt=env0.dt, steps_num=env0.sim_steps)
+        else:
+            for env, needs_integration in zip(self.envs, integrate):
+                if needs_integration:
+                    env.swarm_dynamics.step(dt=env.envs[0].dt, steps_num=env.envs[0].sim_steps)
+
+        obs, rewards, dones, infos = [], [], [], []
+        for env, a in zip(self.envs, env_actions):
+            env_obs, env_rewards, env_dones, env_infos = env.step_post(a)
+            obs.append(np.asarray(env_obs))
+            rewards.extend(env_rewards)
+            dones.extend(env_dones)
+            infos.extend(env_infos)
+
+        return np.concatenate(obs), rewards, dones, infos
+
+    def render(self, mode='human', **kwargs):
+        return self.envs[0].render(mode=mode, **kwargs)
+
+    def close(self):
+        for env in self.envs:
+            env.close()
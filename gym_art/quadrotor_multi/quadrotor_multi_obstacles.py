@@ -1,26 +1,50 @@
 import numpy as np
-from scipy import spatial
 
-from gym_art.quadrotor_multi.quadrotor_single_obstacle import SingleObstacle
-from gym_art.quadrotor_multi.quad_obstacle_utils import OBSTACLES_SHAPE_LIST
+from gym_art.quadrotor_multi.quadrotor_single_obstacle import SingleObstacle, GRAV, TRAJ_LIST
+from gym_art.quadrotor_multi.quad_obstacle_utils import OBSTACLES_SHAPE_LIST, OBSTACLE_OBS_SIZE
 
 EPS = 1e-6
 
+SPHERE, CUBE = OBSTACLES_SHAPE_LIST.index('sphere'), OBSTACLES_SHAPE_LIST.index('cube')
+GRAVITY, ELECTRON = TRAJ_LIST.index('gravity'), TRAJ_LIST.index('electron')
+
 
 class MultiObstacles:
+    """
+    The state of the obstacles is kept in (num_obstacles, ...) arrays: pos, vel, size, shape_ids (index in
+    OBSTACLES_SHAPE_LIST) and traj_ids (index in TRAJ_LIST). The trajectories, the observations and the collision
+    detection are computed for all obstacles at once, self.obstacles are views of single obstacles (see
+    SingleObstacle) that sample their initial states.
+    """
+
     def __init__(self, mode='no_obstacles', num_obstacles=0, max_init_vel=1., init_box=2.0,
                  dt=0.005, quad_size=0.046, shape='sphere', size=0.0, traj='gravity', obs_mode='relative'):
         self.num_obstacles = num_obstacles
-        self.obstacles = []
         self.shape = shape
+        self.traj = traj
         self.shape_list = OBSTACLES_SHAPE_LIST
-
-        for _ in range(num_obstacles):
-            obstacle = SingleObstacle(max_init_vel=max_init_vel, init_box=init_box, mode=mode, shape=shape, size=size,
-                                      quad_size=quad_size, dt=dt, traj=traj, obs_mode=obs_mode)
-            self.obstacles.append(obstacle)
+        self.dt = dt
+        self.quad_size = quad_size
+        self.obs_mode = obs_mode
+
+        self.pos = np.zeros((num_obstacles, 3))
+        self.vel = np.zeros((num_obstacles, 3))
+        self.size = np.zeros(num_obstacles)
+        self.goal_central = np.zeros((num_obstacles, 3))
+        self.shape_ids = np.zeros(num_obstacles, dtype=np.int64)
+        self.traj_ids = np.zeros(num_obstacles, dtype=np.int64)
+
+        self.obstacles = [
+            SingleObstacle(self, i, max_init_vel=max_init_vel, init_box=init_box, mode=mode, shape=shape, size=size,
+                           quad_size=quad_size, dt=dt, traj=traj, obs_mode=obs_mode)
+            for i in range(num_obstacles)
+        ]
 
     def reset(self, obs=None, quads_pos=None, quads_vel=None, set_obstacles=None, formation_size=0.0, goal_central=np.array([0., 0., 2.])):
+        """
+        obs is the (num_agents, num_obstacles * OBSTACLE_OBS_SIZE) obstacle block of the observations, see
+        ObservationBuffer.obstacle_obs, the observations of the obstacles are written into it in place.
+        """
         if self.num_obstacles <= 0:
             return obs
         if set_obstacles is None:
@@ -33,48 +57,83 @@ class MultiObstacles:
             shape_list = np.array(shape_list)
 
         for i, obstacle in enumerate(self.obstacles):
-            obst_obs = obstacle.reset(set_obstacle=set_obstacles[i], formation_size=formation_size,
-                                      goal_central=goal_central, shape=shape_list[i], quads_pos=quads_pos,
-                                      quads_vel=quads_vel)
-
-            obs = np.concatenate((obs, obst_obs), axis=1)
+            obstacle.reset(set_obstacle=set_obstacles[i], formation_size=formation_size, goal_central=goal_central,
+                           shape=shape_list[i])
 
+        self.update_obs(obs, quads_pos=quads_pos, quads_vel=quads_vel, set_obstacles=set_obstacles)
         return obs
 
     def step(self, obs=None, quads_pos=None, quads_vel=None, set_obstacles=None):
         if set_obstacles is None:
             raise ValueError('set_obstacles is None')
 
-        for i, obstacle in enumerate(self.obstacles):
-            obst_obs = obstacle.step(quads_pos=quads_pos, quads_vel=quads_vel, set_obstacle=set_obstacles[i])
-            obs = np.concatenate((obs, obst_obs), axis=1)
-
+        moving = np.asarray(set_obstacles, dtype=bool)
+        electron = moving & (self.traj_ids == ELECTRON)
+        gravity = moving & (self.traj_ids == GRAVITY)
+        if np.any(moving & ~(electron | gravity)):
+            raise NotImplementedError()
+
+        # Electron: mimic the force between electrons, F = k*q1*q2 / r^2, here F = r^2, k = 1, q1 = q2 = 1 and m = 1.0
+        acc = np.zeros((self.num_obstacles, 3))
+        if electron.any():
+            goal_central = self.goal_central[electron]
+            force_pos = 2 * goal_central - self.pos[electron]
+            rel_force_goal = force_pos - goal_central
+            force_noise = np.random.uniform(low=-0.5 * rel_force_goal, high=0.5 * rel_force_goal)
+            acc[electron] = force_pos + force_noise - self.pos[electron]
+        acc[gravity, 2] = -GRAV
+
+        self.vel[moving] += self.dt * acc[moving]
+        self.pos[moving] += self.dt * self.vel[moving]
+
+        self.update_obs(obs, quads_pos=quads_pos, quads_vel=quads_vel, set_obstacles=set_obstacles)
         return obs
 
+    def update_obs(self, obs, quads_pos, quads_vel, set_obstacles):
+        """
+        Writes rel_pos, rel_vel, size and shape of every obstacle (OBSTACLE_OBS_SIZE values) into the
+        (num_agents, num_obstacles * OBSTACLE_OBS_SIZE) obs block.
+        The obstacles that are not set are observed in absolute coordinates with obs_mode absolute or half_relative.
+        """
+        obs = obs.reshape(len(quads_pos), self.num_obstacles, OBSTACLE_OBS_SIZE)
+        np.subtract(self.pos[None], quads_pos[:, None], out=obs[:, :, 0:3])
+        np.subtract(self.vel[None], quads_vel[:, None], out=obs[:, :, 3:6])
+        # obst_size: in xyz axis: radius for sphere, half edge length for cube
+        obs[:, :, 6:9] = (self.size / 2)[None, :, None]
+        obs[:, :, 9] = self.shape_ids[None, :]
+
+        if self.obs_mode in ('absolute', 'half_relative'):
+            absolute = ~np.asarray(set_obstacles, dtype=bool)
+            obs[:, absolute, 0:3] = self.pos[absolute]
+            obs[:, absolute, 3:6] = self.vel[absolute]
+            if self.obs_mode == 'absolute':
+                obs[:, absolute, 6:] = 0.
+
     def collision_detection(self, pos_quads=None, set_obstacles=None):
         if set_obstacles is None:
             raise ValueError('set_obstacles is None')
+        set_obstacles = np.asarray(set_obstacles, dtype=bool)
+        if np.any(set_obstacles & ~np.isin(self.shape_ids, (SPHERE, CUBE))):
+            raise NotImplementedError()
 
         # Shape: (num_agents, num_obstacles)
-        collision_matrix = np.zeros((len(pos_quads), self.num_obstacles))
-
-        for i, obstacle in enumerate(self.obstacles):
-            if set_obstacles[i]:
-                col_arr = obstacle.collision_detection(pos_quads=pos_quads)
-                collision_matrix[:, i] = col_arr
-
-        # check which drone collide with obstacle(s)
-        drone_collisions = []
-        all_collisions = []
-        col_w1 = np.where(collision_matrix >= 1)
-        for i, val in enumerate(col_w1[0]):
-            drone_collisions.append(col_w1[0][i])
-            all_collisions.append((col_w1[0][i], col_w1[1][i]))
-
-        obst_positions = np.stack([self.obstacles[i].pos for i in range(self.num_obstacles)])
-        distance_matrix = spatial.distance_matrix(x=pos_quads, y=obst_positions)
-
-        return collision_matrix, drone_collisions, all_collisions, distance_matrix
+        rel_pos = pos_quads[:, None] - self.pos[None]
+        distance_matrix = np.linalg.norm(rel_pos, axis=2)
+
+        # Sphere: distance to the center, cube: sphere vs. AABB
+        # https://developer.mozilla.org/en-US/docs/Games/Techniques/3D_collision_detection
+        half_size = (0.5 * self.size)[None, :, None]
+        closest = np.clip(rel_pos, -half_size, half_size)
+        cube_collisions = np.sum((closest - rel_pos) ** 2, axis=2) < self.quad_size ** 2
+        sphere_collisions = distance_matrix < self.quad_size + 0.5 * self.size
+        collisions = np.where(self.shape_ids == CUBE, cube_collisions, sphere_collisions)
+        collisions &= set_obstacles
+        collision_matrix = collisions.astype(np.float64)
+
+        # (drone, obstacle) pairs in collision
+        all_collisions = np.argwhere(collisions)
+
+        return collision_matrix, all_collisions, distance_matrix
 
     def get_shape_list(self):
         all_shapes = np.array(self.shape_list)
@@ -1,21 +1,27 @@
 import numpy as np
 from numpy.linalg import norm
 from gym_art.quadrotor_multi.quad_utils import *
-import gym_art.quadrotor_multi.rendering3d as r3d
+
+TILES = 256  # number of tiles used for the obstacle map
+
+# kinds of the colliders of the bodies, see rendering3d.SphereCollision, AxisBoxCollision and CapsuleCollision
+SPHERE_COLLIDER, BOX_COLLIDER, CAPSULE_COLLIDER = 0, 1, 2
+
 
 # determine where to put the obstacles such that no two obstacles intersect
 # and compute the list of obstacles to collision check at each 2d tile.
+# The lists are returned in CSR layout (tile_offsets, tile_bodies):
+# the obstacles of the flat tile t are tile_bodies[tile_offsets[t]:tile_offsets[t + 1]]
 def _place_obstacles(np_random, N, box, radius_range, our_radius, tries=5):
 
     t = np.linspace(0, box, TILES+1)[:-1]
     scale = box / float(TILES)
-    x, y = np.meshgrid(t, t)
     pts = np.zeros((N, 2))
-    dist = x + np.inf
+    dist = np.full((TILES, TILES), np.inf)
 
     radii = np_random.uniform(*radius_range, size=N)
     radii = np.sort(radii)[::-1]
-    test_list = [[] for i in range(TILES**2)]
+    tiles, bodies = [], []
 
     for i in range(N):
         rad = radii[i]
@@ -23,30 +29,45 @@ def _place_obstacles(np_random, N, box, radius_range, our_radius, tries=5):
         if len(ok) == 0:
             if tries == 1:
                 print("Warning: only able to place {}/{} obstacles. "
-                    "Increase box, decrease radius, or decrease N.")
-                return pts[:i,:], radii[:i]
+                    "Increase box, decrease radius, or decrease N.".format(i, N))
+                return pts[:i,:], radii[:i], _tiles_csr(tiles, bodies)
             else:
-                return _place_obstacles(N, box, radius_range, tries-1)
-        pt = np.unravel_index(np_random.choice(ok), dist.shape)
-        pt = scale * np.array(pt)
-        d = np.sqrt((x - pt[1])**2 + (y - pt[0])**2) - rad
+                return _place_obstacles(np_random, N, box, radius_range, our_radius, tries-1)
+        pt_tile = np.unravel_index(np_random.choice(ok), dist.shape)
+        pt = scale * np.array(pt_tile)
+
+        # Only the tiles around the obstacle are updated: the radii are sorted in decreasing order, so the tiles
+        # further than 2 * rad from its center never decide where the next obstacles go
+        reach = int(np.ceil((rad + max(rad, 2*our_radius + scale)) / scale)) + 1
+        rows = slice(max(pt_tile[0] - reach, 0), min(pt_tile[0] + reach + 1, TILES))
+        cols = slice(max(pt_tile[1] - reach, 0), min(pt_tile[1] + reach + 1, TILES))
+        d = np.sqrt((t[None, cols] - pt[1])**2 + (t[rows, None] - pt[0])**2) - rad
         # big slop factor for tile size, off-by-one errors, etc
-        for ind1d in np.where(d.flat <= 2*our_radius + scale)[0]:
-            test_list[ind1d].append(i)
-        dist = np.minimum(dist, d)
+        close_rows, close_cols = np.nonzero(d <= 2*our_radius + scale)
+        tiles.append((close_rows + rows.start) * TILES + close_cols + cols.start)
+        bodies.append(np.full(len(close_rows), i))
+        np.minimum(dist[rows, cols], d, out=dist[rows, cols])
         pts[i,:] = pt - box/2.0
 
-    # very coarse to allow for binning bugs
-    test_list = np.array(test_list).reshape((TILES, TILES))
-    #amt_free = sum(len(a) == 0 for a in test_list.flat) / float(test_list.size)
-    #print(amt_free * 100, "pct free space")
-    return pts, radii, test_list
+    return pts, radii, _tiles_csr(tiles, bodies)
+
+
+def _tiles_csr(tiles, bodies):
+    tiles = np.concatenate(tiles).astype(np.int64) if tiles else np.zeros(0, dtype=np.int64)
+    bodies = np.concatenate(bodies).astype(np.int64) if bodies else np.zeros(0, dtype=np.int64)
+    # stable: the obstacles of a tile stay in the order they were placed
+    order = np.argsort(tiles, kind='stable')
+    tile_offsets = np.zeros(TILES**2 + 1, dtype=np.int64)
+    tile_offsets[1:] = np.cumsum(np.bincount(tiles, minlength=TILES**2))
+    return tile_offsets, bodies[order]
 
 
 # generate N obstacles w/ randomized primitive, size, color, TODO texture
 # arena: boundaries of world in xy plane
 # our_radius: quadrotor's radius
 def _random_obstacles(np_random, N, arena, our_radius):
+    import gym_art.quadrotor_multi.rendering3d as r3d
+
     arena = float(arena)
     # all primitives should be tightly bound by unit circle in xy plane
     boxside = np.sqrt(2)
@@ -59,9 +80,9 @@ def _random_obstacles(np_random, N, arena, our_radius):
 
     bodies = []
     max_radius = 2.0
-    positions, radii, test_list = _place_obstacles(
+    positions, radii, tiles = _place_obstacles(
         np_random, N, arena, (0.5, max_radius), our_radius)
-    for i in range(N):
+    for i in range(len(radii)):
         primitive = np_random.choice(primitives)
         tex_type = r3d.random_textype()
         tex_dark = 0.5 * np_random.uniform()
@@ -81,15 +102,48 @@ def _random_obstacles(np_random, N, arena, our_radius):
                 r3d.Color(color, primitive))
         bodies.append(body)
 
-    return ObstacleMap(arena, bodies, test_list)
+    return ObstacleMap(arena, bodies, tiles)
+
+
+def _body_colliders(bodies):
+    """
+    The colliders of the bodies (Transform nodes of a scene graph with a single primitive) as arrays: the inverse
+    transforms (B, 4, 4), the kinds (B,) and the parameters (B, 6) of the colliders in the frames of the primitives,
+    sphere: radius, box: corner0 and corner1, capsule: radius and height.
+    """
+    mat_inv = np.zeros((len(bodies), 4, 4))
+    kinds = np.zeros(len(bodies), dtype=np.int64)
+    params = np.zeros((len(bodies), 6))
+    for k, body in enumerate(bodies):
+        mat_inv[k] = body.mat_inv
+        node = body
+        while not hasattr(node, 'collider'):
+            node = node.children[0] if isinstance(node.children, list) else node.children
+        collider = node.collider
+        if hasattr(collider, 'corner0'):
+            kinds[k] = BOX_COLLIDER
+            params[k] = np.concatenate((collider.corner0, collider.corner1))
+        elif hasattr(collider, 'height'):
+            kinds[k] = CAPSULE_COLLIDER
+            params[k, :2] = collider.radius, collider.height
+        else:
+            kinds[k] = SPHERE_COLLIDER
+            params[k, 0] = collider.radius
+    return mat_inv, kinds, params
 
 
 # main class for non-visual aspects of the obstacle map.
 class ObstacleMap(object):
-    def __init__(self, box, bodies, test_lists):
+    def __init__(self, box, bodies, tiles):
+        """tiles: (tile_offsets, tile_bodies), the obstacles to collision check at each tile, see _place_obstacles()."""
         self.box = box
         self.bodies = bodies
-        self.test = test_lists
+        self.tile_offsets, self.tile_bodies = tiles if tiles is not None else (None, None)
+        self.mat_inv, self.collider_kinds, self.collider_params = _body_colliders(bodies)
+        if self.tile_offsets is not None:
+            self.free_tiles = (np.diff(self.tile_offsets) == 0).reshape((TILES, TILES))
+        else:
+            self.free_tiles = np.ones((TILES, TILES), dtype=bool)
 
     def detect_collision(self, dynamics):
         pos = dynamics.pos
@@ -100,11 +154,45 @@ class ObstacleMap(object):
         if r < 0 or c < 0 or r >= TILES or c >= TILES:
             print("collided with wall")
             return True
-        if self.test is not None:
-            radius = dynamics.arm + 0.1
-            return any(self.bodies[k].collide_sphere(pos, radius)
-                for k in self.test[r,c])
-        return False
+        return bool(self.detect_collisions(pos[None], dynamics.arm)[0])
+
+    def detect_collisions(self, points, arm):
+        """
+        Collisions of the (P, 3) points, drones with the given arm, with the terrain, the walls and the obstacles.
+        The candidate obstacles of all points are gathered from the tiles at once and tested in one batch.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        collided = points[:, 2] <= arm
+        r, c = self.coord2tile(points[:, 0], points[:, 1])
+        inside = (r >= 0) & (c >= 0) & (r < TILES) & (c < TILES)
+        collided |= ~inside
+        if self.tile_offsets is None:
+            return collided
+
+        # candidate (point, body) pairs of the points above the terrain and inside the walls
+        query = np.flatnonzero(~collided)
+        tile = r[query].astype(np.int64) * TILES + c[query]
+        starts, counts = self.tile_offsets[tile], np.diff(self.tile_offsets)[tile]
+        pair_points = np.repeat(query, counts)
+        pair_first = np.repeat(np.cumsum(counts) - counts, counts)
+        pair_bodies = self.tile_bodies[np.repeat(starts, counts) + np.arange(len(pair_points)) - pair_first]
+
+        # the sphere of the drone in the frame of the primitive, as Transform.collide_sphere()
+        radius = arm + 0.1
+        mat_inv = self.mat_inv[pair_bodies]
+        x = np.einsum('kij,kj->ki', mat_inv[:, :3, :3], points[pair_points]) + mat_inv[:, :3, 3]
+        rlocal = radius * mat_inv[:, 0, 0]
+
+        params, kinds = self.collider_params[pair_bodies], self.collider_kinds[pair_bodies]
+        nearest = np.maximum(params[:, 0:3], np.minimum(x, params[:, 3:6]))
+        box_hit = np.sum((x - nearest) ** 2, axis=1) < rlocal ** 2
+        sphere_hit = np.sum(x ** 2, axis=1) < (params[:, 0] + rlocal) ** 2
+        z = np.clip(x[:, 2], 0., params[:, 1])
+        capsule_hit = x[:, 0] ** 2 + x[:, 1] ** 2 + (x[:, 2] - z) ** 2 < (params[:, 0] + rlocal) ** 2
+        hit = np.where(kinds == BOX_COLLIDER, box_hit, np.where(kinds == CAPSULE_COLLIDER, capsule_hit, sphere_hit))
+
+        collided[pair_points[hit]] = True
+        return collided
 
     def sample_start(self, np_random):
         pad = 4
@@ -117,8 +205,7 @@ class ObstacleMap(object):
         return self.sample_freespace((-(pad + band), -pad), np_random)
 
     def sample_freespace(self, rowrange, np_random):
-        rfree, cfree = np.where(np.vectorize(lambda t: len(t) == 0)(
-            self.test[rowrange[0]:rowrange[1],:]))
+        rfree, cfree = np.where(self.free_tiles[rowrange[0]:rowrange[1],:])
         choice = np_random.choice(len(rfree))
         r, c = rfree[choice], cfree[choice]
         r += rowrange[0]
@@ -133,4 +220,4 @@ class ObstacleMap(object):
 
     def coord2tile(self, x, y):
         scale = float(TILES) / self.box
-        return np.int32(scale * (np.array([x,y]) + self.box / 2.0))
\ No newline at end of file
+        return np.int32(scale * (np.array([x,y]) + self.box / 2.0))
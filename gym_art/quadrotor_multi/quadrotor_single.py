@@ -38,6 +38,7 @@ from gym_art.quadrotor_multi.quadrotor_control import *
 from gym_art.quadrotor_multi.quadrotor_visualization import *
 from gym_art.quadrotor_multi.sensor_noise import SensorNoise
 from gym_art.quadrotor_multi.numba_utils import *
+from gym_art.quadrotor_multi.quadrotor_swarm_dynamics import SwarmDynamics, swarm_rot_property, swarm_row_property
 
 # Numba
 from numba import njit
@@ -47,6 +48,10 @@ logger = logging.getLogger(__name__)
 GRAV = 9.81  # default gravitational constant
 EPS = 1e-6  # small constant to avoid divisions by 0 and log(0)
 
+# Content of the info dicts returned by step(): nothing, the reward components, or the reward components plus the
+# observation components and dynamics parameters of get_diagnostics()
+INFO_LEVELS = ('none', 'rewards', 'full')
+
 
 # WARN:
 # - linearity is set to 1 always, by means of check_quad_param_limits().
@@ -66,9 +71,24 @@ class QuadrotorDynamics:
      - x axis between arms looking forward [x - configuration]
      - y axis pointing to the left
      - z axis up
+    State variables (pos, vel, rot, omega, ...) live in a row of a SwarmDynamics object, see swarm_row_property().
+    If no swarm is provided, the dynamics own a single-row swarm.
     TODO:
     - only diagonal inertia is used at the moment
     """
+    pos = swarm_row_property('pos')
+    vel = swarm_row_property('vel')
+    acc = swarm_row_property('acc')
+    accelerometer = swarm_row_property('accelerometer')
+    rot = swarm_rot_property()
+    quat = swarm_row_property('quat')
+    omega = swarm_row_property('omega')
+    omega_dot = swarm_row_property('omega_dot')
+    torque = swarm_row_property('torque')
+    thrust_cmds_damp = swarm_row_property('thrust_cmds_damp')
+    thrust_rot_damp = swarm_row_property('thrust_rot_damp')
+    since_last_svd = swarm_row_property('since_last_svd')
+    room_box = swarm_row_property('room_box')
 
     def __init__(self, model_params,
                  room_box=None,
@@ -76,7 +96,13 @@ class QuadrotorDynamics:
                  dim_mode="3D",
                  gravity=GRAV,
                  dynamics_simplification=False,
-                 use_numba=False):
+                 use_numba=False,
+                 swarm=None,
+                 swarm_idx=0):
+
+        if swarm is None:
+            swarm, swarm_idx = SwarmDynamics(num_agents=1, use_numba=use_numba), 0
+        self.bind_swarm(swarm, swarm_idx)
 
         self.dynamics_steps_num = dynamics_steps_num
         self.dynamics_simplification = dynamics_simplification
@@ -103,6 +129,15 @@ class QuadrotorDynamics:
         self.since_last_svd_limit = 0.5  # in sec - how ofthen mandatory orthogonalization should be applied
 
         self.eye = np.eye(3)
+
+        ## Work buffers written in place by the integrators, same precision as the swarm
+        dtype = self.swarm.dtype
+        self.torques = np.zeros((4, 3), dtype=dtype)  # (props, xyz)
+        self.thrust = np.zeros(3, dtype=dtype)
+        self.rotor_drag_force = np.zeros(3, dtype=dtype)
+        self.motor_tau = np.zeros(4, dtype=dtype)
+        self.rot_K = np.zeros((3, 3), dtype=dtype)
+        self.rot_dRdt = np.zeros((3, 3), dtype=dtype)
         ###############################################################
         ## Initializing model
         self.thrust_noise = None
@@ -138,6 +173,11 @@ class QuadrotorDynamics:
         """
         return (1 - linearity) * w ** 2 + linearity * w
 
+    def bind_swarm(self, swarm, swarm_idx):
+        self.swarm = swarm
+        self.swarm_idx = swarm_idx
+        self._views = swarm.row_views(swarm_idx)
+
     def update_model(self, model_params):
         if self.dynamics_simplification:
             self.model = QuadLinkSimplified(params=model_params["geom"])
@@ -202,14 +242,16 @@ class QuadrotorDynamics:
         self.torque_to_inertia = np.sum(self.torque_to_inertia, axis=1)
         # self.torque_to_inertia = self.torque_to_inertia / np.linalg.norm(self.torque_to_inertia)
 
+        self.swarm.set_params(self.swarm_idx, self)
         self.reset()
 
     def init_thrust_noise(self):
         # sigma = 0.2 gives roughly max noise of -1 .. 1
+        noise_pool = self.swarm.noise_pool
         if self.use_numba:
-            self.thrust_noise = OUNoiseNumba(4, sigma=0.2 * self.thrust_noise_ratio)
+            self.thrust_noise = OUNoiseNumba(4, sigma=0.2 * self.thrust_noise_ratio, noise_pool=noise_pool)
         else:
-            self.thrust_noise = OUNoise(4, sigma=0.2 * self.thrust_noise_ratio)
+            self.thrust_noise = OUNoise(4, sigma=0.2 * self.thrust_noise_ratio, noise_pool=noise_pool)
 
     # pos, vel, in world coords (meters)
     # rotation is 3x3 matrix (body coords) -> (world coords)dt
@@ -264,12 +306,23 @@ class QuadrotorDynamics:
         return pos, vel, rot, omega
 
     def step(self, thrust_cmds, dt):
+        if self.swarm.batch_step:
+            # The owner of the swarm integrates all agents at once, see SwarmDynamics.step()
+            self.swarm.thrust_cmds[self.swarm_idx] = thrust_cmds
+            return
+        if self.swarm.integrator != 'euler':
+            raise NotImplementedError(f'Integrator {self.swarm.integrator} is only supported by the batched swarm step')
+        if self.swarm.attitude != 'rot':
+            raise NotImplementedError(f'Attitude {self.swarm.attitude} is only supported by the batched swarm step')
+
         thrust_noise = self.thrust_noise.noise()
 
         if self.use_numba:
-            [self.step1_numba(thrust_cmds, dt, thrust_noise) for t in range(self.dynamics_steps_num)]
+            for _ in range(self.dynamics_steps_num):
+                self.step1_numba(thrust_cmds, dt, thrust_noise)
         else:
-            [self.step1(thrust_cmds, dt, thrust_noise) for t in range(self.dynamics_steps_num)]
+            for _ in range(self.dynamics_steps_num):
+                self.step1(thrust_cmds, dt, thrust_noise)
 
     ## Step function integrates based on current derivative values (best fits affine dynamics model)
     # thrust_cmds is motor thrusts given in normalized range [0, 1].
@@ -293,9 +346,9 @@ class QuadrotorDynamics:
         # T is a time constant of the first-order filter
         self.motor_tau_up = 4 * dt / (self.motor_damp_time_up + EPS)
         self.motor_tau_down = 4 * dt / (self.motor_damp_time_down + EPS)
-        motor_tau = self.motor_tau_up * np.ones([4, ])
-        motor_tau[thrust_cmds < self.thrust_cmds_damp] = self.motor_tau_down
-        motor_tau[motor_tau > 1.] = 1.
+        motor_tau = self.motor_tau
+        motor_tau.fill(min(self.motor_tau_up, 1.))
+        motor_tau[thrust_cmds < self.thrust_cmds_damp] = min(self.motor_tau_down, 1.)
 
         ## Since NN commands thrusts we need to convert to rot vel and back
         # WARNING: Unfortunately if the linearity != 1 then filtering using square root is not quite correct
@@ -311,7 +364,7 @@ class QuadrotorDynamics:
 
         thrusts = self.thrust_max * self.angvel2thrust(self.thrust_cmds_damp, linearity=self.motor_linearity)
         # Prop crossproduct give torque directions
-        self.torques = self.prop_crossproducts * thrusts[:, None]  # (4,3)=(props, xyz)
+        np.multiply(self.prop_crossproducts, thrusts[:, None], out=self.torques)  # (4,3)=(props, xyz)
 
         # additional torques along z-axis caused by propeller rotations
         self.torques[:, 2] += self.torque_max * self.prop_ccw * self.thrust_cmds_damp
@@ -382,9 +435,16 @@ class QuadrotorDynamics:
         omega_norm = np.linalg.norm(omega_vec)
         if omega_norm != 0:
             # See [7]
-            K = np.array([[0, -wz, wy], [wz, 0, -wx], [-wy, wx, 0]]) / omega_norm
+            K, dRdt = self.rot_K, self.rot_dRdt
+            K[0, 1], K[0, 2], K[1, 0], K[1, 2], K[2, 0], K[2, 1] = -wz, wy, wz, -wx, -wy, wx
+            K /= omega_norm
             rot_angle = omega_norm * dt
-            dRdt = self.eye + np.sin(rot_angle) * K + (1. - np.cos(rot_angle)) * (K @ K)
+            # dRdt = I + sin(angle) * K + (1 - cos(angle)) * K @ K
+            np.matmul(K, K, out=dRdt)
+            dRdt *= 1. - np.cos(rot_angle)
+            dRdt += self.eye
+            K *= np.sin(rot_angle)
+            dRdt += K
             self.rot = dRdt @ self.rot
 
         ## SVD is not strictly required anymore. Performing it rarely, just in case
@@ -446,24 +506,18 @@ class QuadrotorDynamics:
         self.accelerometer = np.matmul(self.rot.T, acc + [0, 0, self.gravity])
 
     def step1_numba(self, thrust_cmds, dt, thrust_noise):
-        self.motor_tau_up, self.motor_tau_down, self.thrust_rot_damp, self.thrust_cmds_damp, self.torques, \
-        self.torque, self.rot, self.since_last_svd, self.omega_dot, self.omega, self.pos, thrust, rotor_drag_force = \
-            calculate_torque_integrate_rotations_and_update_omega(thrust_cmds, dt, EPS, self.motor_damp_time_up, self.motor_damp_time_down,
-                         self.thrust_cmds_damp, self.thrust_rot_damp, thrust_noise, self.thrust_max, self.motor_linearity,
-                         self.prop_crossproducts, self.prop_ccw, self.torque_max, self.rot, np.float64(self.omega),
-                         self.eye, self.since_last_svd, self.since_last_svd_limit, self.inertia,
-                         self.damp_omega_quadratic, self.omega_max, self.pos, self.vel)
-
-        # Clipping if met the obstacle and nullify velocities (not sure what to do about accelerations)
-        self.pos = np.clip(self.pos, a_min=self.room_box[0], a_max=self.room_box[1])
-
-        # Set constant variables up for numba
-        grav_cnst_arr = np.float64([0, 0, -GRAV])
-        sum_thr_drag = thrust + rotor_drag_force
-        grav_arr = np.float64([0, 0, self.gravity])
-        self.vel, self.acc, self.accelerometer = compute_velocity_and_acceleration(self.vel, grav_cnst_arr, self.mass, self.rot,
-                                                                         sum_thr_drag, self.vel_damp, dt, self.rot.T,
-                                                                         grav_arr)
+        # Both kernels work in place on the swarm rows and the work buffers of this object
+        views = self._views
+        calculate_torque_integrate_rotations_and_update_omega(
+            thrust_cmds, dt, EPS, self.motor_damp_time_up, self.motor_damp_time_down, views['thrust_cmds_damp'],
+            views['thrust_rot_damp'], thrust_noise, self.thrust_max, self.motor_linearity, self.prop_crossproducts,
+            self.prop_ccw, self.torque_max, views['rot'], views['omega'], views['since_last_svd'],
+            self.since_last_svd_limit, self.inertia, self.damp_omega_quadratic, self.omega_max, views['pos'],
+            views['vel'], views['room_box'], self.torques, views['torque'], views['omega_dot'], self.thrust)
+
+        compute_velocity_and_acceleration(views['vel'], views['acc'], views['accelerometer'], self.mass,
+                                          views['rot'], self.thrust, self.rotor_drag_force, self.vel_damp, dt, GRAV,
+                                          self.gravity)
 
     def reset(self):
         self.thrust_cmds_damp = np.zeros([4])
@@ -574,12 +628,14 @@ class QuadrotorDynamics:
         copied_dynamics = cls.__new__(cls)
         memo[id(self)] = copied_dynamics
 
-        skip_copying = {"thrust_noise"}
+        skip_copying = {"thrust_noise", "_views"}
 
         for k, v in self.__dict__.items():
             if k not in skip_copying:
                 setattr(copied_dynamics, k, deepcopy(v, memo))
 
+        # Views have to point into the copied swarm arrays
+        copied_dynamics.bind_swarm(copied_dynamics.swarm, copied_dynamics.swarm_idx)
         copied_dynamics.init_thrust_noise()
         return copied_dynamics
 
@@ -712,7 +768,8 @@ class QuadrotorSingle:
                  rew_coeff=None, sense_noise=None, verbose=False, gravity=GRAV,
                  t2w_std=0.005, t2t_std=0.0005, excite=False, dynamics_simplification=False, use_numba=False, swarm_obs='none', num_agents=1,quads_settle=False,
                  quads_settle_range_meters=1.0, quads_vel_reward_out_range=0.8,
-                 view_mode='local', obstacle_mode='no_obstacles', obstacle_num=0, num_use_neighbor_obs=0):
+                 view_mode='local', obstacle_mode='no_obstacles', obstacle_num=0, num_use_neighbor_obs=0,
+                 swarm=None, swarm_idx=0, info_level='rewards'):
         np.seterr(under='ignore')
         """
         Args:
@@ -741,6 +798,10 @@ class QuadrotorSingle:
             rew_coeff: [dict] weights for different reward components (see compute_weighted_reward() function)
             sens_noise (dict or str): sensor noise parameters. If None - no noise. If "default" then the default params are loaded. Otherwise one can provide specific params.
             excite: [bool] change the setpoint at the fixed frequency to perturb the quad
+            swarm: [SwarmDynamics] shared struct-of-arrays state of all quads, the dynamics of this env use its row
+                swarm_idx. If None - the dynamics own their state.
+            info_level: [str] content of the info dicts, see INFO_LEVELS. The diagnostics of the full level are
+                available on demand with get_diagnostics().
         """
         ## ARGS
         self.init_random_state = init_random_state
@@ -758,6 +819,11 @@ class QuadrotorSingle:
         self.obstacles_num = obstacles_num
         self.raw_control = raw_control
         self.use_numba = use_numba
+        self.swarm = swarm
+        self.swarm_idx = swarm_idx
+        if info_level not in INFO_LEVELS:
+            raise ValueError(f'Unknown info level {info_level}, expected one of {list(INFO_LEVELS)}')
+        self.info_level = info_level
         self.update_sense_noise(sense_noise=sense_noise)
         self.gravity = gravity
         self.swarm_obs = swarm_obs
@@ -900,11 +966,15 @@ class QuadrotorSingle:
         self.dynamics.room_box = self.room_box
 
     def update_sense_noise(self, sense_noise):
+        # noisy observations have the precision of the dynamics and share its noise pool
+        dtype = np.float64 if self.swarm is None else self.swarm.dtype
+        noise_pool = None if self.swarm is None else self.swarm.noise_pool
         if isinstance(sense_noise, dict):
-            self.sense_noise = SensorNoise(**sense_noise)
+            self.sense_noise = SensorNoise(dtype=dtype, noise_pool=noise_pool, **sense_noise)
         elif isinstance(sense_noise, str):
             if sense_noise == "default":
-                self.sense_noise = SensorNoise(bypass=False, use_numba=self.use_numba)
+                self.sense_noise = SensorNoise(bypass=False, use_numba=self.use_numba, dtype=dtype,
+                                               noise_pool=noise_pool)
             else:
                 ValueError("ERROR: QuadEnv: sense_noise parameter is of unknown type: " + str(sense_noise))
         elif sense_noise is None:
@@ -921,7 +991,7 @@ class QuadrotorSingle:
                                           dynamics_steps_num=self.sim_steps, room_box=self.room_box,
                                           dim_mode=self.dim_mode,
                                           gravity=self.gravity, dynamics_simplification=self.dynamics_simplification,
-                                          use_numba=self.use_numba)
+                                          use_numba=self.use_numba, swarm=self.swarm, swarm_idx=self.swarm_idx)
 
         if self.verbose:
             print("#################################################")
@@ -1025,6 +1095,11 @@ class QuadrotorSingle:
         return [seed]
 
     def _step(self, action):
+        self._step_control(action)
+        return self._step_post(action)
+
+    def _step_control(self, action):
+        """Converts the action into thrusts. If the swarm is stepped in batch, the thrusts are only recorded."""
         self.actions[1] = copy.deepcopy(self.actions[0])
         self.actions[0] = copy.deepcopy(action)
         # print('actions_norm: ', np.linalg.norm(self.actions[0]-self.actions[1]))
@@ -1040,6 +1115,7 @@ class QuadrotorSingle:
         # self.oracle.step(self.dynamics, self.goal, self.dt)
         # self.scene.update_state(self.dynamics, self.goal)
 
+    def _update_crashed(self):
         if self.obstacles is not None:
             self.crashed = self.obstacles.detect_collision(self.dynamics)
         else:
@@ -1048,34 +1124,57 @@ class QuadrotorSingle:
                                                           np.clip(self.dynamics.pos,
                                                                   a_min=self.room_box[0],
                                                                   a_max=self.room_box[1]))
+        return self.crashed
 
+    def _step_post(self, action, sv=None, reward=None):
+        """
+        Crash detection, reward and observation after the dynamics have been integrated.
+        sv is the observation if it has already been computed for the whole swarm, see QuadrotorEnvMulti.step_envs().
+        reward is given if the crash and the reward have already been computed for the whole swarm, see
+        quad_rewards.compute_rewards_batched().
+        """
         self.time_remain = self.ep_len - self.tick
-        reward, rew_info = compute_reward_weighted(self.dynamics, self.goal, action, self.dt, self.crashed,
-                                                   self.time_remain,
-                                                   rew_coeff=self.rew_coeff, action_prev=self.actions[1], quads_settle=self.quads_settle,
-                                                   quads_settle_range_meters=self.quads_settle_range_meters,
-                                                   quads_vel_reward_out_range=self.quads_vel_reward_out_range
-        )
+        if reward is None:
+            self._update_crashed()
+            reward, rew_info = compute_reward_weighted(self.dynamics, self.goal, action, self.dt, self.crashed,
+                                                       self.time_remain,
+                                                       rew_coeff=self.rew_coeff, action_prev=self.actions[1], quads_settle=self.quads_settle,
+                                                       quads_settle_range_meters=self.quads_settle_range_meters,
+                                                       quads_vel_reward_out_range=self.quads_vel_reward_out_range
+            )
+        else:
+            rew_info = None
         self.tick += 1
         done = self.tick > self.ep_len  # or self.crashed
-        sv = self.state_vector(self)
+        if sv is None:
+            sv = self.state_vector(self)
 
         self.traj_count += int(done)
 
-        ## TODO: OPTIMIZATION: sv_comp should be a dictionary formed when state() function is called
-        sv_comp = np.split(sv, self.obs_comp_end[:-1], axis=0)
+        if rew_info is None or self.info_level == 'none':
+            info = {}
+        else:
+            info = {'rewards': rew_info}
+        if self.info_level == 'full':
+            info.update(self.get_diagnostics())
+        return sv, reward, done, info
+
+    def get_diagnostics(self):
+        """Observation components and dynamics parameters after the last step."""
+        action = self.actions[0]
+        # dynamics state is stored in swarm arrays that are updated in-place, hence the copies
         obs_comp = {
-            "xyz": [self.dynamics.pos],
-            "vxyz": [self.dynamics.vel],
-            "acc": [self.dynamics.accelerometer],
-            "omega": [self.dynamics.omega],
-            "omega_dot": [self.dynamics.omega_dot],  # roll angular acceleration
+            "xyz": [self.dynamics.pos.copy()],
+            "vxyz": [self.dynamics.vel.copy()],
+            "acc": [self.dynamics.accelerometer.copy()],
+            "omega": [self.dynamics.omega.copy()],
+            "omega_dot": [self.dynamics.omega_dot.copy()],  # roll angular acceleration
             "R": [self.dynamics.rot.flatten()],
             "act": [action],
             "act_clipped": [np.clip(self.controller.action, a_min=0., a_max=1.)],
-            "act_filtered": [self.dynamics.thrust_cmds_damp],
+            "act_filtered": [self.dynamics.thrust_cmds_damp.copy()],
             "act_torque": [self.dynamics.prop_ccw * self.dynamics.thrust_cmds_damp],
-            "torque": [self.dynamics.torque],
+            "torque": [self.dynamics.torque.copy()],
             "goal": [self.goal]
         }
 
@@ -1098,8 +1197,7 @@ class QuadrotorSingle:
             "dt": [self.dt * self.sim_steps],
         }
 
-        # print(sv, obs_comp, dyn_params, self.obs_comp_sizes)      
-        return sv, reward, done, {'rewards': rew_info, "obs_comp": obs_comp, "dyn_params": dyn_params}
+        return {"obs_comp": obs_comp, "dyn_params": dyn_params}
 
     def resample_dynamics(self):
         """
@@ -1626,93 +1724,104 @@ def main(argv):
         )
 
 
-@njit
+@njit(cache=True)
 def calculate_torque_integrate_rotations_and_update_omega(thrust_cmds, dt, eps, motor_damp_time_up,
                                                           motor_damp_time_down, thrust_cmds_damp,
                                                           thrust_rot_damp, thr_noise, thrust_max, motor_linearity,
                                                           prop_crossproducts, prop_ccw, torque_max, rot, omega,
-                                                          eye, since_last_svd, since_last_svd_limit, inertia,
-                                                          damp_omega_quadratic, omega_max, pos, vel):
+                                                          since_last_svd, since_last_svd_limit, inertia,
+                                                          damp_omega_quadratic, omega_max, pos, vel, room_box,
+                                                          torques, torque, omega_dot, thrust):
+    """
+    In place: the state arrays (since_last_svd is a 0-d array) and the torques, torque, omega_dot, thrust work buffers
+    are overwritten, nothing is allocated except for the occasional SVD re-orthogonalization.
+    """
     # Filtering the thruster and adding noise
-    thrust_cmds = np.clip(thrust_cmds, 0., 1.)
-    motor_tau_up = 4 * dt / (motor_damp_time_up + eps)
-    motor_tau_down = 4 * dt / (motor_damp_time_down + eps)
-    motor_tau = motor_tau_up * np.ones(4)
-    motor_tau[thrust_cmds < thrust_cmds_damp] = motor_tau_down
-    motor_tau[motor_tau > 1.] = 1.
-
-    # Since NN commands thrusts we need to convert to rot vel and back
-    thrust_rot = thrust_cmds ** 0.5
-    thrust_rot_damp = motor_tau * (thrust_rot - thrust_rot_damp) + thrust_rot_damp
-    thrust_cmds_damp = thrust_rot_damp ** 2
-
-    # Adding noise
-    thrust_noise = thrust_cmds * thr_noise
-    thrust_cmds_damp = np.clip(thrust_cmds_damp + thrust_noise, 0.0, 1.0)
-    thrusts = thrust_max * angvel2thrust_numba(thrust_cmds_damp, motor_linearity)
-
-    # Prop cross-product gives torque directions
-    torques = prop_crossproducts * np.reshape(thrusts, (-1, 1))
-
-    # Additional torques along z-axis caused by propeller rotations
-    torques[:, 2] += torque_max * prop_ccw * thrust_cmds_damp
-
-    # Net torque: sum over propellers
-    thrust_torque = np.sum(torques, 0)
-
-    # Rotor drag and Rolling forces and moments
-    rotor_visc_torque = rotor_drag_force = np.zeros(3)
-
-    # (Square) Damping using torques (in case we would like to add damping using torques)
-    torque = thrust_torque + rotor_visc_torque
-    thrust = np.array([0, 0, np.sum(thrusts)])
+    motor_tau_up = min(4 * dt / (motor_damp_time_up + eps), 1.)
+    motor_tau_down = min(4 * dt / (motor_damp_time_down + eps), 1.)
+
+    thrust_sum = 0.
+    for k in range(4):
+        cmd = min(max(thrust_cmds[k], 0.), 1.)
+        tau = motor_tau_down if cmd < thrust_cmds_damp[k] else motor_tau_up
+        # Since NN commands thrusts we need to convert to rot vel and back
+        thrust_rot_damp[k] = tau * (cmd ** 0.5 - thrust_rot_damp[k]) + thrust_rot_damp[k]
+        thrust_cmds_damp[k] = min(max(thrust_rot_damp[k] ** 2 + cmd * thr_noise[k], 0.), 1.)
+        thrust_k = thrust_max[k] * ((1 - motor_linearity) * thrust_cmds_damp[k] ** 2 +
+                                    motor_linearity * thrust_cmds_damp[k])
+        thrust_sum += thrust_k
+
+        # Prop cross-product gives torque directions
+        for i in range(3):
+            torques[k, i] = prop_crossproducts[k, i] * thrust_k
+        # Additional torques along z-axis caused by propeller rotations
+        torques[k, 2] += torque_max[k] * prop_ccw[k] * thrust_cmds_damp[k]
+
+    # Net torque: sum over propellers, rotor drag and rolling moments are not modelled here
+    for i in range(3):
+        torque[i] = torques[0, i] + torques[1, i] + torques[2, i] + torques[3, i]
+    thrust[0], thrust[1], thrust[2] = 0., 0., thrust_sum
 
     # ROTATIONAL DYNAMICS
     # Integrating rotations (based on current values)
-    omega_vec = rot @ omega
-    wx, wy, wz = omega_vec
-    omega_norm = np.linalg.norm(omega_vec)
+    wx = rot[0, 0] * omega[0] + rot[0, 1] * omega[1] + rot[0, 2] * omega[2]
+    wy = rot[1, 0] * omega[0] + rot[1, 1] * omega[1] + rot[1, 2] * omega[2]
+    wz = rot[2, 0] * omega[0] + rot[2, 1] * omega[1] + rot[2, 2] * omega[2]
+    omega_norm = (wx * wx + wy * wy + wz * wz) ** 0.5
     if omega_norm != 0:
-        K = np.array([[0, -wz, wy], [wz, 0, -wx], [-wy, wx, 0]]) / omega_norm
+        wx, wy, wz = wx / omega_norm, wy / omega_norm, wz / omega_norm
         rot_angle = omega_norm * dt
-        dRdt = eye + np.sin(rot_angle) * K + (1. - np.cos(rot_angle)) * (K @ K)
-        rot = dRdt @ rot
+        s, c = np.sin(rot_angle), 1. - np.cos(rot_angle)
+        # dRdt = I + sin * K + (1 - cos) * K @ K, applied column by column
+        for j in range(3):
+            r0, r1, r2 = rot[0, j], rot[1, j], rot[2, j]
+            rot[0, j] = (1. - c * (wy * wy + wz * wz)) * r0 + (-s * wz + c * wx * wy) * r1 + (s * wy + c * wx * wz) * r2
+            rot[1, j] = (s * wz + c * wx * wy) * r0 + (1. - c * (wx * wx + wz * wz)) * r1 + (-s * wx + c * wy * wz) * r2
+            rot[2, j] = (-s * wy + c * wx * wz) * r0 + (s * wx + c * wy * wz) * r1 + (1. - c * (wx * wx + wy * wy)) * r2
 
     # SVD is not strictly required anymore. Performing it rarely, just in case
-    since_last_svd += dt
-    if since_last_svd > since_last_svd_limit:
-        u, s, v = np.linalg.svd(rot)
-        rot = u @ v
-        since_last_svd = 0
+    since_last_svd[()] += dt
+    if since_last_svd[()] > since_last_svd_limit:
+        u, s_vals, v = np.linalg.svd(rot)
+        rot[:] = u @ v
+        since_last_svd[()] = 0
 
     # COMPUTING OMEGA UPDATE
     # Linear damping
-    omega_dot = ((1.0 / inertia) * (numba_cross(-omega, inertia * omega) + torque))
+    ox, oy, oz = omega[0], omega[1], omega[2]
+    ix, iy, iz = inertia[0] * ox, inertia[1] * oy, inertia[2] * oz
+    omega_dot[0] = (-(oy * iz - oz * iy) + torque[0]) / inertia[0]
+    omega_dot[1] = (-(oz * ix - ox * iz) + torque[1]) / inertia[1]
+    omega_dot[2] = (-(ox * iy - oy * ix) + torque[2]) / inertia[2]
 
     # Quadratic damping
-    omega_damp_quadratic = np.clip(damp_omega_quadratic * omega ** 2, 0.0, 1.0)
-    omega = omega + (1.0 - omega_damp_quadratic) * dt * omega_dot
-    omega = np.clip(omega, -omega_max, omega_max)
-
-    # Computing position
-    pos = pos + dt * vel
+    for i in range(3):
+        omega_damp_quadratic = min(max(damp_omega_quadratic * omega[i] ** 2, 0.0), 1.0)
+        new_omega = omega[i] + (1.0 - omega_damp_quadratic) * dt * omega_dot[i]
+        omega[i] = min(max(new_omega, -omega_max), omega_max)
 
-    return motor_tau_up, motor_tau_down, thrust_rot_damp, thrust_cmds_damp, torques, \
-           torque, rot, since_last_svd, omega_dot, omega, pos, thrust, rotor_drag_force
+    # Computing position, clipping if met the walls
+    for i in range(3):
+        pos[i] = min(max(pos[i] + dt * vel[i], room_box[0, i]), room_box[1, i])
 
 
-@njit
-def compute_velocity_and_acceleration(vel, grav_cnst_arr, mass, rot, sum_thr_drag, vel_damp, dt, rot_tpose,
-                                      grav_arr):
+@njit(cache=True)
+def compute_velocity_and_acceleration(vel, acc, accelerometer, mass, rot, thrust, rotor_drag_force, vel_damp, dt,
+                                      grav, gravity):
+    """In place, vel, acc and accelerometer are overwritten."""
     # Computing accelerations
-    acc = grav_cnst_arr + ((1.0 / mass) * (rot @ sum_thr_drag))
+    for i in range(3):
+        acc[i] = (rot[i, 0] * (thrust[0] + rotor_drag_force[0]) + rot[i, 1] * (thrust[1] + rotor_drag_force[1]) +
+                  rot[i, 2] * (thrust[2] + rotor_drag_force[2])) / mass
+    acc[2] -= grav
 
     # Computing velocities
-    vel = (1.0 - vel_damp) * vel + dt * acc
+    for i in range(3):
+        vel[i] = (1.0 - vel_damp) * vel[i] + dt * acc[i]
 
     # Accelerometer measures so called "proper acceleration" that includes gravity with the opposite sign
-    accm = rot_tpose @ (acc + grav_arr)
-    return vel, acc, accm
+    for i in range(3):
+        accelerometer[i] = rot[0, i] * acc[0] + rot[1, i] * acc[1] + rot[2, i] * (acc[2] + gravity)
 
 
 if __name__ == '__main__':
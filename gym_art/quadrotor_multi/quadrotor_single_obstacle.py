@@ -6,14 +6,56 @@ EPS = 1e-6
 GRAV = 9.81  # default gravitational constant
 TRAJ_LIST = ['gravity', 'electron']
 
+
+def obstacle_row_property(name):
+    """Attribute of SingleObstacle backed by its row of the (num_obstacles, ...) arrays of MultiObstacles."""
+
+    def getter(self):
+        return getattr(self.multi_obstacles, name)[self.idx]
+
+    def setter(self, value):
+        getattr(self.multi_obstacles, name)[self.idx] = value
+
+    return property(getter, setter)
+
+
+def obstacle_id_property(name, values, unresolved):
+    """
+    String attribute of SingleObstacle stored as its index in values. Values that are not in the list, i.e. the
+    'random' shape or the 'mix' trajectory before the first reset, are stored as -1 and read from MultiObstacles.
+    """
+
+    def getter(self):
+        value_id = getattr(self.multi_obstacles, name)[self.idx]
+        return values[value_id] if value_id >= 0 else getattr(self.multi_obstacles, unresolved)
+
+    def setter(self, value):
+        getattr(self.multi_obstacles, name)[self.idx] = values.index(value) if value in values else -1
+
+    return property(getter, setter)
+
+
 class SingleObstacle:
-    def __init__(self, max_init_vel=1., init_box=2.0, mode='no_obstacles', shape='sphere', size=0.0, quad_size=0.04,
-                 dt=0.05, traj='gravity', obs_mode='relative'):
+    """
+    Obstacle idx of a MultiObstacles. The state lives in the arrays of MultiObstacles, which steps, observes and
+    detects collisions with all the obstacles at once. SingleObstacle samples the initial state of an obstacle.
+    """
+    pos = obstacle_row_property('pos')
+    vel = obstacle_row_property('vel')
+    size = obstacle_row_property('size')  # sphere: diameter, cube: edge length
+    goal_central = obstacle_row_property('goal_central')
+    shape = obstacle_id_property('shape_ids', OBSTACLES_SHAPE_LIST, 'shape')
+    tmp_traj = obstacle_id_property('traj_ids', TRAJ_LIST, 'traj')
+
+    def __init__(self, multi_obstacles, idx, max_init_vel=1., init_box=2.0, mode='no_obstacles', shape='sphere',
+                 size=0.0, quad_size=0.04, dt=0.05, traj='gravity', obs_mode='relative'):
+        self.multi_obstacles = multi_obstacles
+        self.idx = idx
         self.max_init_vel = max_init_vel
         self.init_box = init_box  # means the size of initial space that the obstacles spawn at
         self.mode = mode
         self.shape = shape
-        self.size = size  # sphere: diameter, cube: edge length
+        self.size = size
         self.quad_size = quad_size
         self.dt = dt
         self.traj = traj
@@ -25,7 +67,7 @@ class SingleObstacle:
         self.shape_list = OBSTACLES_SHAPE_LIST
         self.obs_mode = obs_mode
 
-    def reset(self, set_obstacle=None, formation_size=0.0, goal_central=np.array([0., 0., 2.]), shape='sphere', quads_pos=None, quads_vel=None):
+    def reset(self, set_obstacle=None, formation_size=0.0, goal_central=np.array([0., 0., 2.]), shape='sphere'):
         if set_obstacle is None:
             raise ValueError('set_obstacle is None')
 
@@ -64,9 +106,6 @@ class SingleObstacle:
             self.pos = np.array([5., 5., -5.])
             self.vel = np.array([0., 0., 0.])
 
-        obs = self.update_obs(quads_pos=quads_pos, quads_vel=quads_vel, set_obstacle=set_obstacle)
-        return obs
-
     def static_obstacle(self):
         pass
 
@@ -162,98 +201,3 @@ class SingleObstacle:
         vel_magn = np.random.uniform(low=0., high=self.max_init_vel)
         vel = vel_magn * vel_direct / (np.linalg.norm(vel_direct) + EPS)
         return vel
-
-    def update_obs(self, quads_pos, quads_vel, set_obstacle):
-        # Add rel_pos, rel_vel, size, shape to obs, shape: num_agents * 10
-        if (not set_obstacle) and self.obs_mode == 'absolute':
-            rel_pos = self.pos - np.zeros((len(quads_pos), 3))
-            rel_vel = self.vel - np.zeros((len(quads_pos), 3))
-            obst_size = np.zeros((len(quads_pos), 3))
-            obst_shape = np.zeros((len(quads_pos), 1))
-        elif (not set_obstacle) and self.obs_mode == 'half_relative':
-            rel_pos = self.pos - np.zeros((len(quads_pos), 3))
-            rel_vel = self.vel - np.zeros((len(quads_pos), 3))
-            obst_size = (self.size / 2) * np.ones((len(quads_pos), 3))
-            obst_shape = self.shape_list.index(self.shape) * np.ones((len(quads_pos), 1))
-        else:  # False, relative; True
-            rel_pos = self.pos - quads_pos
-            rel_vel = self.vel - quads_vel
-            # obst_size: in xyz axis: radius for sphere, half edge length for cube
-            obst_size = (self.size / 2) * np.ones((len(quads_pos), 3))
-            obst_shape = self.shape_list.index(self.shape) * np.ones((len(quads_pos), 1))
-
-        obs = np.concatenate((rel_pos, rel_vel, obst_size, obst_shape), axis=1)
-
-        return obs
-
-    def step(self, quads_pos=None, quads_vel=None, set_obstacle=None):
-        if set_obstacle is None:
-            raise ValueError('set_obstacle is None')
-
-        if not set_obstacle:
-            obs = self.update_obs(quads_pos=quads_pos, quads_vel=quads_vel, set_obstacle=set_obstacle)
-            return obs
-
-        if self.tmp_traj == 'electron':
-            obs = self.step_electron(quads_pos=quads_pos, quads_vel=quads_vel, set_obstacle=set_obstacle)
-            return obs
-        elif self.tmp_traj == 'gravity':
-            obs = self.step_gravity(quads_pos=quads_pos, quads_vel=quads_vel, set_obstacle=set_obstacle)
-            return obs
-        else:
-            raise NotImplementedError()
-
-    def step_electron(self, quads_pos, quads_vel, set_obstacle):
-        # Generate force, mimic force between electron, F = k*q1*q2 / r^2,
-        # Here, F = r^2, k = 1, q1 = q2 = 1
-        force_pos = 2 * self.goal_central - self.pos
-        rel_force_goal = force_pos - self.goal_central
-        force_noise = np.random.uniform(low=-0.5 * rel_force_goal, high=0.5 * rel_force_goal)
-        force_pos = force_pos + force_noise
-        rel_force_obstacle = force_pos - self.pos
-
-        force = rel_force_obstacle
-        # Calculate acceleration, F = ma, here, m = 1.0
-        acc = force
-        # Calculate position and velocity
-        self.vel += self.dt * acc
-        self.pos += self.dt * self.vel
-
-        obs = self.update_obs(quads_pos=quads_pos, quads_vel=quads_vel, set_obstacle=set_obstacle)
-        return obs
-
-    def step_gravity(self, quads_pos, quads_vel, set_obstacle):
-        acc = np.array([0., 0., -GRAV])  # 9.81
-        # Calculate velocity
-        self.vel += self.dt * acc
-        self.pos += self.dt * self.vel
-
-        obs = self.update_obs(quads_pos=quads_pos, quads_vel=quads_vel, set_obstacle=set_obstacle)
-        return obs
-
-    def cube_detection(self, pos_quads=None):
-        # https://developer.mozilla.org/en-US/docs/Games/Techniques/3D_collision_detection
-        # Sphere vs. AABB
-        collision_arr = np.zeros(len(pos_quads))
-        for i, pos_quad in enumerate(pos_quads):
-            rel_pos = np.maximum(self.pos - 0.5 * self.size, np.minimum(pos_quad, self.pos + 0.5 * self.size))
-            distance = np.dot(rel_pos - pos_quad, rel_pos - pos_quad)
-            if distance < self.quad_size ** 2:
-                collision_arr[i] = 1.0
-
-        return collision_arr
-
-    def sphere_detection(self, pos_quads=None):
-        dist = np.linalg.norm(pos_quads - self.pos, axis=1)
-        collision_arr = (dist < (self.quad_size + 0.5 * self.size)).astype(np.float32)
-        return collision_arr
-
-    def collision_detection(self, pos_quads=None):
-        if self.shape == 'cube':
-            collision_arr = self.cube_detection(pos_quads)
-        elif self.shape == 'sphere':
-            collision_arr = self.sphere_detection(pos_quads)
-        else:
-            raise NotImplementedError()
-
-        return collision_arr
@@ -0,0 +1,624 @@
+"""
+Struct-of-arrays storage and integration of the dynamics of a whole swarm.
+
+Every QuadrotorDynamics object is a thin view onto one row of a SwarmDynamics instance: its pos/vel/rot/omega/...
+attributes are numpy views into the (N, 3) / (N, 3, 3) / (N, 4) swarm arrays. This allows QuadrotorEnvMulti to advance
+all agents with a single vectorized (or njit) call instead of stepping N tiny per-agent integrators from Python.
+"""
+import copy
+
+import numpy as np
+from numba import njit, prange
+
+from gym_art.quadrotor_multi.numba_utils import njit_variant, ou_noise_rows_step_numba, set_numba_threads
+from gym_art.quadrotor_multi.sensor_noise import rot2quat
+
+GRAV = 9.81  # default gravitational constant
+EPS = 1e-6  # small constant to avoid divisions by 0 and log(0)
+
+# Integration schemes of the numba kernels, the values are passed to quad_step_numba()
+INTEGRATORS = {'euler': 0, 'semi_implicit': 1, 'rk4': 2}
+
+# Attitude representations of the numba kernels: rotation matrices re-orthogonalized with an SVD every
+# since_last_svd_limit seconds, or unit quaternions (w, x, y, z) renormalized every step
+ATTITUDES = ('rot', 'quat')
+
+# Floating point types of the state and parameter arrays. The kernels compute in float64 registers either way,
+# float32 halves the memory traffic of the swarm arrays, observations and distance matrices
+PRECISIONS = ('float64', 'float32')
+
+# Per-agent state, (name, shape of a single row, initial value)
+SWARM_STATE_FIELDS = (
+    ('pos', (3,), 0.),
+    ('vel', (3,), 0.),
+    ('acc', (3,), 0.),
+    ('accelerometer', (3,), 0.),
+    ('rot', (3, 3), 0.),
+    ('quat', (4,), 0.),
+    ('omega', (3,), 0.),
+    ('omega_dot', (3,), 0.),
+    ('torque', (3,), 0.),
+    ('thrust_cmds_damp', (4,), 0.),
+    ('thrust_rot_damp', (4,), 0.),
+    ('since_last_svd', (), 0.),
+    ('room_box', (2, 3), 0.),
+)
+
+# Per-agent model parameters, pushed by QuadrotorDynamics.update_model()
+SWARM_PARAM_FIELDS = (
+    ('mass', ()),
+    ('inertia', (3,)),
+    ('thrust_max', (4,)),
+    ('torque_max', (4,)),
+    ('prop_crossproducts', (4, 3)),
+    ('prop_ccw', (4,)),
+    ('motor_linearity', ()),
+    ('motor_damp_time_up', ()),
+    ('motor_damp_time_down', ()),
+    ('vel_damp', ()),
+    ('damp_omega_quadratic', ()),
+    ('omega_max', ()),
+    ('gravity', ()),
+    ('since_last_svd_limit', ()),
+    ('C_rot_drag', ()),
+    ('C_rot_roll', ()),
+)
+
+
+def swarm_row_property(name):
+    """
+    Attribute of QuadrotorDynamics backed by its row of the swarm state arrays.
+    Assignments copy the value into the row, so the swarm arrays are never re-allocated.
+    """
+
+    def getter(self):
+        view = self._views[name]
+        return view[()] if view.ndim == 0 else view
+
+    def setter(self, value):
+        self._views[name][...] = value
+
+    return property(getter, setter)
+
+
+def swarm_rot_property():
+    """
+    swarm_row_property('rot') that supports the quaternion attitude of the swarm: reading materializes the rotation
+    matrices (see SwarmDynamics.sync_rot()), assigning also updates the quaternion.
+    """
+
+    def getter(self):
+        self.swarm.sync_rot()
+        return self._views['rot']
+
+    def setter(self, value):
+        self._views['rot'][...] = value
+        self.swarm.rot_assigned(self.swarm_idx)
+
+    return property(getter, setter)
+
+
+class SwarmDynamics:
+    """
+    Contiguous state of N quadrotors plus a batched integrator.
+    The integration scheme is the same as QuadrotorDynamics.step1_numba(), i.e. rotor drag and rolling moments are
+    not modelled. For agents with non-zero C_drag/C_roll the per-agent QuadrotorDynamics.step1() has to be used.
+    use_numba='parallel' integrates the agents on num_threads numba threads (all available threads if None).
+    integrator selects the numba integration scheme, see INTEGRATORS and quad_step_numba().
+    attitude='quat' integrates the attitude as quaternions. The rot matrices are then only materialized by
+    sync_rot(), i.e. when QuadrotorDynamics.rot is read (observations, rewards, rendering).
+    precision='float32' stores all arrays in single precision, see PRECISIONS.
+    noise_pool is an optional NoisePool for the thrust noise, the sensor noise of the agents draws from it as well.
+    """
+
+    def __init__(self, num_agents, use_numba=False, num_threads=None, integrator='euler', attitude='rot',
+                 precision='float64', noise_pool=None):
+        if integrator not in INTEGRATORS:
+            raise ValueError(f'Unknown integrator {integrator}, expected one of {list(INTEGRATORS)}')
+        if integrator != 'euler' and not use_numba:
+            raise ValueError(f'Integrator {integrator} requires use_numba')
+        if attitude not in ATTITUDES:
+            raise ValueError(f'Unknown attitude representation {attitude}, expected one of {list(ATTITUDES)}')
+        if attitude != 'rot' and not use_numba:
+            raise ValueError(f'Attitude representation {attitude} requires use_numba')
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unknown precision {precision}, expected one of {list(PRECISIONS)}')
+
+        self.num_agents = num_agents
+        self.use_numba = use_numba
+        self.num_threads = num_threads
+        self.integrator = integrator
+        self.attitude = attitude
+        self.dtype = np.dtype(precision)
+
+        for name, shape, value in SWARM_STATE_FIELDS:
+            setattr(self, name, np.full((num_agents,) + shape, value, dtype=self.dtype))
+        self.rot[:] = np.eye(3)
+        self.quat[:, 0] = 1.
+        # With attitude='quat', True if the quaternions have been integrated since rot was last materialized.
+        # Sub-swarms share the flag (and the conversion) of the swarm they were cut from
+        self.rot_stale = False
+        self._root = self
+        self.accelerometer[:, 2] = GRAV
+
+        for name, shape in SWARM_PARAM_FIELDS:
+            setattr(self, name, np.zeros((num_agents,) + shape, dtype=self.dtype))
+
+        # Ornstein-Uhlenbeck thrust noise, one process per motor
+        self.thrust_noise = np.zeros((num_agents, 4), dtype=self.dtype)
+        self.thrust_noise_sigma = np.zeros(num_agents, dtype=self.dtype)
+        self.thrust_noise_theta = 0.15
+        # Shared with the sub-swarms
+        self.noise_pool = noise_pool
+
+        # Thrust commands written by QuadrotorDynamics.step() while batch_step is enabled
+        self.thrust_cmds = np.zeros((num_agents, 4), dtype=self.dtype)
+        # If True, QuadrotorDynamics.step() only records the thrust commands and the owner of the swarm is expected to
+        # call SwarmDynamics.step() to advance all agents at once
+        self.batch_step = False
+
+    def sub_swarm(self, start, num_agents):
+        """Swarm of the agents start .. start + num_agents, its arrays are views into the arrays of this swarm."""
+        sub = copy.copy(self)
+        sub.num_agents = num_agents
+        sub.batch_step = False
+        for name in self._array_names():
+            setattr(sub, name, getattr(self, name)[start:start + num_agents])
+        return sub
+
+    @staticmethod
+    def _array_names():
+        return [name for name, _, _ in SWARM_STATE_FIELDS] + [name for name, _ in SWARM_PARAM_FIELDS] + \
+            ['thrust_noise', 'thrust_noise_sigma', 'thrust_cmds']
+
+    def row_views(self, idx):
+        """Views into the state arrays of a single agent, writing into them modifies the swarm state."""
+        return {name: getattr(self, name)[idx, ...] for name, _, _ in SWARM_STATE_FIELDS}
+
+    def set_params(self, idx, dynamics):
+        """Copy model parameters of a single agent into the swarm arrays."""
+        for name, _ in SWARM_PARAM_FIELDS:
+            getattr(self, name)[idx] = getattr(dynamics, name)
+
+        self.thrust_noise_sigma[idx] = 0.2 * dynamics.thrust_noise_ratio
+        self.thrust_noise[idx] = 0.
+
+    def sync_rot(self):
+        """Materialize the rotation matrices of all agents from the quaternions if they are out of date."""
+        root = self._root
+        if root.rot_stale:
+            quat_to_rot_rows_numba(root.quat, root.rot)
+            root.rot_stale = False
+
+    def rot_assigned(self, idx):
+        """Keep the quaternion of agent idx in sync after its rotation matrix has been assigned."""
+        if self.attitude == 'quat':
+            self.quat[idx] = rot2quat(self.rot[idx])
+
+    def supports_batch_step(self):
+        return not (np.any(self.C_rot_drag) or np.any(self.C_rot_roll))
+
+    def thrust_noise_step(self):
+        # sigma = 0.2 * thrust_noise_ratio gives roughly max noise of -1 .. 1, see QuadrotorDynamics.init_thrust_noise()
+        if self.noise_pool is not None:
+            normals = self.noise_pool.normal((self.num_agents, 4))
+        elif self.use_numba:
+            return ou_noise_rows_step_numba(self.thrust_noise, self.thrust_noise_theta, self.thrust_noise_sigma)
+        else:
+            normals = np.random.randn(self.num_agents, 4)
+        self.thrust_noise += -self.thrust_noise_theta * self.thrust_noise + self.thrust_noise_sigma[:, None] * normals
+        return self.thrust_noise
+
+    def step(self, dt, steps_num=1, thrust_cmds=None, thrust_noise=None):
+        """
+        Advance all agents by steps_num simulation steps of length dt.
+        As in QuadrotorDynamics.step(), the thrust noise is sampled once and shared between the simulation steps.
+        """
+        if thrust_cmds is None:
+            thrust_cmds = self.thrust_cmds
+        if thrust_noise is None:
+            thrust_noise = self.thrust_noise_step()
+
+        if self.use_numba:
+            step_func = swarm_step_numba
+            if self.use_numba == 'parallel':
+                set_numba_threads(self.num_threads)
+                step_func = swarm_step_numba_parallel
+            use_quat = self.attitude == 'quat'
+            step_func(
+                thrust_cmds, thrust_noise, dt, steps_num, INTEGRATORS[self.integrator], use_quat, EPS, GRAV,
+                self.pos, self.vel, self.acc, self.accelerometer, self.rot, self.quat, self.omega, self.omega_dot,
+                self.torque,
+                self.thrust_cmds_damp, self.thrust_rot_damp, self.since_last_svd, self.room_box,
+                self.mass, self.inertia, self.thrust_max, self.torque_max, self.prop_crossproducts, self.prop_ccw,
+                self.motor_linearity, self.motor_damp_time_up, self.motor_damp_time_down, self.vel_damp,
+                self.damp_omega_quadratic, self.omega_max, self.gravity, self.since_last_svd_limit,
+            )
+            if use_quat:
+                self._root.rot_stale = True
+        else:
+            for _ in range(steps_num):
+                self.step1(thrust_cmds, dt, thrust_noise)
+
+    def step1(self, thrust_cmds, dt, thrust_noise):
+        """Vectorized numpy version of QuadrotorDynamics.step1() for the whole swarm (without rotor drag)."""
+        ###################################
+        ## Filtering the thruster and adding noise
+        thrust_cmds = np.clip(thrust_cmds, a_min=0., a_max=1.)
+        motor_tau_up = 4 * dt / (self.motor_damp_time_up + EPS)
+        motor_tau_down = 4 * dt / (self.motor_damp_time_down + EPS)
+        motor_tau = np.where(thrust_cmds < self.thrust_cmds_damp, motor_tau_down[:, None], motor_tau_up[:, None])
+        motor_tau = np.minimum(motor_tau, 1.)
+
+        thrust_rot = thrust_cmds ** 0.5
+        self.thrust_rot_damp[:] = motor_tau * (thrust_rot - self.thrust_rot_damp) + self.thrust_rot_damp
+        self.thrust_cmds_damp[:] = np.clip(self.thrust_rot_damp ** 2 + thrust_cmds * thrust_noise, 0.0, 1.0)
+
+        linearity = self.motor_linearity[:, None]
+        thrusts = self.thrust_max * ((1 - linearity) * self.thrust_cmds_damp ** 2 + linearity * self.thrust_cmds_damp)
+        # Net torque: prop crossproducts give torque directions, plus z-torques caused by propeller rotations
+        self.torque[:] = np.einsum('nk,nkj->nj', thrusts, self.prop_crossproducts)
+        self.torque[:, 2] += np.sum(self.torque_max * self.prop_ccw * self.thrust_cmds_damp, axis=1)
+        thrust_sum = np.sum(thrusts, axis=1)
+
+        #########################################################
+        ## ROTATIONAL DYNAMICS
+        omega_vec = np.einsum('nij,nj->ni', self.rot, self.omega)  # Change from body2world frame
+        omega_norm = np.linalg.norm(omega_vec, axis=1)
+        rotating = omega_norm != 0
+        if np.any(rotating):
+            # Rodrigues' rotation formula, see quadrotor_single.py [7]
+            w = omega_vec[rotating] / omega_norm[rotating, None]
+            K = np.zeros((len(w), 3, 3))
+            K[:, 0, 1], K[:, 0, 2] = -w[:, 2], w[:, 1]
+            K[:, 1, 0], K[:, 1, 2] = w[:, 2], -w[:, 0]
+            K[:, 2, 0], K[:, 2, 1] = -w[:, 1], w[:, 0]
+            rot_angle = omega_norm[rotating] * dt
+            dRdt = np.eye(3) + np.sin(rot_angle)[:, None, None] * K + \
+                (1. - np.cos(rot_angle))[:, None, None] * (K @ K)
+            self.rot[rotating] = dRdt @ self.rot[rotating]
+
+        ## SVD is not strictly required anymore. Performing it rarely, just in case
+        self.since_last_svd += dt
+        svd_mask = self.since_last_svd > self.since_last_svd_limit
+        if np.any(svd_mask):
+            u, s, v = np.linalg.svd(self.rot[svd_mask])
+            self.rot[svd_mask] = u @ v
+            self.since_last_svd[svd_mask] = 0
+
+        ## Computing omega update with quadratic damping
+        inertia_omega = self.inertia * self.omega
+        self.omega_dot[:] = (1.0 / self.inertia) * (np.cross(-self.omega, inertia_omega) + self.torque)
+        omega_damp_quadratic = np.clip(self.damp_omega_quadratic[:, None] * self.omega ** 2, a_min=0.0, a_max=1.0)
+        self.omega += (1.0 - omega_damp_quadratic) * dt * self.omega_dot
+        np.clip(self.omega, a_min=-self.omega_max[:, None], a_max=self.omega_max[:, None], out=self.omega)
+
+        #########################################################
+        # TRANSLATIONAL DYNAMICS
+        self.pos += dt * self.vel
+        np.clip(self.pos, a_min=self.room_box[:, 0], a_max=self.room_box[:, 1], out=self.pos)
+
+        # rot @ [0, 0, thrust_sum] is the third column of rot scaled by the total thrust
+        self.acc[:] = (thrust_sum / self.mass)[:, None] * self.rot[:, :, 2]
+        self.acc[:, 2] -= GRAV
+        self.vel[:] = (1.0 - self.vel_damp)[:, None] * self.vel + dt * self.acc
+
+        ## Accelerometer measures so called "proper acceleration" that includes gravity with the opposite sign
+        proper_acc = self.acc.copy()
+        proper_acc[:, 2] += self.gravity
+        self.accelerometer[:] = np.einsum('nji,nj->ni', self.rot, proper_acc)
+
+
+@njit(nogil=True, cache=True)
+def rotate_exp_map_numba(rot, n, ox, oy, oz, dt):
+    """rot[n] = rot[n] @ exp(dt * skew(omega)) for a body frame omega, i.e. Rodrigues' formula in the world frame."""
+    wx = rot[n, 0, 0] * ox + rot[n, 0, 1] * oy + rot[n, 0, 2] * oz
+    wy = rot[n, 1, 0] * ox + rot[n, 1, 1] * oy + rot[n, 1, 2] * oz
+    wz = rot[n, 2, 0] * ox + rot[n, 2, 1] * oy + rot[n, 2, 2] * oz
+    omega_norm = (wx * wx + wy * wy + wz * wz) ** 0.5
+    if omega_norm != 0:
+        wx, wy, wz = wx / omega_norm, wy / omega_norm, wz / omega_norm
+        rot_angle = omega_norm * dt
+        s, c = np.sin(rot_angle), 1. - np.cos(rot_angle)
+        # dR = I + sin * K + (1 - cos) * K @ K, K = skew(w)
+        d00, d01, d02 = 1. - c * (wy * wy + wz * wz), -s * wz + c * wx * wy, s * wy + c * wx * wz
+        d10, d11, d12 = s * wz + c * wx * wy, 1. - c * (wx * wx + wz * wz), -s * wx + c * wy * wz
+        d20, d21, d22 = -s * wy + c * wx * wz, s * wx + c * wy * wz, 1. - c * (wx * wx + wy * wy)
+        # rot = dR @ rot, column by column
+        for j in range(3):
+            r0, r1, r2 = rot[n, 0, j], rot[n, 1, j], rot[n, 2, j]
+            rot[n, 0, j] = d00 * r0 + d01 * r1 + d02 * r2
+            rot[n, 1, j] = d10 * r0 + d11 * r1 + d12 * r2
+            rot[n, 2, j] = d20 * r0 + d21 * r1 + d22 * r2
+
+
+@njit(nogil=True, cache=True)
+def orthogonalize_numba(rot, n, since_last_svd, since_last_svd_limit, dt):
+    # SVD is not strictly required anymore. Performing it rarely, just in case
+    since_last_svd[n] += dt
+    if since_last_svd[n] > since_last_svd_limit[n]:
+        u, s_vals, v = np.linalg.svd(rot[n])
+        rot[n] = u @ v
+        since_last_svd[n] = 0
+
+
+@njit(nogil=True, cache=True)
+def quat_rotated_numba(quat, n, ox, oy, oz, dt):
+    """quat[n] * exp(dt * omega / 2) for a body frame omega, the quaternion form of rotate_exp_map_numba()."""
+    w, x, y, z = quat[n, 0], quat[n, 1], quat[n, 2], quat[n, 3]
+    omega_norm = (ox * ox + oy * oy + oz * oz) ** 0.5
+    if omega_norm == 0:
+        return w, x, y, z
+    half_angle = 0.5 * omega_norm * dt
+    c, s = np.cos(half_angle), np.sin(half_angle) / omega_norm
+    rx, ry, rz = s * ox, s * oy, s * oz
+    return w * c - x * rx - y * ry - z * rz, \
+        w * rx + x * c + y * rz - z * ry, \
+        w * ry - x * rz + y * c + z * rx, \
+        w * rz + x * ry - y * rx + z * c
+
+
+@njit(nogil=True, cache=True)
+def quat_to_rot_numba(quat, rot, n):
+    """rot[n] = rotation matrix of the unit quaternion quat[n], see quad_utils.quat2R()."""
+    w, x, y, z = quat[n, 0], quat[n, 1], quat[n, 2], quat[n, 3]
+    rot[n, 0, 0], rot[n, 0, 1], rot[n, 0, 2] = 1. - 2. * (y * y + z * z), 2. * (x * y - w * z), 2. * (x * z + w * y)
+    rot[n, 1, 0], rot[n, 1, 1], rot[n, 1, 2] = 2. * (x * y + w * z), 1. - 2. * (x * x + z * z), 2. * (y * z - w * x)
+    rot[n, 2, 0], rot[n, 2, 1], rot[n, 2, 2] = 2. * (x * z - w * y), 2. * (y * z + w * x), 1. - 2. * (x * x + y * y)
+
+
+@njit(nogil=True, cache=True)
+def quat_to_rot_rows_numba(quat, rot):
+    for n in range(quat.shape[0]):
+        quat_to_rot_numba(quat, rot, n)
+
+
+@njit(nogil=True, cache=True)
+def update_attitude_numba(rot, quat, use_quat, n, ox, oy, oz, dt, since_last_svd, since_last_svd_limit):
+    """
+    Rotate the attitude of agent n by the body rates omega over dt. Quaternions are renormalized every step,
+    which is much cheaper than the periodic SVD of the rotation matrix.
+    """
+    if use_quat:
+        w, x, y, z = quat_rotated_numba(quat, n, ox, oy, oz, dt)
+        norm = (w * w + x * x + y * y + z * z) ** 0.5
+        quat[n, 0], quat[n, 1], quat[n, 2], quat[n, 3] = w / norm, x / norm, y / norm, z / norm
+    else:
+        rotate_exp_map_numba(rot, n, ox, oy, oz, dt)
+        orthogonalize_numba(rot, n, since_last_svd, since_last_svd_limit, dt)
+
+
+@njit(nogil=True, cache=True)
+def thrust_axis_numba(rot, quat, use_quat, n):
+    """Body z axis of agent n in the world frame, i.e. the third column of its rotation matrix."""
+    if use_quat:
+        w, x, y, z = quat[n, 0], quat[n, 1], quat[n, 2], quat[n, 3]
+        return 2. * (x * z + w * y), 2. * (y * z - w * x), 1. - 2. * (x * x + y * y)
+    return rot[n, 0, 2], rot[n, 1, 2], rot[n, 2, 2]
+
+
+@njit(nogil=True, cache=True)
+def to_body_frame_numba(rot, quat, use_quat, n, vx, vy, vz):
+    """rot[n].T @ v for a world frame vector v."""
+    if use_quat:
+        w, x, y, z = quat[n, 0], quat[n, 1], quat[n, 2], quat[n, 3]
+        return (1. - 2. * (y * y + z * z)) * vx + 2. * (x * y + w * z) * vy + 2. * (x * z - w * y) * vz, \
+            2. * (x * y - w * z) * vx + (1. - 2. * (x * x + z * z)) * vy + 2. * (y * z + w * x) * vz, \
+            2. * (x * z + w * y) * vx + 2. * (y * z - w * x) * vy + (1. - 2. * (x * x + y * y)) * vz
+    return rot[n, 0, 0] * vx + rot[n, 1, 0] * vy + rot[n, 2, 0] * vz, \
+        rot[n, 0, 1] * vx + rot[n, 1, 1] * vy + rot[n, 2, 1] * vz, \
+        rot[n, 0, 2] * vx + rot[n, 1, 2] * vy + rot[n, 2, 2] * vz
+
+
+@njit(nogil=True, cache=True)
+def rotated_thrust_axis_numba(rot, quat, use_quat, n, ox, oy, oz, dt):
+    """Third column of rot[n] @ exp(dt * skew(omega)), without forming the rotation (Rodrigues' formula for e_z)."""
+    if use_quat:
+        w, x, y, z = quat_rotated_numba(quat, n, ox, oy, oz, dt)
+        return 2. * (x * z + w * y), 2. * (y * z - w * x), 1. - 2. * (x * x + y * y)
+    omega_norm = (ox * ox + oy * oy + oz * oz) ** 0.5
+    if omega_norm == 0:
+        return rot[n, 0, 2], rot[n, 1, 2], rot[n, 2, 2]
+    kx, ky, kz = ox / omega_norm, oy / omega_norm, oz / omega_norm
+    s, c = np.sin(omega_norm * dt), 1. - np.cos(omega_norm * dt)
+    # e_z * cos + (k x e_z) * sin + k * k_z * (1 - cos), in the body frame
+    vx, vy, vz = ky * s + kx * kz * c, -kx * s + ky * kz * c, 1. - c + kz * kz * c
+    return rot[n, 0, 0] * vx + rot[n, 0, 1] * vy + rot[n, 0, 2] * vz, \
+        rot[n, 1, 0] * vx + rot[n, 1, 1] * vy + rot[n, 1, 2] * vz, \
+        rot[n, 2, 0] * vx + rot[n, 2, 1] * vy + rot[n, 2, 2] * vz
+
+
+@njit(nogil=True, cache=True)
+def omega_dot_numba(inertia, n, ox, oy, oz, tx, ty, tz):
+    """Euler's rotation equation, I^-1 (-omega x I omega + torque)."""
+    ix, iy, iz = inertia[n, 0] * ox, inertia[n, 1] * oy, inertia[n, 2] * oz
+    return (-(oy * iz - oz * iy) + tx) / inertia[n, 0], \
+        (-(oz * ix - ox * iz) + ty) / inertia[n, 1], \
+        (-(ox * iy - oy * ix) + tz) / inertia[n, 2]
+
+
+@njit(nogil=True, cache=True)
+def motor_wrench_numba(n, t, update, thrust_cmds, thrust_noise, thrust_cmds_damp, thrust_rot_damp, eps,
+                       mass, thrust_max, torque_max, prop_crossproducts, prop_ccw,
+                       motor_linearity, motor_damp_time_up, motor_damp_time_down):
+    """
+    Torque and thrust acceleration of agent n after the motors have been tracking the commands for t seconds.
+    Exact solution of the first order motor model the Euler scheme discretizes with 4 * dt / damp_time,
+    written back to thrust_rot_damp / thrust_cmds_damp if update.
+    """
+    lin = motor_linearity[n]
+    tx, ty, tz, thrust_sum = 0., 0., 0., 0.
+    for k in range(4):
+        cmd = min(max(thrust_cmds[n, k], 0.), 1.)
+        damp_time = motor_damp_time_down[n] if cmd < thrust_cmds_damp[n, k] else motor_damp_time_up[n]
+        rot_damp = cmd ** 0.5 + (thrust_rot_damp[n, k] - cmd ** 0.5) * np.exp(-4 * t / (damp_time + eps))
+        cmd_damp = min(max(rot_damp ** 2 + cmd * thrust_noise[n, k], 0.), 1.)
+        if update:
+            thrust_rot_damp[n, k] = rot_damp
+            thrust_cmds_damp[n, k] = cmd_damp
+
+        thrust = thrust_max[n, k] * ((1 - lin) * cmd_damp ** 2 + lin * cmd_damp)
+        tx += prop_crossproducts[n, k, 0] * thrust
+        ty += prop_crossproducts[n, k, 1] * thrust
+        tz += prop_crossproducts[n, k, 2] * thrust + torque_max[n, k] * prop_ccw[n, k] * cmd_damp
+        thrust_sum += thrust
+    return tx, ty, tz, thrust_sum / mass[n]
+
+
+@njit(nogil=True, cache=True)
+def quad_step_numba(n, thrust_cmds, thrust_noise, dt, steps_num, integrator, use_quat, eps, grav,
+                    pos, vel, acc, accelerometer, rot, quat, omega, omega_dot, torque,
+                    thrust_cmds_damp, thrust_rot_damp, since_last_svd, room_box,
+                    mass, inertia, thrust_max, torque_max, prop_crossproducts, prop_ccw,
+                    motor_linearity, motor_damp_time_up, motor_damp_time_down, vel_damp,
+                    damp_omega_quadratic, omega_max, gravity, since_last_svd_limit):
+    """
+    Same math as calculate_torque_integrate_rotations_and_update_omega(), in place for agent n.
+    Only touches row n of the state arrays, so different agents can be integrated by different threads.
+    integrator is one of INTEGRATORS: explicit Euler (the reference scheme, bit for bit the original dynamics),
+    semi-implicit Euler or RK4. The attitude is always updated with the exponential map. The higher order schemes use
+    the exact motor response (motor_wrench_numba) at their stage times, the damping terms are applied per step.
+    If use_quat, the attitude is integrated in quat and rot is left untouched, see SwarmDynamics.sync_rot().
+    """
+    motor_tau_up = min(4 * dt / (motor_damp_time_up[n] + eps), 1.)
+    motor_tau_down = min(4 * dt / (motor_damp_time_down[n] + eps), 1.)
+    lin = motor_linearity[n]
+
+    for _ in range(steps_num):
+        ox, oy, oz = omega[n, 0], omega[n, 1], omega[n, 2]
+        # Quadratic damping of the angular velocity, based on the value at the beginning of the step
+        dmx = 1.0 - min(max(damp_omega_quadratic[n] * ox ** 2, 0.), 1.)
+        dmy = 1.0 - min(max(damp_omega_quadratic[n] * oy ** 2, 0.), 1.)
+        dmz = 1.0 - min(max(damp_omega_quadratic[n] * oz ** 2, 0.), 1.)
+        vel_keep = 1.0 - vel_damp[n]
+
+        if integrator == 0:
+            # Filtering the thruster and adding noise
+            tx, ty, tz, thrust_sum = 0., 0., 0., 0.
+            for k in range(4):
+                cmd = min(max(thrust_cmds[n, k], 0.), 1.)
+                tau = motor_tau_down if cmd < thrust_cmds_damp[n, k] else motor_tau_up
+                thrust_rot_damp[n, k] = tau * (cmd ** 0.5 - thrust_rot_damp[n, k]) + thrust_rot_damp[n, k]
+                cmd_damp = min(max(thrust_rot_damp[n, k] ** 2 + cmd * thrust_noise[n, k], 0.), 1.)
+                thrust_cmds_damp[n, k] = cmd_damp
+
+                thrust = thrust_max[n, k] * ((1 - lin) * cmd_damp ** 2 + lin * cmd_damp)
+                tx += prop_crossproducts[n, k, 0] * thrust
+                ty += prop_crossproducts[n, k, 1] * thrust
+                tz += prop_crossproducts[n, k, 2] * thrust + torque_max[n, k] * prop_ccw[n, k] * cmd_damp
+                thrust_sum += thrust
+            thrust_acc = thrust_sum / mass[n]
+            dox, doy, doz = omega_dot_numba(inertia, n, ox, oy, oz, tx, ty, tz)
+
+            # Euler: rotations and positions are integrated with the rates at the beginning of the step
+            update_attitude_numba(rot, quat, use_quat, n, ox, oy, oz, dt, since_last_svd, since_last_svd_limit)
+            omega[n, 0] = ox + dmx * dt * dox
+            omega[n, 1] = oy + dmy * dt * doy
+            omega[n, 2] = oz + dmz * dt * doz
+            for i in range(3):
+                pos[n, i] += dt * vel[n, i]
+            zx, zy, zz = thrust_axis_numba(rot, quat, use_quat, n)
+            acc[n, 0], acc[n, 1], acc[n, 2] = zx * thrust_acc, zy * thrust_acc, zz * thrust_acc - grav
+            for i in range(3):
+                vel[n, i] = vel_keep * vel[n, i] + dt * acc[n, i]
+        elif integrator == 1:
+            # Semi-implicit (symplectic) Euler: rates first, then attitude and position with the new rates
+            tx, ty, tz, thrust_acc = motor_wrench_numba(
+                n, dt, True, thrust_cmds, thrust_noise, thrust_cmds_damp, thrust_rot_damp, eps, mass, thrust_max,
+                torque_max, prop_crossproducts, prop_ccw, motor_linearity, motor_damp_time_up, motor_damp_time_down,
+            )
+            dox, doy, doz = omega_dot_numba(inertia, n, ox, oy, oz, tx, ty, tz)
+            omega[n, 0] = min(max(ox + dmx * dt * dox, -omega_max[n]), omega_max[n])
+            omega[n, 1] = min(max(oy + dmy * dt * doy, -omega_max[n]), omega_max[n])
+            omega[n, 2] = min(max(oz + dmz * dt * doz, -omega_max[n]), omega_max[n])
+            update_attitude_numba(rot, quat, use_quat, n, omega[n, 0], omega[n, 1], omega[n, 2], dt,
+                                  since_last_svd, since_last_svd_limit)
+            zx, zy, zz = thrust_axis_numba(rot, quat, use_quat, n)
+            acc[n, 0], acc[n, 1], acc[n, 2] = zx * thrust_acc, zy * thrust_acc, zz * thrust_acc - grav
+            for i in range(3):
+                vel[n, i] = vel_keep * vel[n, i] + dt * acc[n, i]
+                pos[n, i] += dt * vel[n, i]
+        else:
+            # RK4, the stage attitudes and the final attitude update use the exponential map
+            h = 0.5 * dt
+            t1x, t1y, t1z, f1 = motor_wrench_numba(
+                n, 0., False, thrust_cmds, thrust_noise, thrust_cmds_damp, thrust_rot_damp, eps, mass, thrust_max,
+                torque_max, prop_crossproducts, prop_ccw, motor_linearity, motor_damp_time_up, motor_damp_time_down,
+            )
+            t2x, t2y, t2z, f2 = motor_wrench_numba(
+                n, h, False, thrust_cmds, thrust_noise, thrust_cmds_damp, thrust_rot_damp, eps, mass, thrust_max,
+                torque_max, prop_crossproducts, prop_ccw, motor_linearity, motor_damp_time_up, motor_damp_time_down,
+            )
+            tx, ty, tz, f4 = motor_wrench_numba(
+                n, dt, True, thrust_cmds, thrust_noise, thrust_cmds_damp, thrust_rot_damp, eps, mass, thrust_max,
+                torque_max, prop_crossproducts, prop_ccw, motor_linearity, motor_damp_time_up, motor_damp_time_down,
+            )
+            k1x, k1y, k1z = omega_dot_numba(inertia, n, ox, oy, oz, t1x, t1y, t1z)
+            o2x, o2y, o2z = ox + h * k1x, oy + h * k1y, oz + h * k1z
+            k2x, k2y, k2z = omega_dot_numba(inertia, n, o2x, o2y, o2z, t2x, t2y, t2z)
+            o3x, o3y, o3z = ox + h * k2x, oy + h * k2y, oz + h * k2z
+            k3x, k3y, k3z = omega_dot_numba(inertia, n, o3x, o3y, o3z, t2x, t2y, t2z)
+            o4x, o4y, o4z = ox + dt * k3x, oy + dt * k3y, oz + dt * k3z
+            dox, doy, doz = omega_dot_numba(inertia, n, o4x, o4y, o4z, tx, ty, tz)
+
+            # Thrust direction at the stages
+            z1x, z1y, z1z = thrust_axis_numba(rot, quat, use_quat, n)
+            z2x, z2y, z2z = rotated_thrust_axis_numba(rot, quat, use_quat, n, ox, oy, oz, h)
+            z3x, z3y, z3z = rotated_thrust_axis_numba(rot, quat, use_quat, n, o2x, o2y, o2z, h)
+            z4x, z4y, z4z = rotated_thrust_axis_numba(rot, quat, use_quat, n, o3x, o3y, o3z, dt)
+            a1 = (z1x * f1, z1y * f1, z1z * f1 - grav)
+            a2 = (z2x * f2, z2y * f2, z2z * f2 - grav)
+            a3 = (z3x * f2, z3y * f2, z3z * f2 - grav)
+            a4 = (z4x * f4, z4y * f4, z4z * f4 - grav)
+            for i in range(3):
+                v1 = vel[n, i]
+                v2 = v1 + h * a1[i]
+                v3 = v1 + h * a2[i]
+                v4 = v1 + dt * a3[i]
+                pos[n, i] += dt / 6. * (v1 + 2. * v2 + 2. * v3 + v4)
+                vel[n, i] = vel_keep * v1 + dt / 6. * (a1[i] + 2. * a2[i] + 2. * a3[i] + a4[i])
+
+            update_attitude_numba(rot, quat, use_quat, n, (ox + 2. * o2x + 2. * o3x + o4x) / 6.,
+                                  (oy + 2. * o2y + 2. * o3y + o4y) / 6., (oz + 2. * o2z + 2. * o3z + o4z) / 6., dt,
+                                  since_last_svd, since_last_svd_limit)
+            omega[n, 0] = ox + dmx * dt / 6. * (k1x + 2. * k2x + 2. * k3x + dox)
+            omega[n, 1] = oy + dmy * dt / 6. * (k1y + 2. * k2y + 2. * k3y + doy)
+            omega[n, 2] = oz + dmz * dt / 6. * (k1z + 2. * k2z + 2. * k3z + doz)
+            thrust_acc = f4
+            zx, zy, zz = thrust_axis_numba(rot, quat, use_quat, n)
+            acc[n, 0], acc[n, 1], acc[n, 2] = zx * thrust_acc, zy * thrust_acc, zz * thrust_acc - grav
+
+        torque[n, 0], torque[n, 1], torque[n, 2] = tx, ty, tz
+        omega_dot[n, 0], omega_dot[n, 1], omega_dot[n, 2] = dox, doy, doz
+
+        # Clipping the angular velocity, and the position if met the walls
+        for i in range(3):
+            omega[n, i] = min(max(omega[n, i], -omega_max[n]), omega_max[n])
+            pos[n, i] = min(max(pos[n, i], room_box[n, 0, i]), room_box[n, 1, i])
+
+        # Accelerometer measures so called "proper acceleration" that includes gravity with the opposite sign
+        accelerometer[n, 0], accelerometer[n, 1], accelerometer[n, 2] = to_body_frame_numba(
+            rot, quat, use_quat, n, acc[n, 0], acc[n, 1], acc[n, 2] + gravity[n])
+
+
+def _swarm_step(thrust_cmds, thrust_noise, dt, steps_num, integrator, use_quat, eps, grav,
+                pos, vel, acc, accelerometer, rot, quat, omega, omega_dot, torque,
+                thrust_cmds_damp, thrust_rot_damp, since_last_svd, room_box,
+                mass, inertia, thrust_max, torque_max, prop_crossproducts, prop_ccw,
+                motor_linearity, motor_damp_time_up, motor_damp_time_down, vel_damp,
+                damp_omega_quadratic, omega_max, gravity, since_last_svd_limit):
+    """quad_step_numba() for all agents, in place."""
+    for n in prange(pos.shape[0]):
+        quad_step_numba(
+            n, thrust_cmds, thrust_noise, dt, steps_num, integrator, use_quat, eps, grav,
+            pos, vel, acc, accelerometer, rot, quat, omega, omega_dot, torque,
+            thrust_cmds_damp, thrust_rot_damp, since_last_svd, room_box,
+            mass, inertia, thrust_max, torque_max, prop_crossproducts, prop_ccw,
+            motor_linearity, motor_damp_time_up, motor_damp_time_down, vel_damp,
+            damp_omega_quadratic, omega_max, gravity, since_last_svd_limit,
+        )
+
+
+# prange is a plain range in the serial version, the parallel one distributes the agents over the numba threads
+swarm_step_numba = njit_variant(_swarm_step, 'swarm_step_numba', nogil=True, cache=True)
+swarm_step_numba_parallel = njit_variant(_swarm_step, 'swarm_step_numba_parallel', nogil=True, parallel=True, cache=True)
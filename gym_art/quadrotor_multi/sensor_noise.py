@@ -24,7 +24,7 @@ def quat_from_small_angle(theta):
     return q_theta
 
 
-quat_from_small_angle_numba = njit()(quat_from_small_angle)
+quat_from_small_angle_numba = njit(cache=True)(quat_from_small_angle)
 
 
 '''
@@ -64,7 +64,7 @@ def rot2quat(rot):
     return np.array([qw, qx, qy, qz])
 
 
-rot2quat_numba = njit()(rot2quat)
+rot2quat_numba = njit(cache=True)(rot2quat)
 
 
 class SensorNoise:
@@ -74,7 +74,7 @@ class SensorNoise:
                  gyro_noise_density=0.000175, gyro_random_walk=0.0105,
                  gyro_bias_correlation_time=1000., bypass=False,
                  acc_static_noise_std=0.002, acc_dynamic_noise_ratio=0.005,
-                 use_numba=False):
+                 use_numba=False, dtype=np.float64, noise_pool=None):
         """
         Args:
             pos_norm_std (float): std of pos gaus noise component
@@ -88,6 +88,8 @@ class SensorNoise:
             gyro_bias_correlation_time: gyroscope noise, MPU-9250 spec
             # gyro_gyro_turn_on_bias_sigma: gyroscope noise, MPU-9250 spec (val 0.09)
             bypass: no noise
+            dtype: floating point type of the noisy measurements
+            noise_pool: NoisePool the samples are taken from, None to use numpy.random / the numba generator
         """
 
         self.pos_norm_std = pos_norm_std
@@ -109,8 +111,10 @@ class SensorNoise:
         self.acc_static_noise_std = acc_static_noise_std
         self.acc_dynamic_noise_ratio = acc_dynamic_noise_ratio
         self.bypass = bypass
+        self.dtype = dtype
+        self.noise_pool = noise_pool
 
-    def add_noise(self, pos, vel, rot, omega, acc, dt):
+    def add_noise(self, pos, vel, rot, omega, acc, dt, quat=None):
         if self.bypass:
             return pos, vel, rot, omega, acc
         # """
@@ -120,31 +124,26 @@ class SensorNoise:
         #     rot: ground truth of the orientation in rotational matrix / quaterions / euler angles
         #     omega: ground truth of the angular velocity in body frame
         #     dt: integration step
+        #     quat: quaternion of the rotation matrix rot if known, saves the rot -> quat conversion
         # """
         assert pos.shape == (3,)
         assert vel.shape == (3,)
         assert omega.shape == (3,)
 
         # add noise to position measurement
-        noisy_pos = pos + \
-                    normal(loc=0., scale=self.pos_norm_std, size=3) + \
-                    uniform(low=-self.pos_unif_range, high=self.pos_unif_range, size=3)
+        noisy_pos = pos + self.normal(self.pos_norm_std) + self.uniform(self.pos_unif_range)
 
         # add noise to linear velocity
-        noisy_vel = vel + \
-                    normal(loc=0., scale=self.vel_norm_std, size=3) + \
-                    uniform(low=-self.vel_unif_range, high=self.vel_unif_range, size=3)
+        noisy_vel = vel + self.normal(self.vel_norm_std) + self.uniform(self.vel_unif_range)
 
         ## Noise in omega
         if self.gyro_norm_std != 0.:
             noisy_omega = self.add_noise_to_omega(omega, dt)
         else:
-            noisy_omega = omega + \
-                          normal(loc=0., scale=self.gyro_noise_density, size=3)
+            noisy_omega = omega + self.normal(self.gyro_noise_density)
 
         # Noise in rotation
-        theta = normal(0, self.quat_norm_std, size=3) + \
-                uniform(-self.quat_unif_range, self.quat_unif_range, size=3)
+        theta = self.normal(self.quat_norm_std) + self.uniform(self.quat_unif_range)
 
         if rot.shape == (3,):
             # Euler angles (xyz: roll=[-pi, pi], pitch=[-pi/2, pi/2], yaw = [-pi, pi])
@@ -154,7 +153,8 @@ class SensorNoise:
         elif rot.shape == (3, 3):
             # Rotation matrix
             quat_theta = quat_from_small_angle(theta)
-            quat = rot2quat(rot)
+            if quat is None:
+                quat = rot2quat(rot)
             noisy_quat = quatXquat(quat, quat_theta)
             noisy_rot = quat2R(noisy_quat[0], noisy_quat[1], noisy_quat[2], noisy_quat[3])
         elif rot.shape == (4,):
@@ -165,12 +165,11 @@ class SensorNoise:
             raise ValueError("ERROR: SensNoise: Unknown rotation type: " + str(rot))
 
         # Accelerometer noise
-        noisy_acc = acc + normal(loc=0., scale=self.acc_static_noise_std, size=3) + \
-                    acc * normal(loc=0., scale=self.acc_dynamic_noise_ratio, size=3)
+        noisy_acc = acc + self.normal(self.acc_static_noise_std) + acc * self.normal(self.acc_dynamic_noise_ratio)
 
-        return noisy_pos, noisy_vel, noisy_rot, noisy_omega, noisy_acc
+        return self.cast(noisy_pos, noisy_vel, noisy_rot, noisy_omega, noisy_acc)
 
-    def add_noise_numba(self, pos, vel, rot, omega, acc, dt):
+    def add_noise_numba(self, pos, vel, rot, omega, acc, dt, quat=None):
         if self.bypass:
             return pos, vel, rot, omega, acc
         # """
@@ -180,19 +179,25 @@ class SensorNoise:
         #     rot: ground truth of the orientation in rotational matrix / quaterions / euler angles
         #     omega: ground truth of the angular velocity in body frame
         #     dt: integration step
+        #     quat: quaternion of the rotation matrix rot if known, saves the rot -> quat conversion
         # """
         assert pos.shape == (3,)
         assert vel.shape == (3,)
         assert omega.shape == (3,)
 
-        noisy_pos, noisy_vel, noisy_omega, noisy_acc, theta = add_noise_to_vel_acc_pos_omega_rot(
-            pos, vel, omega, acc,
+        rand_vars = dict(
             pos_rand_var=(self.pos_norm_std, self.pos_unif_range),
             vel_rand_var=(self.vel_norm_std, self.vel_unif_range),
             omega_rand_var=self.gyro_noise_density,
             acc_rand_var=(self.acc_static_noise_std, self.acc_dynamic_noise_ratio),
             rot_rand_var=(self.quat_norm_std, self.quat_unif_range),
         )
+        if self.noise_pool is None:
+            noisy_pos, noisy_vel, noisy_omega, noisy_acc, theta = add_noise_to_vel_acc_pos_omega_rot(
+                pos, vel, omega, acc, **rand_vars)
+        else:
+            noisy_pos, noisy_vel, noisy_omega, noisy_acc, theta = add_noise_from_samples_numba(
+                pos, vel, omega, acc, self.noise_pool.normal((6, 3)), self.noise_pool.uniform((3, 3)), **rand_vars)
 
         # Noise in omega
         if self.gyro_norm_std != 0.:
@@ -206,7 +211,8 @@ class SensorNoise:
         elif rot.shape == (3, 3):
             # Rotation matrix
             quat_theta = quat_from_small_angle_numba(theta)
-            quat = rot2quat_numba(rot)
+            if quat is None:
+                quat = rot2quat_numba(rot)
             noisy_quat = quatXquat_numba(quat, quat_theta)
             noisy_rot = quat2R_numba(noisy_quat[0], noisy_quat[1], noisy_quat[2], noisy_quat[3])
         elif rot.shape == (4,):
@@ -216,7 +222,21 @@ class SensorNoise:
         else:
             raise ValueError("ERROR: SensNoise: Unknown rotation type: " + str(rot))
 
-        return noisy_pos, noisy_vel, noisy_rot, noisy_omega, noisy_acc
+        return self.cast(noisy_pos, noisy_vel, noisy_rot, noisy_omega, noisy_acc)
+
+    def normal(self, std, size=3):
+        if self.noise_pool is None:
+            return normal(loc=0., scale=std, size=size)
+        return std * self.noise_pool.normal(size)
+
+    def uniform(self, unif_range, size=3):
+        if self.noise_pool is None:
+            return uniform(low=-unif_range, high=unif_range, size=size)
+        return unif_range * self.noise_pool.uniform(size)
+
+    def cast(self, *measurements):
+        # the noise is sampled in float64
+        return tuple(m.astype(self.dtype, copy=False) for m in measurements)
 
     # copy from rotorS imu plugin
     def add_noise_to_omega(self, omega, dt):
@@ -227,12 +247,97 @@ class SensorNoise:
                     exp(-2 * dt / self.gyro_bias_correlation_time) - 1)) ** 0.5
         pi_g_d = exp(-dt / self.gyro_bias_correlation_time)
 
-        self.gyro_bias = pi_g_d * self.gyro_bias + sigma_b_g_d * normal(0, 1, 3)
-        return omega + self.gyro_bias + self.gyro_random_walk * normal(0, 1,
-                                                                       3)  # + self.gyro_turn_on_bias_sigma * normal(0, 1, 3)
+        self.gyro_bias = pi_g_d * self.gyro_bias + self.normal(sigma_b_g_d)
+        return omega + self.gyro_bias + self.normal(self.gyro_random_walk)  # + self.gyro_turn_on_bias_sigma * normal(0, 1, 3)
+
+
+class SwarmSensorNoise:
+    """
+    Noise model of a SensorNoise applied to the (N, 3) / (N, 3, 3) states of a whole swarm in a single call.
+    The parameters are read from sensor_noise at every call, e.g. setting sensor_noise.bypass also disables this noise.
+    The gyro bias random walk has one (3,) state per agent.
+    """
 
+    def __init__(self, num_agents, sensor_noise, noise_pool=None):
+        self.num_agents = num_agents
+        self.sensor_noise = sensor_noise
+        self.noise_pool = noise_pool
+        self.gyro_bias = np.zeros((num_agents, 3))
 
-@njit
+    def normal(self, std, shape):
+        if self.noise_pool is None:
+            return normal(loc=0., scale=std, size=shape)
+        return std * self.noise_pool.normal(shape)
+
+    def uniform(self, unif_range, shape):
+        if self.noise_pool is None:
+            return uniform(low=-unif_range, high=unif_range, size=shape)
+        return unif_range * self.noise_pool.uniform(shape)
+
+    def add_noise(self, pos, vel, rot, omega, acc, dt):
+        sn = self.sensor_noise
+        if sn.bypass:
+            return pos, vel, rot, omega, acc
+        shape = (self.num_agents, 3)
+        assert pos.shape == vel.shape == omega.shape == acc.shape == shape
+        assert rot.shape == (self.num_agents, 3, 3)
+
+        noisy_pos = pos + self.normal(sn.pos_norm_std, shape) + self.uniform(sn.pos_unif_range, shape)
+        noisy_vel = vel + self.normal(sn.vel_norm_std, shape) + self.uniform(sn.vel_unif_range, shape)
+
+        if sn.gyro_norm_std != 0.:
+            noisy_omega = self.add_noise_to_omega(omega, dt)
+        else:
+            noisy_omega = omega + self.normal(sn.gyro_noise_density, shape)
+
+        # R(quat x quat_theta) = R(quat) R(quat_theta), see SensorNoise.add_noise()
+        if sn.quat_norm_std != 0. or sn.quat_unif_range != 0.:
+            theta = self.normal(sn.quat_norm_std, shape) + self.uniform(sn.quat_unif_range, shape)
+            noisy_rot = np.matmul(rot, rots_from_small_angles(theta))
+        else:
+            noisy_rot = rot.copy()
+
+        noisy_acc = acc + self.normal(sn.acc_static_noise_std, shape) + \
+            acc * self.normal(sn.acc_dynamic_noise_ratio, shape)
+
+        return sn.cast(noisy_pos, noisy_vel, noisy_rot, noisy_omega, noisy_acc)
+
+    def add_noise_to_omega(self, omega, dt):
+        """SensorNoise.add_noise_to_omega() for all agents."""
+        sn = self.sensor_noise
+        sigma_g_d = sn.gyro_noise_density / (dt ** 0.5)
+        sigma_b_g_d = (-(sigma_g_d ** 2) * (sn.gyro_bias_correlation_time / 2) * (
+                exp(-2 * dt / sn.gyro_bias_correlation_time) - 1)) ** 0.5
+        pi_g_d = exp(-dt / sn.gyro_bias_correlation_time)
+
+        self.gyro_bias = pi_g_d * self.gyro_bias + self.normal(sigma_b_g_d, omega.shape)
+        return omega + self.gyro_bias + self.normal(sn.gyro_random_walk, omega.shape)
+
+
+def rots_from_small_angles(theta):
+    """Rotation matrices of quat_from_small_angle() for a (N, 3) array of angles."""
+    q_squared = np.sum(theta ** 2, axis=1) / 4.0
+    small = q_squared < 1
+    w = np.where(small, np.sqrt(np.maximum(1 - q_squared, 0.)), 1.0 / np.sqrt(1 + q_squared))
+    f = np.where(small, 0.5, 0.5 * w)
+    q = np.concatenate([w[:, None], theta * f[:, None]], axis=1)
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+
+    qw, qx, qy, qz = q.T
+    rot = np.empty((len(q), 3, 3))
+    rot[:, 0, 0] = 1.0 - 2 * qy ** 2 - 2 * qz ** 2
+    rot[:, 0, 1] = 2 * qx * qy - 2 * qz * qw
+    rot[:, 0, 2] = 2 * qx * qz + 2 * qy * qw
+    rot[:, 1, 0] = 2 * qx * qy + 2 * qz * qw
+    rot[:, 1, 1] = 1.0 - 2 * qx ** 2 - 2 * qz ** 2
+    rot[:, 1, 2] = 2 * qy * qz - 2 * qx * qw
+    rot[:, 2, 0] = 2 * qx * qz - 2 * qy * qw
+    rot[:, 2, 1] = 2 * qy * qz + 2 * qx * qw
+    rot[:, 2, 2] = 1.0 - 2 * qx ** 2 - 2 * qy ** 2
+    return rot
+
+
+@njit(cache=True)
 def add_noise_to_vel_acc_pos_omega_rot(
         pos, vel, omega, acc, pos_rand_var, vel_rand_var, omega_rand_var,
         acc_rand_var, rot_rand_var
@@ -262,6 +367,25 @@ def add_noise_to_vel_acc_pos_omega_rot(
     return noisy_pos, noisy_vel, noisy_omega, noisy_acc, theta
 
 
+@njit(cache=True)
+def add_noise_from_samples_numba(
+        pos, vel, omega, acc, normals, uniforms, pos_rand_var, vel_rand_var, omega_rand_var,
+        acc_rand_var, rot_rand_var
+):
+    """
+    Same as add_noise_to_vel_acc_pos_omega_rot() with the samples drawn by the caller, e.g. from a NoisePool.
+    normals: (6, 3) standard normals for pos, vel, omega, rot, static and dynamic acc noise
+    uniforms: (3, 3) uniforms in [-1, 1) for pos, vel and rot
+    """
+    noisy_pos = pos + pos_rand_var[0] * normals[0] + pos_rand_var[1] * uniforms[0]
+    noisy_vel = vel + vel_rand_var[0] * normals[1] + vel_rand_var[1] * uniforms[1]
+    noisy_omega = omega + omega_rand_var * normals[2]
+    theta = rot_rand_var[0] * normals[3] + rot_rand_var[1] * uniforms[2]
+    noisy_acc = acc + acc_rand_var[0] * normals[4] + acc * (acc_rand_var[1] * normals[5])
+
+    return noisy_pos, noisy_vel, noisy_omega, noisy_acc, theta
+
+
 if __name__ == "__main__":
     sens = SensorNoise()
     import time
@@ -0,0 +1,110 @@
+"""
+Accuracy vs cost of the integration schemes of SwarmDynamics on fixed thrust sequences.
+
+The reference trajectory is RK4 at a high simulation frequency. Every scheme is run at the control frequency of the env
+(100 Hz) times the number of simulation steps per control step, i.e. sim_freq=200 / sim_steps=2 is the default Euler setup.
+
+python -m gym_art.quadrotor_multi.tests.benchmark_integrators --num_agents 64 --duration 2
+"""
+import argparse
+import copy
+import time
+
+import numpy as np
+
+from gym_art.quadrotor_multi.quadrotor_swarm_dynamics import GRAV
+from gym_art.quadrotor_multi.tests.test_multi_env import create_env
+
+CONTROL_FREQ = 100
+
+# (integrator, simulation steps per control step)
+SCHEMES = [('euler', 2), ('euler', 1), ('semi_implicit', 2), ('semi_implicit', 1), ('rk4', 1)]
+REFERENCE = ('rk4', 32)
+
+
+def make_swarm(num_agents, seed=0):
+    """Swarm with the Crazyflie parameters of the env, all quads near the center of the room with small angular rates."""
+    env = create_env(num_agents, use_numba=True)
+    env.reset()
+    swarm = copy.deepcopy(env.swarm_dynamics)
+    env.close()
+
+    rng = np.random.default_rng(seed)
+    swarm.pos[:] = [0., 0., 5.] + rng.uniform(-1., 1., size=(num_agents, 3))
+    swarm.vel[:] = 0.
+    swarm.rot[:] = np.eye(3)
+    swarm.omega[:] = rng.uniform(-1., 1., size=(num_agents, 3))
+    swarm.thrust_noise_sigma[:] = 0.
+    swarm.thrust_noise[:] = 0.
+    swarm.since_last_svd[:] = 0.
+    return swarm
+
+
+def make_thrusts(swarm, num_steps, seed=0):
+    """(num_steps, N, 4) sequence of normalized thrusts oscillating around hover."""
+    rng = np.random.default_rng(seed)
+    hover = swarm.mass * GRAV / np.sum(swarm.thrust_max, axis=1)
+    t = np.arange(num_steps)[:, None, None] / CONTROL_FREQ
+    freq = rng.uniform(0.5, 2., size=(1, swarm.num_agents, 4))
+    phase = rng.uniform(0., 2 * np.pi, size=(1, swarm.num_agents, 4))
+    return np.clip(hover[None, :, None] * (1. + 0.15 * np.sin(2 * np.pi * freq * t + phase)), 0., 1.)
+
+
+def run(swarm, thrusts, integrator, sim_steps):
+    """Positions and rotations after every control step, and the wall time of the integration."""
+    swarm = copy.deepcopy(swarm)
+    swarm.integrator = integrator
+    dt = 1. / (CONTROL_FREQ * sim_steps)
+    positions, rotations = [], []
+
+    start = time.time()
+    for thrust_cmds in thrusts:
+        swarm.step(dt=dt, steps_num=sim_steps, thrust_cmds=thrust_cmds, thrust_noise=swarm.thrust_noise)
+        positions.append(swarm.pos.copy())
+        rotations.append(swarm.rot.copy())
+    elapsed_sec = time.time() - start
+
+    return np.array(positions), np.array(rotations), elapsed_sec
+
+
+def trajectory_errors(positions, rotations, ref_positions, ref_rotations):
+    """Max position error (m) and max attitude error (rad) over all agents and control steps."""
+    pos_err = np.max(np.linalg.norm(positions - ref_positions, axis=-1))
+    rel_rot = np.einsum('tnji,tnjk->tnik', ref_rotations, rotations)
+    cos_angle = np.clip((np.trace(rel_rot, axis1=-2, axis2=-1) - 1.) / 2., -1., 1.)
+    return pos_err, np.max(np.arccos(cos_angle))
+
+
+def compare_integrators(num_agents=16, duration=2., schemes=SCHEMES, seed=0):
+    """Returns [(integrator, sim_steps, max position error, max attitude error, sec per control step)]."""
+    swarm = make_swarm(num_agents, seed)
+    thrusts = make_thrusts(swarm, int(duration * CONTROL_FREQ), seed)
+
+    # compilation
+    for integrator, sim_steps in schemes:
+        run(swarm, thrusts[:1], integrator, sim_steps)
+
+    ref_positions, ref_rotations, _ = run(swarm, thrusts, *REFERENCE)
+    results = []
+    for integrator, sim_steps in schemes:
+        positions, rotations, elapsed_sec = run(swarm, thrusts, integrator, sim_steps)
+        pos_err, rot_err = trajectory_errors(positions, rotations, ref_positions, ref_rotations)
+        results.append((integrator, sim_steps, pos_err, rot_err, elapsed_sec / len(thrusts)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_agents', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=2., help='Length of the trajectories in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f'{"integrator":>14}{"sim_freq":>10}{"max pos err, m":>16}{"max rot err, rad":>18}{"us/control step":>17}')
+    for integrator, sim_steps, pos_err, rot_err, sec in compare_integrators(args.num_agents, args.duration,
+                                                                          seed=args.seed):
+        print(f'{integrator:>14}{CONTROL_FREQ * sim_steps:>10}{pos_err:>16.2e}{rot_err:>18.2e}{sec * 1e6:>17.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Time-to-first-step of a fresh process, with an empty and with a populated on-disk numba cache.
+
+python -m gym_art.quadrotor_multi.tests.benchmark_startup --modes numba fused
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from gym_art.quadrotor_multi.tests.benchmark_swarm import NUMBA_MODES
+
+FIRST_STEP_SCRIPT = '''
+import time
+start = time.time()
+from gym_art.quadrotor_multi.tests.test_multi_env import create_env
+env = create_env({num_agents}, use_numba={use_numba!r})
+env.reset()
+env.step([env.action_space.sample() for _ in range({num_agents})])
+print('time_to_first_step', time.time() - start)
+'''
+
+
+def time_to_first_step(mode, num_agents, cache_dir):
+    """Runs the first step of an env in a new interpreter, like a freshly started rollout worker."""
+    script = FIRST_STEP_SCRIPT.format(num_agents=num_agents, use_numba=NUMBA_MODES[mode])
+    env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+    output = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True, check=True).stdout
+    line = [l for l in output.splitlines() if l.startswith('time_to_first_step')][-1]
+    return float(line.split()[1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', nargs='+', default=['numba', 'fused', 'parallel'], choices=list(NUMBA_MODES))
+    parser.add_argument('--num_agents', type=int, default=8)
+    args = parser.parse_args()
+
+    print(f'{"mode":>10}{"cold cache, s":>16}{"warm cache, s":>16}')
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cold = time_to_first_step(mode, args.num_agents, cache_dir)
+            warm = time_to_first_step(mode, args.num_agents, cache_dir)
+        print(f'{mode:>10}{cold:>16.2f}{warm:>16.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Throughput of QuadrotorEnvMulti as a function of the swarm size.
+
+python -m gym_art.quadrotor_multi.tests.benchmark_swarm --modes fused parallel --num_agents 8 64 512
+"""
+import argparse
+import time
+
+import numpy as np
+
+from gym_art.quadrotor_multi.tests.test_multi_env import create_env
+
+NUMBA_MODES = {'numpy': False, 'numba': True, 'fused': 'fused', 'parallel': 'parallel'}
+
+
+def benchmark_env(num_agents, mode, steps, local_obs=6, num_threads=None):
+    """Returns control steps per second of the whole swarm, measured after a warmup (jit compilation, first reset)."""
+    env = create_env(num_agents, use_numba=NUMBA_MODES[mode], local_obs=min(local_obs, num_agents - 1))
+    if env.fused_step is not None:
+        env.fused_step.num_threads = num_threads
+    env.reset()
+
+    actions = [np.stack([env.action_space.sample() for _ in range(num_agents)]) for _ in range(16)]
+    for i in range(10):
+        env.step(actions[i % len(actions)])
+
+    start = time.time()
+    for i in range(steps):
+        env.step(actions[i % len(actions)])
+        # this env self-resets
+    elapsed_sec = time.time() - start
+
+    env.close()
+    return steps / elapsed_sec
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', nargs='+', default=['numba', 'fused', 'parallel'], choices=list(NUMBA_MODES))
+    parser.add_argument('--num_agents', nargs='+', type=int, default=[8, 16, 32, 64, 128, 256, 512])
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    print(f'{"agents":>8}{"mode":>10}{"steps/s":>12}{"agent-steps/s":>16}')
+    for num_agents in args.num_agents:
+        for mode in args.modes:
+            fps = benchmark_env(num_agents, mode, args.steps, num_threads=args.num_threads)
+            print(f'{num_agents:>8}{mode:>10}{fps:>12.1f}{fps * num_agents:>16.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,17 @@ from unittest import TestCase
 import numpy as np
 
 from gym_art.quadrotor_multi.quad_experience_replay import ExperienceReplayWrapper
-from gym_art.quadrotor_multi.quadrotor_multi import QuadrotorEnvMulti
+from gym_art.quadrotor_multi.quad_neighbors import NeighborSelector
+from gym_art.quadrotor_multi.quad_obstacle_utils import OBSTACLES_SHAPE_LIST, OBSTACLE_OBS_SIZE
+from gym_art.quadrotor_multi.quad_scenarios_utils import QUADS_FORMATION_LIST, FormationTemplateCache, \
+    get_goal_by_formation
+from gym_art.quadrotor_multi.quad_utils import ContactEvents, generate_points, get_grid_dim_number
+from gym_art.quadrotor_multi.quadrotor_multi import QuadrotorEnvMulti, QuadrotorVecEnvMulti
+from gym_art.quadrotor_multi.quadrotor_multi_obstacles import MultiObstacles
 
 
-def create_env(num_agents, use_numba=False, use_replay_buffer=False, episode_duration=7, local_obs=-1):
+def create_env(num_agents, use_numba=False, use_replay_buffer=False, episode_duration=7, local_obs=-1,
+               swarm_obs='pos_vel_goals_ndist_gdist', **kwargs):
     quad = 'Crazyflie'
     dyn_randomize_every = dyn_randomization_ratio = None
 
@@ -28,8 +35,9 @@ def create_env(num_agents, use_numba=False, use_replay_buffer=False, episode_dur
         dynamics_randomize_every=dyn_randomize_every, dynamics_change=dynamics_change, dyn_sampler_1=sampler_1,
         sense_noise=sense_noise, init_random_state=True, ep_time=episode_duration, quads_use_numba=use_numba,
         use_replay_buffer=use_replay_buffer,
-        swarm_obs="pos_vel_goals_ndist_gdist",
+        swarm_obs=swarm_obs,
         local_obs=local_obs,
+        **kwargs,
     )
     return env
 
@@ -95,6 +103,329 @@ class TestMultiEnv(TestCase):
 
         env.close()
 
+    def test_info_levels(self):
+        num_agents = 2
+        for use_numba in (False, True, 'fused'):
+            envs = {level: create_env(num_agents, use_numba=use_numba, quads_info_level=level)
+                    for level in ('none', 'rewards', 'full')}
+            for level, env in envs.items():
+                env.reset()
+                _, _, _, infos = env.step([env.action_space.sample() for _ in range(num_agents)])
+                self.assertEqual(len(infos), num_agents)
+                self.assertEqual('rew_main' in infos[0].get('rewards', {}), level != 'none')
+                self.assertEqual('obs_comp' in infos[0], level == 'full')
+                self.assertEqual('dyn_params' in infos[0], level == 'full')
+
+                # full diagnostics on demand
+                diagnostics = env.get_diagnostics()
+                self.assertEqual(len(diagnostics), num_agents)
+                self.assertTrue(np.array_equal(diagnostics[1]['obs_comp']['xyz'][0], env.envs[1].dynamics.pos))
+                self.assertIn('thrust_max', diagnostics[0]['dyn_params'])
+                env.close()
+
+        with self.assertRaises(ValueError):
+            create_env(num_agents, quads_info_level='some')
+
+    def test_episode_rewards(self):
+        num_agents = 4
+        for use_numba in (False, 'fused'):
+            env = create_env(num_agents, use_numba=use_numba, episode_duration=1, quads_info_level='rewards')
+            env.reset()
+            sums = [dict() for _ in range(num_agents)]
+            dones = [False]
+            while not dones[0]:
+                _, rewards, dones, infos = env.step([env.action_space.sample() for _ in range(num_agents)])
+                for i, info in enumerate(infos):
+                    for key, value in info['rewards'].items():
+                        sums[i][key] = sums[i].get(key, 0.) + value
+                    self.assertEqual('episode_rewards' in info, dones[i])
+
+            for i, info in enumerate(infos):
+                self.assertEqual(set(info['episode_rewards']), set(sums[i]))
+                for key, value in info['episode_rewards'].items():
+                    self.assertAlmostEqual(value, sums[i][key])
+            # the episode sums are cleared by the reset
+            self.assertFalse(env.reward_components.episode.any())
+            env.close()
+
+    def test_obs_buffer(self):
+        num_agents, num_obstacles = 4, 2
+        for use_numba in (False, True, 'fused'):
+            env = create_env(num_agents, use_numba=use_numba, quads_obstacle_mode='dynamic',
+                             quads_obstacle_num=num_obstacles, local_obs=2)
+            obs = env.reset()
+            for _ in range(20):
+                obs, _, _, _ = env.step([env.action_space.sample() for _ in range(num_agents)])
+            self.assertEqual(obs.shape, (num_agents,) + env.observation_space.shape)
+            # a copy of the buffer, which is overwritten by the next step
+            self.assertFalse(np.shares_memory(obs, env.obs_buffer.buffer))
+            self.assertTrue(np.array_equal(obs, env.obs_buffer.buffer))
+
+            quads_vel = np.array([e.dynamics.vel for e in env.envs])
+            for i, obstacle in enumerate(env.multi_obstacles.obstacles):
+                # rel_pos, rel_vel, size and shape, the obstacles are always set in the dynamic mode
+                obst_obs = np.concatenate((obstacle.pos - env.pos, obstacle.vel - quads_vel,
+                                           np.full((num_agents, 3), obstacle.size / 2),
+                                           np.full((num_agents, 1), OBSTACLES_SHAPE_LIST.index(obstacle.shape))), axis=1)
+                self.assertTrue(np.allclose(env.obs_buffer.obstacle(i), obst_obs))
+            env.close()
+
+    def test_multi_obstacles(self):
+        num_agents, num_obstacles = 50, 6
+        obstacles = MultiObstacles(mode='dynamic', num_obstacles=num_obstacles, shape='random', traj='mix',
+                                   dt=0.01, quad_size=0.046, obs_mode='half_relative')
+        set_obstacles = np.array([True, True, True, True, False, False])
+        obs = np.zeros((num_agents, num_obstacles * OBSTACLE_OBS_SIZE))
+        rng = np.random.default_rng(0)
+        quads_pos, quads_vel = rng.uniform(-2., 2., size=(num_agents, 3)), rng.normal(size=(num_agents, 3))
+        obstacles.reset(obs=obs, quads_pos=quads_pos, quads_vel=quads_vel, set_obstacles=set_obstacles)
+        # the random shapes and mixed trajectories are drawn by the reset
+        self.assertTrue((obstacles.shape_ids >= 0).all() and (obstacles.traj_ids[set_obstacles] >= 0).all())
+        obstacles.shape_ids[:4] = [0, 1, 0, 1]
+        obstacles.traj_ids[:4] = [0, 0, 1, 1]
+
+        for _ in range(30):
+            pos, vel = obstacles.pos.copy(), obstacles.vel.copy()
+            np.random.seed(1)
+            obstacles.step(obs=obs, quads_pos=quads_pos, quads_vel=quads_vel, set_obstacles=set_obstacles)
+
+            # reference: the trajectories of the obstacles one by one, with the same random draws
+            np.random.seed(1)
+            for i, obstacle in enumerate(obstacles.obstacles):
+                if not set_obstacles[i]:
+                    continue
+                if obstacle.tmp_traj == 'electron':
+                    force_pos = 2 * obstacle.goal_central - pos[i]
+                    rel_force_goal = force_pos - obstacle.goal_central
+                    force_pos = force_pos + np.random.uniform(low=-0.5 * rel_force_goal, high=0.5 * rel_force_goal)
+                    acc = force_pos - pos[i]
+                else:
+                    acc = np.array([0., 0., -9.81])
+                vel[i] += 0.01 * acc
+                pos[i] += 0.01 * vel[i]
+            self.assertTrue(np.allclose(obstacles.pos, pos))
+            self.assertTrue(np.allclose(obstacles.vel, vel))
+
+        for i, obstacle in enumerate(obstacles.obstacles):
+            relative = set_obstacles[i]
+            expected = np.concatenate((obstacle.pos - quads_pos * relative, obstacle.vel - quads_vel * relative,
+                                       np.full((num_agents, 3), obstacle.size / 2),
+                                       np.full((num_agents, 1), OBSTACLES_SHAPE_LIST.index(obstacle.shape))), axis=1)
+            self.assertTrue(np.allclose(obs[:, i * OBSTACLE_OBS_SIZE:(i + 1) * OBSTACLE_OBS_SIZE], expected))
+
+        # drones around the obstacles, reference: sphere vs. point and sphere vs. AABB one pair at a time
+        obstacles.size[:] = 1.0
+        quads_pos = obstacles.pos[rng.integers(num_obstacles, size=num_agents)] + rng.uniform(-0.6, 0.6, (num_agents, 3))
+        collision_matrix, all_collisions, distance_matrix = obstacles.collision_detection(quads_pos, set_obstacles)
+        expected = np.zeros((num_agents, num_obstacles))
+        for i, obstacle in enumerate(obstacles.obstacles):
+            for n, pos in enumerate(quads_pos):
+                if not set_obstacles[i]:
+                    continue
+                if obstacle.shape == 'cube':
+                    half_size = 0.5 * obstacle.size
+                    closest = np.maximum(obstacle.pos - half_size, np.minimum(pos, obstacle.pos + half_size))
+                    expected[n, i] = np.dot(closest - pos, closest - pos) < 0.046 ** 2
+                else:
+                    expected[n, i] = np.linalg.norm(pos - obstacle.pos) < 0.046 + 0.5 * obstacle.size
+        self.assertGreater(expected.sum(), 0)
+        self.assertTrue(np.array_equal(collision_matrix, expected))
+        self.assertTrue(np.array_equal(all_collisions, np.argwhere(expected)))
+        self.assertTrue(np.allclose(distance_matrix, np.linalg.norm(quads_pos[:, None] - obstacles.pos, axis=2)))
+
+        # the obstacles move by the same time per control step with any number of sim steps
+        for sim_steps in (1, 2, 4):
+            env = create_env(2, quads_obstacle_mode='dynamic', quads_obstacle_num=1, sim_freq=100. * sim_steps,
+                             sim_steps=sim_steps)
+            self.assertEqual(env.multi_obstacles.dt, 0.005)
+            env.close()
+
+    def test_neighbor_obs(self):
+        num_agents = 8
+        for swarm_obs in ('pos_vel', 'pos_vel_goals', 'pos_vel_goals_ndist_gdist'):
+            for local_obs in (-1, 3):
+                env = create_env(num_agents, swarm_obs=swarm_obs, local_obs=local_obs)
+                env.reset()
+                for _ in range(10):
+                    obs, _, _, _ = env.step([env.action_space.sample() for _ in range(num_agents)])
+
+                # per-agent reference of the gathered neighbor observations
+                closest_drones = env.neighborhood_indices()
+                self.assertEqual(closest_drones.shape, (num_agents, env.num_use_neighbor_obs))
+                pos = np.array([e.dynamics.pos for e in env.envs])
+                vel = np.array([e.dynamics.vel for e in env.envs])
+                goals = np.array([e.goal for e in env.envs])
+                for i in range(num_agents):
+                    others = [j for j in range(num_agents) if j != i]
+                    self.assertTrue(np.array_equal(env.neighbor_indices_all[i], others))
+                    if local_obs == -1:
+                        self.assertTrue(np.array_equal(closest_drones[i], others))
+                    else:
+                        dist = np.linalg.norm(pos[others] - pos[i], axis=1)
+                        self.assertLessEqual(dist[np.isin(others, closest_drones[i])].max(),
+                                             dist[~np.isin(others, closest_drones[i])].min())
+
+                    nbrs = closest_drones[i]
+                    pos_rel, vel_rel, goals_rel = pos[nbrs] - pos[i], vel[nbrs] - vel[i], goals[nbrs] - pos[i]
+                    columns = [pos_rel, vel_rel]
+                    if swarm_obs != 'pos_vel':
+                        columns.append(goals_rel)
+                    if swarm_obs == 'pos_vel_goals_ndist_gdist':
+                        columns += [np.linalg.norm(pos_rel, axis=1)[:, None], np.linalg.norm(goals_rel, axis=1)[:, None]]
+                    expected = np.clip(np.concatenate(columns, axis=1).reshape(-1), env.clip_neighbor_space_min_box,
+                                       env.clip_neighbor_space_max_box)
+                    self.assertTrue(np.allclose(obs[i, env.obs_buffer.neighbor_slice], expected))
+                env.close()
+
+    def test_neighbor_selector(self):
+        num_agents, num_neighbors = 300, 6
+        rng = np.random.default_rng(0)
+        pos = rng.uniform(-5., 5., size=(num_agents, 3))
+        pos[:20] = pos[0]  # drones at the same position
+        vel = rng.normal(size=(num_agents, 3))
+        for local_metric in ('dist', 'dist_inverse'):
+            for local_coeff in (0.0, 0.5):
+                # reference: full argsort of the metric of every agent
+                others = np.array([[j for j in range(num_agents) if j != i] for i in range(num_agents)])
+                rel_pos, rel_vel = pos[others] - pos[:, None], vel[others] - vel[:, None]
+                rel_dist = np.maximum(np.linalg.norm(rel_pos, axis=2), 0.01)
+                vel_proj = np.sum(rel_pos / rel_dist[:, :, None] * rel_vel, axis=2)
+                if local_metric == 'dist':
+                    metric = rel_dist + local_coeff * vel_proj
+                else:
+                    metric = -(1.0 / rel_dist - local_coeff * vel_proj)
+                expected = np.take_along_axis(others, metric.argsort(axis=1)[:, :num_neighbors], axis=1)
+
+                def metric_of(neighbors):
+                    # column of neighbor j in the row of agent i is j - (j > i)
+                    columns = neighbors - (neighbors > np.arange(num_agents)[:, None])
+                    return np.take_along_axis(metric, columns, axis=1)
+
+                for search in ('full', 'kdtree'):
+                    selector = NeighborSelector(num_agents, num_neighbors, local_metric=local_metric,
+                                                local_coeff=local_coeff, search=search)
+                    closest = selector.select(pos, vel)
+                    # same neighbors in the same order, up to drones with the same metric
+                    self.assertTrue(np.array_equal(metric_of(closest), metric_of(expected)))
+                    self.assertFalse((closest == np.arange(num_agents)[:, None]).any())
+
+        with self.assertRaises(ValueError):
+            NeighborSelector(num_agents, num_neighbors, search='octree')
+        for use_numba in ('fused', 'parallel'):
+            with self.assertRaises(ValueError):
+                create_env(8, use_numba=use_numba, local_obs=4, quads_neighbor_search='kdtree')
+
+    def test_collision_events(self):
+        contacts = ContactEvents(4, 4)
+        self.assertTrue(contacts.update(np.array([0, 1]), np.array([1, 2])).all())
+        self.assertTrue(np.array_equal(contacts.update(np.array([0, 2]), np.array([1, 3])), [False, True]))
+        self.assertEqual(np.count_nonzero(contacts.contacts), 2)
+        contacts.reset()
+        self.assertFalse(contacts.contacts.any())
+
+        env = create_env(3, use_numba=True)
+        self.assertEqual(len(env.last_step_unique_collisions), 0)
+        env.reset()
+        positions = np.array([[0., 0., 2.], [0., 0., 2.], [3., 3., 2.]])
+        hover = np.zeros((3, 4))
+        # drones 0 and 1 stay in contact for 5 steps, separate and touch again: two collisions
+        for step in range(12):
+            env.swarm_dynamics.pos[:] = positions
+            env.swarm_dynamics.vel[:] = 0.
+            if step == 5:
+                env.swarm_dynamics.pos[1, 0] = 1.
+            env.step(hover)
+        self.assertEqual(env.collisions_per_episode, 2)
+        self.assertTrue(np.array_equal(env.curr_drone_collisions, [[0, 1]]))
+        self.assertEqual(len(env.last_step_unique_collisions), 0)
+        env.close()
+
+    def test_goal_schedules(self):
+        num_agents = 4
+        for quads_mode in ['dynamic_same_goal', 'ep_lissajous3D', 'ep_rand_bezier']:
+            env = create_env(num_agents, quads_mode=quads_mode)
+            np.random.seed(0)
+            env.reset()
+            scenario = env.scenario
+            schedule = scenario.goal_schedule
+            self.assertEqual(schedule.shape, (env.envs[0].ep_len + 2, num_agents, 3))
+            self.assertTrue(np.array_equal(schedule[0], [e.goal for e in env.envs]))
+
+            control_freq = env.envs[0].control_freq
+            if quads_mode == 'dynamic_same_goal':
+                switch = scenario.control_step_for_sec
+                segments = np.arange(len(schedule)) // switch
+                self.assertTrue(np.array_equal(schedule, schedule[segments * switch]))
+            elif quads_mode == 'ep_lissajous3D':
+                # the goals move by lissajous3D(tick) from the goal of the first drone of the previous tick
+                ticks = np.arange(1, len(schedule))
+                offsets = np.stack(scenario.lissajous3D(ticks / control_freq), axis=1)
+                self.assertTrue(np.allclose(schedule[1:], schedule[:-1, :1] + offsets[:, None]))
+            else:
+                # the goals of the reset until the tick 2, then all drones follow continuous curves
+                control_steps = int(5 * control_freq)
+                self.assertTrue(np.array_equal(schedule[1], schedule[0]))
+                self.assertTrue(np.array_equal(schedule[2:], np.repeat(schedule[2:, :1], num_agents, axis=1)))
+                ends = np.arange(control_steps, len(schedule), control_steps)
+                self.assertTrue(np.allclose(schedule[ends], schedule[ends - 1]))
+
+            for _ in range(int(5.5 * control_freq)):
+                env.step([env.action_space.sample() for _ in range(num_agents)])
+                tick = env.envs[0].tick
+                self.assertTrue(np.array_equal([e.goal for e in env.envs], schedule[tick]))
+            self.assertTrue(np.array_equal(scenario.goals, schedule[tick]))
+            env.close()
+
+    def test_formation_templates(self):
+        def generate_goals_reference(formation, num_agents, num_agents_per_layer, formation_size, center, layer_dist):
+            # goals of the agents one by one, as QuadrotorScenario.generate_goals() used to
+            goals = []
+            for i in range(num_agents):
+                layer = i // num_agents_per_layer
+                agents_in_layer = min(num_agents_per_layer, num_agents - layer * num_agents_per_layer)
+                if formation.startswith('circle'):
+                    degree = 2 * np.pi * (i % agents_in_layer) / agents_in_layer
+                    goals.append(get_goal_by_formation(formation, formation_size * np.cos(degree),
+                                                       formation_size * np.sin(degree), layer * layer_dist))
+                elif formation.startswith('grid'):
+                    dim_1, dim_2 = get_grid_dim_number(agents_in_layer)
+                    goals.append(get_goal_by_formation(formation, formation_size * (i % dim_2),
+                                                       formation_size * (int(i / dim_2) % dim_1), layer * layer_dist))
+                elif formation == 'cube':
+                    floor_dim_size = int(np.power(num_agents, 1.0 / 3))
+                    goals.append([center[2] + formation_size * (i // np.square(floor_dim_size)),
+                                  formation_size * (int(i / floor_dim_size) % floor_dim_size),
+                                  formation_size * (i % floor_dim_size)])
+            if formation == 'sphere':
+                return formation_size * np.array(generate_points(num_agents)) + center
+            goals = np.array(goals)
+            if formation.startswith('circle'):
+                return goals + center
+            return goals - np.mean(goals, axis=0) + center
+
+        env = create_env(8)
+        scenario = env.scenario
+        cache = FormationTemplateCache(maxsize=4)
+        center = np.array([0.5, -1.0, 2.0])
+        for formation in QUADS_FORMATION_LIST:
+            for num_agents in [1, 5, 8, 19, 64]:
+                for num_agents_per_layer in [8, 50]:
+                    templates = cache.get(formation, num_agents, num_agents_per_layer)
+                    self.assertIs(cache.get(formation, num_agents, num_agents_per_layer), templates)
+                    self.assertFalse(templates[0].flags.writeable)
+
+                    scenario.formation, scenario.num_agents_per_layer = formation, num_agents_per_layer
+                    scenario.formation_size = 0.37
+                    goals = scenario.generate_goals(num_agents, formation_center=center, layer_dist=0.29)
+                    expected = generate_goals_reference(formation, num_agents, num_agents_per_layer, 0.37, center, 0.29)
+                    self.assertTrue(np.allclose(goals, expected, rtol=0., atol=1e-12))
+
+        self.assertEqual(len(cache.templates), 4)
+        self.assertEqual(cache.hit_rate(), 0.5)
+        with self.assertRaises(NotImplementedError):
+            cache.get('triangle', 4, 8)
+        env.close()
+
 
 class TestReplayBuffer(TestCase):
     def test_replay(self):
@@ -118,3 +449,66 @@ class TestReplayBuffer(TestCase):
             # this env self-resets
 
         env.close()
+
+    def test_replay_episode_rewards(self):
+        num_agents = 4
+        env = ExperienceReplayWrapper(create_env(num_agents, use_replay_buffer=True), replay_buffer_sample_prob=1.0)
+        obs = env.reset()
+        for _ in range(50):
+            obs, _, _, _ = env.step([env.action_space.sample() for _ in range(num_agents)])
+        env.save_checkpoint(obs)
+        env.replay_buffer.write_cp_to_buffer(*env.episode_checkpoints[-1])
+        self.assertTrue(env.env.reward_components.episode.any())
+
+        # the sums of a replayed episode only count the replayed steps
+        env.env.activate_replay_buffer = True
+        env.new_episode()
+        self.assertEqual(env.replayed_events, 1)
+        self.assertFalse(env.env.reward_components.episode.any())
+        step_sums = 0.
+        for _ in range(10):
+            env.step([env.action_space.sample() for _ in range(num_agents)])
+            step_sums = step_sums + env.env.reward_components.step
+        self.assertTrue(np.allclose(env.env.reward_components.episode, step_sums))
+        env.close()
+
+
+class TestVecEnv(TestCase):
+    def test_basic(self):
+        num_envs, num_agents = 3, 2
+        env = QuadrotorVecEnvMulti(
+            num_envs=num_envs, num_agents=num_agents, dynamics_params='Crazyflie', sense_noise='default',
+            init_random_state=True, ep_time=0.5, swarm_obs='pos_vel_goals', quads_use_numba=True,
+            dynamics_change=dict(noise=dict(thrust_noise_ratio=0.05), damp=dict(vel=0, omega_quadratic=0)),
+        )
+        self.assertEqual(env.num_agents, num_envs * num_agents)
+
+        obs = env.reset()
+        self.assertEqual(obs.shape, (num_envs * num_agents, env.observation_space.shape[0]))
+
+        # swarms share the dynamics engine of the vector env
+        for k, swarm_env in enumerate(env.envs):
+            self.assertTrue(np.shares_memory(swarm_env.envs[0].dynamics.pos, env.swarm_dynamics.pos))
+            self.assertTrue(np.array_equal(swarm_env.envs[1].dynamics.pos, env.swarm_dynamics.pos[k * num_agents + 1]))
+
+        # the swarms are stepped in lockstep here, so all of them finish their episodes at the same tick
+        for i in range(120):
+            obs, rewards, dones, infos = env.step([env.action_space.sample() for _ in range(env.num_agents)])
+            self.assertEqual(obs.shape[0], env.num_agents)
+            self.assertEqual(len(rewards), env.num_agents)
+            self.assertEqual(len(infos), env.num_agents)
+            if any(dones):
+                self.assertTrue(all(dones))
+                self.assertIn('episode_extra_stats', infos[0])
+
+        # a swarm that is reset on its own does not touch the others
+        pos_before = env.swarm_dynamics.pos.copy()
+        env.envs[1].reset()
+        self.assertTrue(np.array_equal(env.swarm_dynamics.pos[:num_agents], pos_before[:num_agents]))
+        self.assertTrue(np.array_equal(env.swarm_dynamics.pos[2 * num_agents:], pos_before[2 * num_agents:]))
+        env.close()
+
+        for use_numba in ('fused', 'parallel'):
+            with self.assertRaises(ValueError):
+                QuadrotorVecEnvMulti(num_envs=num_envs, num_agents=num_agents, dynamics_params='Crazyflie',
+                                     quads_use_numba=use_numba)
@@ -1,4 +1,5 @@
 import time
+from types import SimpleNamespace
 from unittest import TestCase
 import numpy.random as nr
 
@@ -7,7 +8,18 @@ import numpy
 from gym_art.quadrotor_multi.tests.test_multi_env import create_env
 from gym_art.quadrotor_multi.numba_utils import OUNoiseNumba
 from gym_art.quadrotor_multi.quad_utils import OUNoise
-from gym_art.quadrotor_multi.sensor_noise import SensorNoise
+from gym_art.quadrotor_multi.sensor_noise import SensorNoise, SwarmSensorNoise
+from gym_art.quadrotor_multi import get_state
+from gym_art.quadrotor_multi.noise_pool import NoisePool
+from gym_art.quadrotor_multi.quad_rewards import AGENT_REWARD_COMPONENTS, compute_rewards_batched
+from gym_art.quadrotor_multi.quadrotor_single import compute_reward_weighted
+from gym_art.quadrotor_multi.quad_utils import calculate_collision_matrix, calculate_collision_pairs, \
+    calculate_drone_proximity_penalties, calculate_drone_proximity_penalties_sparse, collisions_between_drones_numba, \
+    collisions_with_obstacles_numba, compute_col_norm_and_new_velocities, perform_collision_between_drones, \
+    perform_collisions_between_drones, sample_collision_omega_kicks, calculate_obst_drone_proximity_penalties
+from gym_art.quadrotor_multi.quad_obstacle_sdf import ObstacleSDF
+from gym_art.quadrotor_multi.quadrotor_multi_obstacles import MultiObstacles
+from gym_art.quadrotor_multi.quadrotor_obstacles import TILES, ObstacleMap, _place_obstacles
 
 
 class TestOpt(TestCase):
@@ -117,3 +129,679 @@ class TestOpt(TestCase):
             self.assertTrue(numpy.allclose(new_o1, new_o2))
             self.assertTrue(numpy.allclose(new_r1, new_r2))
             env.close()
+
+    def test_swarm_step(self):
+        num_agents, dt, steps = 4, 0.005, 120
+        env = create_env(num_agents)
+        env.reset()
+
+        import copy
+        swarm = env.swarm_dynamics
+        swarm_numba = copy.deepcopy(swarm)
+        swarm_numba.use_numba = True
+        dynamics = [copy.deepcopy(e.dynamics) for e in env.envs]
+
+        thrusts = numpy.random.random((num_agents, 4))
+        thrust_noise = 0.01 * numpy.random.normal(size=(num_agents, 4))
+        for _ in range(steps):
+            for i, d in enumerate(dynamics):
+                d.step1(thrusts[i], dt, thrust_noise[i])
+        swarm.step(dt, steps_num=steps, thrust_cmds=thrusts, thrust_noise=thrust_noise)
+        swarm_numba.step(dt, steps_num=steps, thrust_cmds=thrusts, thrust_noise=thrust_noise)
+
+        for s in (swarm, swarm_numba):
+            for i, d in enumerate(dynamics):
+                self.assertTrue(numpy.allclose(s.pos[i], d.pos))
+                self.assertTrue(numpy.allclose(s.vel[i], d.vel))
+                self.assertTrue(numpy.allclose(s.rot[i], d.rot))
+                self.assertTrue(numpy.allclose(s.omega[i], d.omega))
+                self.assertTrue(numpy.allclose(s.accelerometer[i], d.accelerometer))
+                self.assertTrue(numpy.allclose(s.thrust_cmds_damp[i], d.thrust_cmds_damp))
+
+        # env dynamics are views onto the swarm arrays
+        self.assertTrue(numpy.shares_memory(env.envs[1].dynamics.pos, swarm.pos))
+        env.close()
+
+    def test_fused_step(self):
+        num_agents = 6
+        for local_obs in (-1, 3):
+            env = create_env(num_agents, use_numba='fused', local_obs=local_obs)
+            env.apply_collision_force = False
+            env.collision_falloff_radius = 4.0
+            env.rew_coeff['quadcol_bin_smooth_max'] = 10.0
+
+            # compare without noise, the fused path draws from a different random generator
+            env.swarm_dynamics.thrust_noise_sigma[:] = 0.
+            env.fused_step.sense_noise_on = False
+            for e in env.envs:
+                e.sense_noise.bypass = True
+                e.dynamics.thrust_noise.sigma = 0.
+
+            env.reset()
+            import copy
+            env_ref = copy.deepcopy(env)
+            env_ref.fused_step = None
+
+            for _ in range(50):
+                actions = [env.action_space.sample() for _ in range(num_agents)]
+                obs, rewards, dones, infos = env.step(actions)
+                obs_ref, rewards_ref, dones_ref, infos_ref = env_ref.step(actions)
+
+                self.assertTrue(numpy.allclose(obs, obs_ref, atol=1e-6))
+                self.assertTrue(numpy.allclose(rewards, rewards_ref))
+                self.assertEqual(dones, dones_ref)
+                self.assertTrue(numpy.allclose(env.reward_components.step, env_ref.reward_components.step))
+                self.assertTrue(numpy.array_equal(env.reward_components.step_written,
+                                                  env_ref.reward_components.step_written))
+                self.assertEqual(env.collisions_per_episode, env_ref.collisions_per_episode)
+            env.close()
+
+    def test_parallel_step(self):
+        num_agents = 24
+        env = create_env(num_agents, use_numba='parallel', local_obs=6)
+        self.assertTrue(env.fused_step.parallel)
+        env.apply_collision_force = False
+
+        env.swarm_dynamics.thrust_noise_sigma[:] = 0.
+        env.fused_step.sense_noise_on = False
+        env.reset()
+
+        import copy
+        env_serial = copy.deepcopy(env)
+        env_serial.fused_step.parallel = False
+
+        for _ in range(50):
+            actions = [env.action_space.sample() for _ in range(num_agents)]
+            obs, rewards, dones, infos = env.step(actions)
+            obs_serial, rewards_serial, dones_serial, infos_serial = env_serial.step(actions)
+
+            self.assertTrue(numpy.allclose(obs, obs_serial))
+            self.assertTrue(numpy.allclose(rewards, rewards_serial))
+            self.assertEqual(dones, dones_serial)
+            self.assertEqual(env.collisions_per_episode, env_serial.collisions_per_episode)
+        env.close()
+
+    def test_numba_step_allocations(self):
+        import copy
+        import tracemalloc
+        from numba import types
+        from numba.core.runtime import rtsys, _nrt_python
+        from gym_art.quadrotor_multi.numba_utils import ou_noise_rows_step_numba, ou_noise_step_numba
+        from gym_art.quadrotor_multi.quadrotor_single import calculate_torque_integrate_rotations_and_update_omega, \
+            compute_velocity_and_acceleration
+        from gym_art.quadrotor_multi.quadrotor_swarm_dynamics import swarm_step_numba
+
+        num_agents, dt, steps = 2, 0.005, 40
+        env = create_env(num_agents, use_numba=True)
+        env.reset()
+        dynamics = env.envs[0].dynamics
+        swarm = copy.deepcopy(env.swarm_dynamics)
+        thrusts = numpy.random.random(4)
+        swarm_thrusts = numpy.random.random((num_agents, 4))
+
+        # jit compilation, then restart the re-orthogonalization counters: the SVD every 0.5 sec does allocate
+        dynamics.step(thrusts, dt)
+        swarm.step(dt, steps_num=2, thrust_cmds=swarm_thrusts)
+        env.swarm_dynamics.since_last_svd[:] = 0.
+        swarm.since_last_svd[:] = 0.
+
+        # The numba dispatcher wraps every array argument into a runtime object for the duration of the call,
+        # any allocation on top of that was made by the kernels themselves
+        def num_array_args(kernel):
+            return sum(isinstance(arg, types.Array) for arg in kernel.nopython_signatures[-1].args)
+
+        wrappers_per_step = \
+            num_array_args(ou_noise_step_numba) + dynamics.dynamics_steps_num * (
+                num_array_args(calculate_torque_integrate_rotations_and_update_omega) +
+                num_array_args(compute_velocity_and_acceleration)) + \
+            num_array_args(ou_noise_rows_step_numba) + num_array_args(swarm_step_numba)
+
+        _nrt_python.memsys_enable_stats()
+        nrt_allocs = rtsys.get_allocation_stats().alloc
+        tracemalloc.start()
+        traced_start, _ = tracemalloc.get_traced_memory()
+        for _ in range(steps):
+            dynamics.step(thrusts, dt)
+            swarm.step(dt, steps_num=2, thrust_cmds=swarm_thrusts)
+        traced_end, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.assertEqual(traced_end, traced_start)
+        self.assertEqual(rtsys.get_allocation_stats().alloc - nrt_allocs, steps * wrappers_per_step)
+        env.close()
+
+    def test_integrators(self):
+        from gym_art.quadrotor_multi.quadrotor_swarm_dynamics import SwarmDynamics
+        from gym_art.quadrotor_multi.tests.benchmark_integrators import compare_integrators
+
+        # 2 sec of open loop flight, the error is relative to RK4 at 3200 Hz
+        errors = {(integrator, sim_steps): pos_err for integrator, sim_steps, pos_err, _, _ in compare_integrators(
+            num_agents=4, duration=2., schemes=[('euler', 2), ('rk4', 1)])}
+        # RK4 at the control frequency stays within 1 cm, while the default Euler at 200 Hz drifts by decimeters
+        self.assertLess(errors[('rk4', 1)], 0.01)
+        self.assertLess(errors[('rk4', 1)], 0.1 * errors[('euler', 2)])
+
+        with self.assertRaises(ValueError):
+            SwarmDynamics(4, use_numba=True, integrator='midpoint')
+        with self.assertRaises(ValueError):
+            SwarmDynamics(4, use_numba=False, integrator='rk4')
+
+    def test_quaternion_attitude(self):
+        import copy
+        from gym_art.quadrotor_multi.tests.benchmark_integrators import make_swarm, make_thrusts
+
+        swarm = make_swarm(num_agents=8)
+        thrusts = make_thrusts(swarm, num_steps=200)
+        for integrator in ('euler', 'rk4'):
+            swarm_rot = copy.deepcopy(swarm)
+            swarm_quat = copy.deepcopy(swarm)
+            swarm_rot.integrator = swarm_quat.integrator = integrator
+            swarm_quat.attitude = 'quat'
+            for i in range(swarm_quat.num_agents):
+                swarm_quat.rot_assigned(i)
+
+            for thrust_cmds in thrusts:
+                swarm_rot.step(dt=0.005, steps_num=2, thrust_cmds=thrust_cmds, thrust_noise=swarm.thrust_noise)
+                swarm_quat.step(dt=0.005, steps_num=2, thrust_cmds=thrust_cmds, thrust_noise=swarm.thrust_noise)
+
+            # the matrices are only computed on demand
+            self.assertTrue(swarm_quat.rot_stale)
+            swarm_quat.sync_rot()
+            self.assertFalse(swarm_quat.rot_stale)
+            self.assertTrue(numpy.allclose(swarm_quat.rot, swarm_rot.rot, atol=1e-6))
+            self.assertTrue(numpy.allclose(swarm_quat.pos, swarm_rot.pos, atol=1e-6))
+            self.assertTrue(numpy.allclose(swarm_quat.accelerometer, swarm_rot.accelerometer, atol=1e-6))
+
+        # the numba (lazy rot) and the fused (rot materialized in the kernel) paths agree
+        num_agents = 4
+        env = create_env(num_agents, use_numba='fused', quads_attitude='quat')
+        env.apply_collision_force = False
+        env.swarm_dynamics.thrust_noise_sigma[:] = 0.
+        env.fused_step.sense_noise_on = False
+        for e in env.envs:
+            e.sense_noise.bypass = True
+            e.dynamics.thrust_noise.sigma = 0.
+        env.reset()
+        env_ref = copy.deepcopy(env)
+        env_ref.fused_step = None
+
+        for _ in range(50):
+            actions = [env.action_space.sample() for _ in range(num_agents)]
+            obs, rewards, _, _ = env.step(actions)
+            obs_ref, rewards_ref, _, _ = env_ref.step(actions)
+            self.assertTrue(numpy.allclose(obs, obs_ref, atol=1e-6))
+            self.assertTrue(numpy.allclose(rewards, rewards_ref))
+        env.close()
+
+        # sensor noise with a known quaternion skips the rot -> quat conversion, same result
+        rot = env.envs[0].dynamics.rot.copy()
+        quat = env.envs[0].dynamics.quat.copy()
+        sense_noise = SensorNoise(bypass=False, quat_norm_std=0.1)
+        nr.seed(0)
+        noisy = sense_noise.add_noise(numpy.zeros(3), numpy.zeros(3), rot, numpy.zeros(3), numpy.zeros(3), 0.005)
+        nr.seed(0)
+        noisy_quat = sense_noise.add_noise(numpy.zeros(3), numpy.zeros(3), rot, numpy.zeros(3), numpy.zeros(3), 0.005,
+                                           quat=quat)
+        self.assertTrue(numpy.allclose(noisy[2], noisy_quat[2]))
+
+        with self.assertRaises(ValueError):
+            create_env(num_agents, use_numba=False, quads_attitude='quat')
+
+    def test_float32_drift(self):
+        from gym_art.quadrotor_multi.quadrotor_control import NonlinearPositionController
+
+        num_agents = 4
+        envs = {p: create_env(num_agents, use_numba=True, quads_precision=p) for p in ('float64', 'float32')}
+        for env in envs.values():
+            env.swarm_dynamics.thrust_noise_sigma[:] = 0.
+            for e in env.envs:
+                e.sense_noise.bypass = True
+        obs = {p: env.reset() for p, env in envs.items()}
+        self.assertEqual(obs['float32'][0].dtype, numpy.float32)
+
+        # same initial state, 1 m away from the goals, then closed loop control for a 15 sec episode
+        swarm64, swarm32 = envs['float64'].swarm_dynamics, envs['float32'].swarm_dynamics
+        goals = numpy.array([e.goal[:3] for e in envs['float64'].envs])
+        swarm64.pos[:] = goals + [1., 0.5, -0.5]
+        swarm64.vel[:] = swarm64.omega[:] = 0.
+        swarm64.rot[:] = numpy.eye(3)
+        for name in swarm64._array_names():
+            getattr(swarm32, name)[...] = getattr(swarm64, name)
+        self.assertEqual(swarm32.pos.dtype, numpy.float32)
+
+        controllers = {p: [NonlinearPositionController(e.dynamics, tf_control=False) for e in env.envs]
+                       for p, env in envs.items()}
+        e0 = envs['float64'].envs[0]
+        max_pos_err = max_rot_err = 0.
+        for _ in range(int(15 * e0.control_freq)):
+            for p, env in envs.items():
+                env.swarm_dynamics.batch_step = True
+                for controller, e, goal in zip(controllers[p], env.envs, goals):
+                    controller.step(e.dynamics, goal, e0.dt)
+                env.swarm_dynamics.batch_step = False
+                env.swarm_dynamics.step(dt=e0.dt, steps_num=e0.sim_steps)
+            max_pos_err = max(max_pos_err, numpy.abs(swarm64.pos - swarm32.pos).max())
+            max_rot_err = max(max_rot_err, numpy.abs(swarm64.rot - swarm32.rot).max())
+
+        self.assertLess(max_pos_err, 1e-4)
+        self.assertLess(max_rot_err, 1e-4)
+        self.assertLess(numpy.abs(swarm32.pos - goals).max(), 1e-3)
+
+        # the whole observation pipeline stays in float32, with and without the fused step
+        for use_numba in (True, 'fused'):
+            env = create_env(num_agents, use_numba=use_numba, quads_precision='float32')
+            env.reset()
+            obs, _, _, _ = env.step([env.action_space.sample() for _ in range(num_agents)])
+            self.assertEqual(numpy.asarray(obs).dtype, numpy.float32)
+            env.close()
+        for env in envs.values():
+            env.close()
+
+        with self.assertRaises(ValueError):
+            create_env(num_agents, use_numba=True, quads_precision='float16')
+
+    def test_noise_pool(self):
+        # the samples only depend on the seed and the sequence of requests, also across block refills
+        pools = [NoisePool(block_size=100, seed=7) for _ in range(2)]
+        samples = [[numpy.concatenate([p.normal((3, 3)).ravel(), p.uniform(4)]) for _ in range(50)] for p in pools]
+        self.assertTrue(numpy.array_equal(samples[0], samples[1]))
+        self.assertGreater(pools[0].num_refills, 2)
+        self.assertEqual(pools[0].normal(1000).shape, (1000,))
+
+        pool = NoisePool(seed=0)
+        normals, uniforms = pool.normal((20000, 4)), pool.uniform(20000)
+        self.assertAlmostEqual(normals.std(), 1., delta=0.02)
+        self.assertTrue(numpy.all(uniforms >= -1.) and numpy.all(uniforms < 1.))
+
+        # noise models with a pool have the same statistics as with numpy.random
+        for use_numba in (False, True):
+            sense_noise = SensorNoise(bypass=False, use_numba=use_numba, noise_pool=NoisePool(seed=1))
+            add_noise = sense_noise.add_noise_numba if use_numba else sense_noise.add_noise
+            noisy_pos = numpy.array([add_noise(numpy.zeros(3), numpy.zeros(3), numpy.eye(3), numpy.zeros(3),
+                                               numpy.zeros(3), 0.005)[0] for _ in range(5000)])
+            self.assertAlmostEqual(noisy_pos.std(), sense_noise.pos_norm_std, delta=0.05 * sense_noise.pos_norm_std)
+
+            ou_noise_cls = OUNoiseNumba if use_numba else OUNoise
+            ou_noise = ou_noise_cls(4, sigma=0.3, noise_pool=NoisePool(seed=1))
+            ou_samples = numpy.array([ou_noise.noise().copy() for _ in range(5000)])
+            # stationary std of the discrete process, sigma / sqrt(1 - (1 - theta) ** 2)
+            self.assertAlmostEqual(ou_samples[1000:].std(), 0.3 / (1 - 0.85 ** 2) ** 0.5, delta=0.1)
+
+        # seeded envs with a noise pool produce the same trajectories
+        for use_numba in (False, True):
+            trajectories = []
+            for seed in (3, 3, 4):
+                env = create_env(2, use_numba=use_numba, quads_noise_pool=True)
+                env.seed(seed)
+                nr.seed(0)  # initial states and goals
+                obs = [env.reset()]
+                for _ in range(20):
+                    obs.append(env.step([numpy.full(4, 0.5)] * 2)[0])
+                trajectories.append(numpy.array(obs))
+                env.close()
+            self.assertTrue(numpy.array_equal(trajectories[0], trajectories[1]))
+            self.assertFalse(numpy.array_equal(trajectories[0], trajectories[2]))
+
+        sense_noise = SensorNoise(bypass=False, noise_pool=NoisePool(seed=0))
+        steps = 2000
+        start = time.time()
+        for _ in range(steps):
+            sense_noise.add_noise(numpy.zeros(3), numpy.zeros(3), numpy.eye(3), numpy.zeros(3), numpy.zeros(3), 0.005)
+        print('Sensor noise with pool, us/call: ', (time.time() - start) / steps * 1e6)
+
+    def test_swarm_sensor_noise(self):
+        num_agents, dt = 4000, 0.005
+        pos, vel, omega = numpy.random.uniform(-1., 1., size=(3, num_agents, 3))
+        acc = numpy.random.uniform(5., 10., size=(num_agents, 3))
+        rot = numpy.repeat(numpy.eye(3)[None], num_agents, axis=0)
+
+        # same statistics as the per-agent noise, including the rotation and the gyro bias models
+        sensor_noise = SensorNoise(bypass=False, quat_norm_std=0.05, gyro_norm_std=1.)
+        swarm_noise = SwarmSensorNoise(num_agents, sensor_noise, noise_pool=NoisePool(seed=0))
+        for _ in range(10):
+            swarm_noisy = swarm_noise.add_noise(pos, vel, rot, omega, acc, dt)
+        self.assertEqual(swarm_noise.gyro_bias.shape, (num_agents, 3))
+        single_noisy = []
+        for i in range(num_agents):
+            # gyro bias of every agent after the same number of steps
+            agent_noise = SensorNoise(bypass=False, quat_norm_std=0.05, gyro_norm_std=1.)
+            for _ in range(10):
+                noisy = agent_noise.add_noise(pos[i], vel[i], rot[i], omega[i], acc[i], dt)
+            single_noisy.append(noisy)
+        single_noisy = [numpy.array(m) for m in zip(*single_noisy)]
+
+        for swarm_m, single_m, true_m in zip(swarm_noisy, single_noisy, (pos, vel, rot, omega, acc)):
+            self.assertEqual(swarm_m.shape, true_m.shape)
+            swarm_std, single_std = (swarm_m - true_m).std(axis=0), (single_m - true_m).std(axis=0)
+            self.assertTrue(numpy.allclose(swarm_std, single_std, rtol=0.1, atol=1e-4), (swarm_std, single_std))
+        # rotations stay orthonormal
+        self.assertTrue(numpy.allclose(numpy.matmul(swarm_noisy[2], swarm_noisy[2].transpose(0, 2, 1)), numpy.eye(3)))
+
+        sensor_noise.bypass = True
+        self.assertIs(swarm_noise.add_noise(pos, vel, rot, omega, acc, dt)[0], pos)
+
+        # batched observations of the multi env are the same as the per-agent ones
+        for obs_repr in ('xyz_vxyz_R_omega', 'xyz_vxyz_R_omega_wall'):
+            env = create_env(4, use_numba=True, obs_repr=obs_repr)
+            for e in env.envs:
+                e.sense_noise.bypass = True
+            env.reset()
+            obs, _, _, _ = env.step([env.action_space.sample() for _ in range(4)])
+            self_obs = numpy.array([e.state_vector(e) for e in env.envs])
+            self.assertTrue(numpy.array_equal(numpy.asarray(obs)[:, :self_obs.shape[1]], self_obs))
+            env.close()
+
+        env = create_env(64, use_numba=True)
+        env.reset()
+        steps = 100
+        start = time.time()
+        for _ in range(steps):
+            get_state.swarm_state_xyz_vxyz_R_omega(env)
+        swarm_sec = (time.time() - start) / steps
+        start = time.time()
+        for _ in range(steps):
+            [e.state_vector(e) for e in env.envs]
+        print(f'Observations of 64 agents, batched: {swarm_sec * 1e6:.1f} us, per agent: '
+              f'{(time.time() - start) / steps * 1e6:.1f} us')
+        env.close()
+
+    def test_batched_rewards(self):
+        num_agents, dt = 64, 0.01
+        rng = numpy.random.default_rng(0)
+        pos, vel, omega, goals = rng.uniform(-1.5, 1.5, size=(4, num_agents, 3))
+        rot = numpy.linalg.qr(rng.normal(size=(num_agents, 3, 3)))[0]
+        actions, actions_prev = rng.uniform(-1., 1., size=(2, num_agents, 4))
+        crashed = rng.uniform(size=num_agents) < 0.2
+        rew_coeff = dict(pos=1., effort=0.05, crash=1., orient=1., yaw=0.1, rot=0.2, attitude=0.3, spin=0.1,
+                         action_change=0.05, vel=0.1)
+
+        class Dynamics:
+            pass
+
+        for quads_settle in (False, True):
+            settle_kwargs = dict(quads_settle=quads_settle, quads_settle_range_meters=1.5,
+                                 quads_vel_reward_out_range=0.8)
+            rewards, components = compute_rewards_batched(pos, vel, rot, omega, goals, actions, actions_prev, crashed,
+                                                          rew_coeff, dt, **settle_kwargs)
+            self.assertEqual(components.shape, (num_agents, len(AGENT_REWARD_COMPONENTS)))
+            for i in range(num_agents):
+                dynamics = Dynamics()
+                dynamics.pos, dynamics.vel, dynamics.rot, dynamics.omega = pos[i], vel[i], rot[i], omega[i]
+                reward, rew_info = compute_reward_weighted(dynamics, goals[i], actions[i], dt, crashed[i], 0,
+                                                           rew_coeff, actions_prev[i], **settle_kwargs)
+                self.assertAlmostEqual(rewards[i], reward)
+                for col, name in enumerate(AGENT_REWARD_COMPONENTS):
+                    self.assertAlmostEqual(components[i, col], rew_info[name])
+
+        start = time.time()
+        for _ in range(100):
+            compute_rewards_batched(pos, vel, rot, omega, goals, actions, actions_prev, crashed, rew_coeff, dt)
+        batched_sec = (time.time() - start) / 100
+        start = time.time()
+        for i in range(num_agents):
+            dynamics = Dynamics()
+            dynamics.pos, dynamics.vel, dynamics.rot, dynamics.omega = pos[i], vel[i], rot[i], omega[i]
+            compute_reward_weighted(dynamics, goals[i], actions[i], dt, crashed[i], 0, rew_coeff, actions_prev[i])
+        print(f'Rewards of {num_agents} agents, batched: {batched_sec * 1e6:.1f} us, per agent: '
+              f'{(time.time() - start) * 1e6:.1f} us')
+
+    def test_grid_broad_phase(self):
+        arm, dt, hitbox, falloff = 0.046, 0.01, 2.0, 4.0
+        rng = numpy.random.default_rng(0)
+        for num_agents in (2, 64, 1000):
+            pos = rng.uniform(-0.1, 0.1, size=(num_agents, 3)) * num_agents ** (1 / 3)
+            pos[1] = pos[0]  # drones at the same position
+            col_matrix, collisions, dist = calculate_collision_matrix(pos, arm, hitbox)
+            pairs, grid_collisions = calculate_collision_pairs(pos, arm, hitbox, falloff)
+            self.assertTrue(numpy.array_equal(grid_collisions, collisions))
+
+            pairs_i, pairs_j, pairs_dist = pairs
+            close = numpy.triu(dist < falloff * arm, k=1)
+            self.assertTrue(numpy.array_equal(numpy.stack((pairs_i, pairs_j)), numpy.stack(numpy.nonzero(close))))
+            self.assertTrue(numpy.allclose(pairs_dist, dist[close]))
+
+            penalties = calculate_drone_proximity_penalties(dist, arm, dt, falloff, 10.0, num_agents)
+            sparse_penalties = calculate_drone_proximity_penalties_sparse(pairs, arm, dt, falloff, 10.0, num_agents)
+            self.assertTrue(numpy.allclose(sparse_penalties, penalties))
+
+        # same rewards and collisions in the env
+        num_agents = 16
+        env = create_env(num_agents, use_numba=True, quads_collision_broad_phase='grid')
+        env.apply_collision_force = False
+        env.collision_falloff_radius = 4.0
+        env.rew_coeff['quadcol_bin_smooth_max'] = 10.0
+        env.swarm_dynamics.thrust_noise_sigma[:] = 0.
+        for e in env.envs:
+            e.sense_noise.bypass = True
+            e.dynamics.thrust_noise.sigma = 0.
+        env.reset()
+        import copy
+        env_dense = copy.deepcopy(env)
+        env_dense.collision_broad_phase = 'dense'
+        for _ in range(50):
+            actions = [env.action_space.sample() for _ in range(num_agents)]
+            _, rewards, _, _ = env.step(actions)
+            _, rewards_dense, _, _ = env_dense.step(actions)
+            self.assertTrue(numpy.allclose(rewards, rewards_dense))
+            self.assertTrue(numpy.array_equal(env.all_collisions['drone'], env_dense.all_collisions['drone']))
+        env.close()
+
+        for use_numba in ('fused', 'parallel'):
+            with self.assertRaises(ValueError):
+                create_env(num_agents, use_numba=use_numba, quads_collision_broad_phase='grid')
+
+        pos = rng.uniform(-5., 5., size=(2000, 3))
+        for name, func in (('dense', lambda: calculate_collision_matrix(pos, arm, hitbox)),
+                           ('grid', lambda: calculate_collision_pairs(pos, arm, hitbox, falloff))):
+            func()
+            start = time.time()
+            for _ in range(10):
+                func()
+            print(f'Collisions of 2000 drones, {name}: {(time.time() - start) / 10 * 1e3:.2f} ms')
+
+    def test_collision_response(self):
+        rng = numpy.random.default_rng(0)
+        num_agents = 64
+        pos = rng.uniform(-0.3, 0.3, size=(num_agents, 3))
+        vel = rng.normal(size=(num_agents, 3))
+        omega = rng.normal(size=(num_agents, 3))
+        _, pairs, _ = calculate_collision_matrix(pos, 0.046, 2.0)
+        self.assertGreater(len(pairs), 10)
+
+        # without the random components: the elastic collisions of the pairs in order
+        dyns = [SimpleNamespace(pos=pos[i].copy(), vel=vel[i].copy(), omega=omega[i].copy()) for i in range(num_agents)]
+        for i, j in pairs:
+            v1new, v2new, collision_norm = compute_col_norm_and_new_velocities(dyns[i], dyns[j])
+            dyns[i].vel += (v2new - v1new) * collision_norm
+            dyns[j].vel += (v1new - v2new) * collision_norm
+        vel_batched, omega_batched = vel.copy(), omega.copy()
+        zeros = numpy.zeros((len(pairs), 3))
+        collisions_between_drones_numba(pos, vel_batched, omega_batched, pairs, zeros, zeros, zeros)
+        self.assertTrue(numpy.allclose(vel_batched, [d.vel for d in dyns]))
+
+        # the omega kicks of a pair cancel out, their magnitudes are in [omega_max / 2, omega_max]
+        vel_batched, omega_batched = vel.copy(), omega.copy()
+        perform_collisions_between_drones(pos, vel_batched, omega_batched, pairs)
+        self.assertTrue(numpy.allclose(omega_batched.sum(axis=0), omega.sum(axis=0)))
+        kicks = sample_collision_omega_kicks(10000)
+        magnitudes = numpy.linalg.norm(kicks, axis=1)
+        self.assertTrue(numpy.all((magnitudes > 10 * numpy.pi - 1e-3) & (magnitudes < 20 * numpy.pi)))
+
+        obstacles_pos, obstacles_vel = rng.uniform(-0.3, 0.3, size=(2, 3)), rng.normal(size=(2, 3))
+        obst_pairs = numpy.array([[0, 0], [0, 1], [5, 1]])
+        vel_batched, omega_batched = vel.copy(), omega.copy()
+        collisions_with_obstacles_numba(pos, vel_batched, omega_batched, obstacles_pos, obstacles_vel, obst_pairs,
+                                        zeros[:3], zeros[:3])
+        dyns = [SimpleNamespace(pos=pos[i].copy(), vel=vel[i].copy()) for i in range(num_agents)]
+        for i, o in obst_pairs:
+            obstacle = SimpleNamespace(pos=obstacles_pos[o], vel=obstacles_vel[o])
+            v1new, v2new, collision_norm = compute_col_norm_and_new_velocities(obstacle, dyns[i])
+            dyns[i].vel += (v1new - v2new) * collision_norm
+        self.assertTrue(numpy.allclose(vel_batched, [d.vel for d in dyns]))
+
+        def per_pair():
+            for i, j in pairs:
+                perform_collision_between_drones(dyns[i], dyns[j])
+
+        dyns = [SimpleNamespace(pos=pos[i].copy(), vel=vel[i].copy(), omega=omega[i].copy()) for i in range(num_agents)]
+        for name, func in (('per pair', per_pair),
+                           ('batched', lambda: perform_collisions_between_drones(pos, vel.copy(), omega.copy(), pairs))):
+            start = time.time()
+            for _ in range(100):
+                func()
+            print(f'Response to {len(pairs)} collisions, {name}: {(time.time() - start) / 100 * 1e3:.3f} ms')
+
+    def test_obstacle_sdf(self):
+        rng = numpy.random.default_rng(0)
+        num_agents, num_obstacles, arm, dt, fall_off, max_penalty = 500, 200, 0.046, 0.01, 10.0, 10.0
+        room_box = numpy.array([[-5., -5., 0.], [5., 5., 10.]])
+        obstacles = MultiObstacles(mode='static', num_obstacles=num_obstacles, shape='random', quad_size=arm)
+        obstacles.pos[:] = rng.uniform(room_box[0] + 0.5, room_box[1] - 0.5, size=(num_obstacles, 3))
+        obstacles.size[:] = rng.uniform(0.15, 0.5, size=num_obstacles)
+        obstacles.shape_ids[:] = rng.integers(2, size=num_obstacles)
+        set_obstacles = rng.uniform(size=num_obstacles) < 0.9
+        penalty_radius = fall_off * arm + obstacles.size / 2
+
+        sdf = ObstacleSDF(resolution=0.05)
+        sdf.build(room_box, obstacles.pos, obstacles.size, obstacles.shape_ids, set_obstacles, penalty_radius)
+
+        def dense(points):
+            collision_matrix, _, distance_matrix = obstacles.collision_detection(points, set_obstacles)
+            penalties = calculate_obst_drone_proximity_penalties(distance_matrix, arm, dt, fall_off, max_penalty,
+                                                                 len(points), obstacles.size / 2)
+            return collision_matrix.any(axis=1), penalties
+
+        # exact at the grid nodes, drones around the obstacles
+        nodes = numpy.rint((obstacles.pos[rng.integers(num_obstacles, size=num_agents)] - room_box[0]) / 0.05)
+        points = room_box[0] + 0.05 * (nodes + rng.integers(-5, 6, size=(num_agents, 3)))
+        colliding, penalties = dense(points)
+        self.assertGreater(colliding.sum(), 10)
+        self.assertTrue(numpy.array_equal(sdf.distance(points) < arm, colliding))
+        self.assertTrue(numpy.allclose(sdf.proximity_penalties(points, max_penalty, dt), penalties, atol=1e-5))
+        pairs = sdf.collision_detection(points, arm)
+        self.assertTrue(numpy.array_equal(pairs[:, 0], numpy.flatnonzero(colliding)))
+        collision_matrix, _, _ = obstacles.collision_detection(points, set_obstacles)
+        self.assertTrue(collision_matrix[pairs[:, 0], pairs[:, 1]].all())
+
+        # in between the nodes, up to the interpolation error
+        points = points + rng.uniform(-0.025, 0.025, size=(num_agents, 3))
+        colliding, penalties = dense(points)
+        self.assertGreater(numpy.mean((sdf.distance(points) < arm) == colliding), 0.97)
+        self.assertLess(numpy.abs(sdf.proximity_penalties(points, max_penalty, dt) - penalties).max(), 0.01)
+
+        for name, func in (('dense', lambda: dense(points)),
+                           ('sdf', lambda: (sdf.collision_detection(points, arm),
+                                            sdf.proximity_penalties(points, max_penalty, dt)))):
+            start = time.time()
+            for _ in range(20):
+                func()
+            print(f'Obstacle queries of {num_agents} drones, {num_obstacles} obstacles, {name}: '
+                  f'{(time.time() - start) / 20 * 1e3:.2f} ms')
+        start = time.time()
+        sdf.build(room_box, obstacles.pos, obstacles.size, obstacles.shape_ids, set_obstacles, penalty_radius)
+        print(f'SDF build: {(time.time() - start) * 1e3:.1f} ms')
+
+        # in the env: same collisions as the dense detection with obstacles placed on the drones
+        env = create_env(8, use_numba=True, quads_obstacle_mode='static', quads_obstacle_num=4, quads_obstacle_sdf=True)
+        env.reset()
+        env.apply_collision_force = False
+        env.swarm_dynamics.thrust_noise_sigma[:] = 0.
+        for e in env.envs:
+            e.sense_noise.bypass = True
+            e.dynamics.thrust_noise.sigma = 0.
+        env.set_obstacles[:] = True
+        env.multi_obstacles.pos[:] = env.swarm_dynamics.pos[:4] + [0.2, 0., 0.]
+        env.multi_obstacles.size[:] = 0.4
+        env.build_obstacle_sdf()
+        import copy
+        env_dense = copy.deepcopy(env)
+        env_dense.obstacle_sdf = None
+        for _ in range(5):
+            actions = numpy.zeros((8, 4))
+            _, rewards, _, _ = env.step(actions)
+            _, rewards_dense, _, _ = env_dense.step(actions)
+            self.assertTrue(numpy.array_equal(env.all_collisions['obstacle'], env_dense.all_collisions['obstacle']))
+            self.assertTrue(numpy.allclose(rewards, rewards_dense, atol=1e-3))
+        self.assertGreater(env.obst_quad_collisions_per_episode, 0)
+        env.close()
+
+        with self.assertRaises(ValueError):
+            create_env(8, quads_obstacle_mode='dynamic', quads_obstacle_num=4, quads_obstacle_sdf=True)
+
+    def test_obstacle_map(self):
+        num_obstacles, box, our_radius = 60, 40.0, 0.05
+
+        def place_obstacles_reference(np_random):
+            # full grid distance updates and a list of obstacles per tile
+            t = numpy.linspace(0, box, TILES + 1)[:-1]
+            scale = box / float(TILES)
+            x, y = numpy.meshgrid(t, t)
+            pts, dist = numpy.zeros((num_obstacles, 2)), x + numpy.inf
+            radii = numpy.sort(np_random.uniform(0.5, 2.0, size=num_obstacles))[::-1]
+            test_list = [[] for _ in range(TILES ** 2)]
+            for i in range(num_obstacles):
+                ok = numpy.where(dist.flat > radii[i])[0]
+                pt = scale * numpy.array(numpy.unravel_index(np_random.choice(ok), dist.shape))
+                d = numpy.sqrt((x - pt[1]) ** 2 + (y - pt[0]) ** 2) - radii[i]
+                for ind1d in numpy.where(d.flat <= 2 * our_radius + scale)[0]:
+                    test_list[ind1d].append(i)
+                dist = numpy.minimum(dist, d)
+                pts[i, :] = pt - box / 2.0
+            return pts, radii, test_list
+
+        pts_ref, radii_ref, test_list = place_obstacles_reference(numpy.random.RandomState(0))
+        pts, radii, (tile_offsets, tile_bodies) = _place_obstacles(numpy.random.RandomState(0), num_obstacles, box,
+                                                                    (0.5, 2.0), our_radius)
+        self.assertTrue(numpy.array_equal(pts, pts_ref) and numpy.array_equal(radii, radii_ref))
+        for tile in range(0, TILES ** 2, 7):
+            self.assertEqual(tile_bodies[tile_offsets[tile]:tile_offsets[tile + 1]].tolist(), test_list[tile])
+
+        # bodies as built by _random_obstacles(): box, sphere and capsule primitives scaled by the radii
+        boxside = numpy.sqrt(2)
+        colliders = [SimpleNamespace(corner0=-boxside / 2 * numpy.ones(3), corner1=boxside / 2 * numpy.ones(3)),
+                     SimpleNamespace(radius=1.0), SimpleNamespace(radius=1.0, height=2.0)]
+        bodies = []
+        for i in range(len(radii)):
+            matrix = numpy.diag([radii[i], radii[i], radii[i] * (0.5 + i / len(radii)), 1.])
+            matrix[:3, 3] = pts[i, 0], pts[i, 1], radii[i] * (i % 2)
+            bodies.append(SimpleNamespace(mat_inv=numpy.linalg.inv(matrix), children=SimpleNamespace(
+                children=[SimpleNamespace(collider=colliders[i % 3])])))
+        obstacle_map = ObstacleMap(box, bodies, (tile_offsets, tile_bodies))
+        self.assertTrue(numpy.array_equal(obstacle_map.free_tiles.reshape(-1), [len(l) == 0 for l in test_list]))
+
+        def collide_reference(point, arm):
+            r, c = obstacle_map.coord2tile(*point[:2])
+            if point[2] <= arm or r < 0 or c < 0 or r >= TILES or c >= TILES:
+                return True
+            for k in test_list[r * TILES + c]:
+                x = (bodies[k].mat_inv @ numpy.append(point, 1.))[:3]
+                rlocal = (arm + 0.1) * bodies[k].mat_inv[0, 0]
+                collider = colliders[k % 3]
+                if k % 3 == 0:
+                    nearest = numpy.maximum(collider.corner0, numpy.minimum(x, collider.corner1))
+                    hit = numpy.sum((x - nearest) ** 2) < rlocal ** 2
+                elif k % 3 == 1:
+                    hit = numpy.sum(x ** 2) < (collider.radius + rlocal) ** 2
+                else:
+                    nearest = [0, 0, min(max(0, x[2]), collider.height)]
+                    hit = numpy.sum((x - nearest) ** 2) < (collider.radius + rlocal) ** 2
+                if hit:
+                    return True
+            return False
+
+        rng = numpy.random.default_rng(0)
+        points = numpy.concatenate((pts[rng.integers(len(pts), size=2000)], rng.uniform(0., 3., (2000, 1))), axis=1)
+        points[:, :2] += rng.uniform(-2.5, 2.5, size=(2000, 2))
+        points[:10, :2] = box  # outside of the walls
+        collided = obstacle_map.detect_collisions(points, 0.046)
+        expected = [collide_reference(p, 0.046) for p in points]
+        self.assertTrue(numpy.array_equal(collided, expected))
+        self.assertGreater(collided.sum(), 100)
+        self.assertLess(collided.sum(), 1900)
+
+        start = time.time()
+        _place_obstacles(numpy.random.RandomState(0), 2000, 400.0, (0.5, 2.0), our_radius)
+        print(f'Placement of 2000 obstacles: {(time.time() - start) * 1e3:.1f} ms')
+        start = time.time()
+        obstacle_map.detect_collisions(points, 0.046)
+        print(f'Collisions of 2000 points, batched: {(time.time() - start) * 1e3:.2f} ms')
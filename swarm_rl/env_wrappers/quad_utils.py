@@ -56,7 +56,7 @@ def make_quadrotor_env_single(cfg, **kwargs):
 
 
 def make_quadrotor_env_multi(cfg, **kwargs):
-    from gym_art.quadrotor_multi.quadrotor_multi import QuadrotorEnvMulti
+    from gym_art.quadrotor_multi.quadrotor_multi import QuadrotorEnvMulti, QuadrotorVecEnvMulti
     quad = 'Crazyflie'
     dyn_randomize_every = dyn_randomization_ratio = None
 
@@ -78,22 +78,35 @@ def make_quadrotor_env_multi(cfg, **kwargs):
 
     use_replay_buffer = cfg.replay_buffer_sample_prob > 0.0
 
-    env = QuadrotorEnvMulti(
+    if cfg.quads_num_vec_envs > 1:
+        if use_replay_buffer:
+            raise NotImplementedError('Replay buffer is not supported with --quads_num_vec_envs > 1')
+        env_cls, env_kwargs = QuadrotorVecEnvMulti, dict(num_envs=cfg.quads_num_vec_envs)
+    else:
+        env_cls, env_kwargs = QuadrotorEnvMulti, dict()
+
+    env = env_cls(
+        **env_kwargs,
         num_agents=cfg.quads_num_agents,
         dynamics_params=quad, raw_control=raw_control, raw_control_zero_middle=raw_control_zero_middle,
         dynamics_randomize_every=dyn_randomize_every, dynamics_change=dynamics_change, dyn_sampler_1=sampler_1,
         sense_noise=sense_noise, init_random_state=True, ep_time=episode_duration, room_length=cfg.room_dims[0],
         room_width=cfg.room_dims[1], room_height=cfg.room_dims[2], rew_coeff=rew_coeff,
         quads_mode=cfg.quads_mode, quads_formation=cfg.quads_formation, quads_formation_size=cfg.quads_formation_size,
-        swarm_obs=extended_obs, quads_use_numba=cfg.quads_use_numba, quads_settle=cfg.quads_settle, quads_settle_range_meters=cfg.quads_settle_range_meters,
+        swarm_obs=extended_obs, quads_use_numba=cfg.quads_use_numba, quads_num_threads=cfg.quads_num_threads, quads_integrator=cfg.quads_integrator,
+        quads_attitude=cfg.quads_attitude, quads_precision=cfg.quads_precision, quads_noise_pool=cfg.quads_noise_pool,
+        quads_info_level=cfg.quads_info_level, sim_freq=100. * cfg.quads_sim_steps, sim_steps=cfg.quads_sim_steps,
+        quads_settle=cfg.quads_settle, quads_settle_range_meters=cfg.quads_settle_range_meters,
         quads_vel_reward_out_range=cfg.quads_vel_reward_out_range, quads_obstacle_mode=cfg.quads_obstacle_mode,
         quads_view_mode=cfg.quads_view_mode, quads_obstacle_num=cfg.quads_obstacle_num, quads_obstacle_type=cfg.quads_obstacle_type, quads_obstacle_size=cfg.quads_obstacle_size,
         adaptive_env=cfg.quads_adaptive_env, obstacle_traj=cfg.quads_obstacle_traj, local_obs=cfg.quads_local_obs, obs_repr=cfg.quads_obs_repr,
         collision_hitbox_radius=cfg.quads_collision_hitbox_radius, collision_falloff_radius=cfg.quads_collision_falloff_radius,
         local_metric=cfg.quads_local_metric,
         local_coeff=cfg.quads_local_coeff,  # how much velocity matters in "distance" calculation
+        quads_neighbor_search=cfg.quads_neighbor_search, quads_collision_broad_phase=cfg.quads_collision_broad_phase,
         use_replay_buffer=use_replay_buffer, obstacle_obs_mode=cfg.quads_obstacle_obs_mode,
-        obst_penalty_fall_off=cfg.quads_obst_penalty_fall_off,
+        obst_penalty_fall_off=cfg.quads_obst_penalty_fall_off, quads_obstacle_sdf=cfg.quads_obstacle_sdf,
+        quads_obstacle_sdf_resolution=cfg.quads_obstacle_sdf_resolution,
     )
 
     if use_replay_buffer:
@@ -1,6 +1,13 @@
 from sample_factory.utils.utils import str2bool
 
 
+def str2numba_mode(v):
+    """--quads_use_numba accepts a boolean or the name of a numba mode, 'fused' or 'parallel'."""
+    if isinstance(v, str) and v.lower() in ('fused', 'parallel'):
+        return v.lower()
+    return str2bool(v)
+
+
 def quadrotors_override_defaults(env, parser):
     parser.set_defaults(
         encoder_type='mlp',
@@ -20,6 +27,7 @@ def add_quadrotors_env_args(env, parser):
     p.add_argument('--quads_effort_reward', default=None, type=float, help='Override default value for effort reward')
     p.add_argument('--quads_episode_duration', default=15.0, type=float, help='Override default value for episode duration')
     p.add_argument('--quads_num_agents', default=8, type=int, help='Override default value for the number of quadrotors')
+    p.add_argument('--quads_num_vec_envs', default=1, type=int, help='Number of swarms simulated by a single env object (QuadrotorVecEnvMulti). Each swarm has quads_num_agents quadrotors. More than one swarm is not supported with --quads_use_numba=fused/parallel')
     p.add_argument('--quads_neighbor_hidden_size', default=256, type=int, help='The hidden size for the neighbor encoder')
     p.add_argument('--quads_neighbor_encoder_type', default='attention', type=str, choices=['attention', 'mean_embed', 'mlp', 'no_encoder'], help='The type of the neighborhood encoder')
 
@@ -36,15 +44,26 @@ def add_quadrotors_env_args(env, parser):
     p.add_argument('--quads_collision_smooth_max_penalty', default=10.0, type=float, help='The upper bound of the collision function given distance among drones')
 
     p.add_argument('--neighbor_obs_type', default='none', type=str, choices=['none', 'pos_vel', 'pos_vel_goals', 'pos_vel_goals_ndist_gdist'], help='Choose what kind of obs to send to encoder.')
-    p.add_argument('--quads_use_numba', default=False, type=str2bool, help='Whether to use numba for jit or not')
+    p.add_argument('--quads_use_numba', default=False, type=str2numba_mode, help='Whether to use numba for jit or not. fused: the whole control step of the swarm is a single numba call. parallel: fused, with the agents distributed over numba threads (for swarms of 64+ drones)')
+    p.add_argument('--quads_num_threads', default=None, type=int, help='Number of numba threads used by --quads_use_numba=parallel. Default (None) means all available threads')
+    p.add_argument('--quads_integrator', default='euler', type=str, choices=['euler', 'semi_implicit', 'rk4'], help='Integration scheme of the numba dynamics. rk4 at --quads_sim_steps=1 is more accurate than the default euler at 2 simulation steps per control step')
+    p.add_argument('--quads_attitude', default='rot', type=str, choices=['rot', 'quat'], help='Attitude representation of the numba dynamics. quat: unit quaternions renormalized every step instead of rotation matrices with a periodic SVD, the matrices are only computed for observations, rewards and rendering')
+    p.add_argument('--quads_precision', default='float64', type=str, choices=['float64', 'float32'], help='Floating point type of the dynamics state, observations and distance matrices')
+    p.add_argument('--quads_noise_pool', default=False, type=str2bool, help='Draw the thrust and sensor noise from pre-generated blocks of random numbers, seeded by env.seed(). Not used by --quads_use_numba=fused/parallel')
+    p.add_argument('--quads_info_level', default='none', type=str, choices=['none', 'rewards', 'full'], help='Content of the per-agent info dicts. none: only the episode sums of the reward components at the end of episodes. rewards: also the reward components of every step. full: also observation components and dynamics parameters, which are otherwise available with env.get_diagnostics()')
+    p.add_argument('--quads_sim_steps', default=2, type=int, help='Simulation steps per control step, the control frequency stays at 100 Hz')
     p.add_argument('--quads_obstacle_mode', default='no_obstacles', type=str, choices=['no_obstacles', 'static', 'dynamic'], help='Choose which obstacle mode to run')
     p.add_argument('--quads_obstacle_num', default=0, type=int, help='Choose the number of obstacle(s)')
     p.add_argument('--quads_obstacle_type', default='sphere', type=str, choices=['sphere', 'cube', 'random'], help='Choose the type of obstacle(s)')
     p.add_argument('--quads_obstacle_size', default=0.0, type=float, help='Choose the size of obstacle(s)')
     p.add_argument('--quads_obstacle_traj', default='gravity', type=str, choices=['gravity', 'electron', 'mix'],  help='Choose the type of force to use')
+    p.add_argument('--quads_obstacle_sdf', default=False, type=str2bool, help='Answer the obstacle collision and proximity queries from a signed distance grid over the room, built at every reset. Only for obstacles that do not move within an episode (not --quads_obstacle_mode=dynamic)')
+    p.add_argument('--quads_obstacle_sdf_resolution', default=0.1, type=float, help='Spacing of the nodes of the signed distance grid of --quads_obstacle_sdf, in meters')
     p.add_argument('--quads_local_obs', default=-1, type=int, help='Number of neighbors to consider. -1=all neighbors. 0=blind agents, 0<n<num_agents-1 = nonzero number of agents')
     p.add_argument('--quads_local_coeff', default=0.0, type=float, help='This parameter is used for the metric of select which drones are the N closest drones.')
     p.add_argument('--quads_local_metric', default='dist_inverse', type=str, choices=['dist', 'dist_inverse'], help='The main part of evaluate the closest drones')
+    p.add_argument('--quads_neighbor_search', default='full', type=str, choices=['full', 'kdtree'], help='Search of the closest drones with --quads_local_obs. full: metric of all pairs of drones. kdtree: only the metric of the nearest candidates found by a KD-tree, for large swarms. Not supported with --quads_use_numba=fused/parallel')
+    p.add_argument('--quads_collision_broad_phase', default='dense', type=str, choices=['dense', 'grid'], help='Drone-drone collisions and proximity penalties. dense: distances of all pairs of drones. grid: uniform grid broad phase that only returns the pairs within the hitbox / fall-off radius, for large swarms. Not supported with --quads_use_numba=fused/parallel')
 
     p.add_argument('--quads_view_mode', default='local', type=str, choices=['local', 'global'], help='Choose which kind of view/camera to use')
     p.add_argument('--quads_adaptive_env', default=False, type=str2bool, help='Iteratively shrink the environment into a tunnel to increase obstacle density based on statistics')
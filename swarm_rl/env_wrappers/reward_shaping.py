@@ -29,6 +29,8 @@ class QuadsRewardShapingWrapper(gym.Wrapper, RewardShapingInterface, TrainingInf
         self.episode_actions = None
 
         self.num_agents = env.num_agents if hasattr(env, 'num_agents') else 1
+        # the env sums the reward components itself and reports them in info['episode_rewards'] at the end of episodes
+        self.env_episode_rewards = getattr(env.unwrapped, 'reports_episode_rewards', False)
 
         self.reward_shaping_updated = True
 
@@ -68,22 +70,25 @@ class QuadsRewardShapingWrapper(gym.Wrapper, RewardShapingInterface, TrainingInf
             infos_multi, dones_multi = [infos], [dones]
 
         for i, info in enumerate(infos_multi):
-            rew_dict = info['rewards']
-
-            for key, value in rew_dict.items():
-                if key.startswith('rew'):
-                    if key not in self.cumulative_rewards[i]:
-                        self.cumulative_rewards[i][key] = 0
-                    self.cumulative_rewards[i][key] += value
+            if not self.env_episode_rewards:
+                for key, value in info['rewards'].items():
+                    if key.startswith('rew'):
+                        if key not in self.cumulative_rewards[i]:
+                            self.cumulative_rewards[i][key] = 0
+                        self.cumulative_rewards[i][key] += value
 
             if dones_multi[i]:
-                true_reward = self.cumulative_rewards[i]['rewraw_main']
-                true_reward_consider_collisions = True
-                if true_reward_consider_collisions:
-                    # we ideally want zero collisions, so collisions between quads are given very high weight
-                    true_reward += 1000 * self.cumulative_rewards[i].get('rewraw_quadcol', 0)
+                if self.env_episode_rewards:
+                    self.cumulative_rewards[i] = info['episode_rewards']
+
+                if 'rewraw_main' in self.cumulative_rewards[i]:
+                    true_reward = self.cumulative_rewards[i]['rewraw_main']
+                    true_reward_consider_collisions = True
+                    if true_reward_consider_collisions:
+                        # we ideally want zero collisions, so collisions between quads are given very high weight
+                        true_reward += 1000 * self.cumulative_rewards[i].get('rewraw_quadcol', 0)
 
-                info['true_reward'] = true_reward
+                    info['true_reward'] = true_reward
                 if 'episode_extra_stats' not in info:
                     info['episode_extra_stats'] = dict()
                 extra_stats = info['episode_extra_stats']
@@ -95,7 +100,8 @@ class QuadsRewardShapingWrapper(gym.Wrapper, RewardShapingInterface, TrainingInf
                 if hasattr(self.env.unwrapped, 'scenario') and self.env.unwrapped.scenario:
                     scenario_name = self.env.unwrapped.scenario.name()
                     for rew_key in ['rew_pos', 'rewraw_pos', 'rew_crash', 'rewraw_crash']:
-                        extra_stats[f'{rew_key}_{scenario_name}'] = self.cumulative_rewards[i][rew_key]
+                        if rew_key in self.cumulative_rewards[i]:
+                            extra_stats[f'{rew_key}_{scenario_name}'] = self.cumulative_rewards[i][rew_key]
 
                 episode_actions = np.array(self.episode_actions)
                 episode_actions = episode_actions.transpose()
@@ -9,6 +9,7 @@ from sample_factory.algorithms.utils.arguments import parse_args
 from sample_factory.envs.env_registry import global_env_registry
 from sample_factory.run_algorithm import run_algorithm
 
+from gym_art.quadrotor_multi import warmup
 from swarm_rl.env_wrappers.quad_utils import make_quadrotor_env
 from swarm_rl.env_wrappers.quadrotor_params import add_quadrotors_env_args, quadrotors_override_defaults
 from swarm_rl.models.quad_multi_model import register_models
@@ -29,6 +30,9 @@ def main():
     """Script entry point."""
     register_custom_components()
     cfg = parse_args(evaluation=False)
+    if cfg.env == 'quadrotor_multi' and cfg.quads_use_numba:
+        # populate the on-disk numba cache once, before the rollout workers start
+        warmup(quads_use_numba=cfg.quads_use_numba, quads_precision=cfg.quads_precision)
     status = run_algorithm(cfg)
     return status
 